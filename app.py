@@ -1,13 +1,17 @@
 import streamlit as st
-import requests
-import json
 import base64
 import time
-from PIL import Image
-import io
+import uuid
+import functools
+import re
 import db  # Import database module
-
-import google.generativeai as genai
+import veo_jobs
+import video_downloader
+import media_tiles
+import media_budget
+import preprocess
+import engines
+import image_jobs
 
 # --- 設定 ---
 # APIキーは st.secrets から取得 (ローカルでは .streamlit/secrets.toml, クラウドではSecrets管理画面で設定)
@@ -27,22 +31,11 @@ if not API_KEY:
     if not API_KEY:
         st.warning("KIEAI APIキーが設定されていません。画像生成機能は使用できません。")
 
-# Gemini API Key
-try:
-    if "GEMINI_API_KEY" in st.secrets:
-        GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-    else:
-        GEMINI_API_KEY = None
-except:
-    GEMINI_API_KEY = None
-
-if not GEMINI_API_KEY:
-    GEMINI_API_KEY = st.sidebar.text_input("Gemini API Key (for Auto Categorization)", type="password")
-
 CREATE_TASK_URL = "https://api.kie.ai/api/v1/jobs/createTask"
 
 # --- 関数: 画像をBase64文字列に変換 ---
 def image_to_base64(image):
+    import io
     buffered = io.BytesIO()
     # RGBA (透過) 画像の場合はRGBに変換 (JPEG対応のため)
     if image.mode in ("RGBA", "LA", "P"):
@@ -54,6 +47,7 @@ def image_to_base64(image):
 
 # --- 関数: 画像アップロード ---
 def upload_image_to_kieai(headers, base64_image):
+    import requests  # requests / PIL は使うときだけ読み込む (起動時間の短縮)
     upload_url = "https://kieai.redpandaai.co/api/file-base64-upload"
     upload_payload = {
         "base64Data": base64_image,
@@ -72,6 +66,7 @@ def upload_image_to_kieai(headers, base64_image):
 
 # --- 関数: Webhookトークン取得 ---
 def get_webhook_token():
+    import requests
     try:
         res = requests.post("https://webhook.site/token")
         if res.status_code in [200, 201]:
@@ -81,48 +76,62 @@ def get_webhook_token():
         pass
     return None
 
-# --- 関数: Geminiで画像を分類 ---
-def categorize_image_with_gemini(image_bytes):
-    if not GEMINI_API_KEY:
-        return None, "API Key Missing"
-    
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-flash-latest')
-        
-        image_part = {"mime_type": "image/jpeg", "data": image_bytes}
-        
-        prompt = """
-        この画像を解析し、以下のカテゴリのいずれか1つに分類してください:
-        [リビング, ダイニング, キッチン, 寝室, バスルーム, 玄関, 外観, 庭, その他]
-        
-        また、画像の内容を短い日本語で説明してください（最大20文字）。
-        
-        結果を以下のJSON形式で返してください:
-        {
-            "category": "カテゴリ名",
-            "description": "短い説明"
-        }
-        """
-        
-        response = model.generate_content([prompt, image_part])
-        text = response.text
-        # JSON部分を抽出 (Markdownのコードブロックを除去)
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        elif "```" in text:
-            text = text.split("```")[1].split("```")[0]
-            
-        return json.loads(text)
-    except Exception as e:
-        return None, str(e)
-
-# --- UI構築 ---
-st.set_page_config(page_title="ishitomo-home AI パース β版", layout="wide")
-
-# カスタムCSSの注入
-st.markdown("""
-<style>
+# --- 関数: ギャラリーのページ送り (キーセットページネーション) ---
+# セッションにはカーソルの履歴と現在ページだけを持ち、1回の再実行で取得・描画するのは1ページ分に限定する
+def get_gallery_page(state_key, page_size, media=None):
+    state = st.session_state.setdefault(state_key, {"cursors": [None], "page": None})
+    if state["page"] is None:
+        state["page"] = db.get_results_page(cursor=state["cursors"][-1], page_size=page_size, media=media)
+    records, next_cursor = state["page"]
+    return records, next_cursor, len(state["cursors"])
+
+def _gallery_go_older(state_key, next_cursor):
+    state = st.session_state[state_key]
+    state["cursors"].append(next_cursor)
+    state["page"] = None
+
+def _gallery_go_newer(state_key):
+    state = st.session_state[state_key]
+    if len(state["cursors"]) > 1:
+        state["cursors"].pop()
+    state["page"] = None
+
+def _gallery_reset(state_key):
+    st.session_state[state_key] = {"cursors": [None], "page": None}
+
+def render_gallery_pager(state_key, next_cursor, page_no):
+    col_newer, col_page, col_older = st.columns([1, 1, 1])
+    with col_newer:
+        if page_no > 1:
+            st.button("◀ 新しい結果", key=f"{state_key}_newer", on_click=_gallery_go_newer, args=(state_key,))
+        else:
+            st.button("🔄 最新に更新", key=f"{state_key}_reset", on_click=_gallery_reset, args=(state_key,))
+    with col_page:
+        st.caption(f"ページ {page_no}")
+    with col_older:
+        if next_cursor:
+            st.button("さらに古い結果 ▶", key=f"{state_key}_older", on_click=_gallery_go_older, args=(state_key, next_cursor))
+
+# --- 関数: 画像生成の実行結果 (Grid表示) ---
+def render_image_run(run):
+    cols = st.columns(2) # 2列で表示
+    for idx, task in enumerate(run.tasks):
+        with cols[idx % 2]:
+            if task.result_url:
+                st.image(task.result_url, use_container_width=True)
+                st.markdown(f"**{task.label}**")
+            elif task.status == image_jobs.STATUS_FAILED:
+                st.error(f"{task.label}: 生成失敗 ({task.error})")
+            elif task.status == image_jobs.STATUS_TIMEOUT:
+                st.error(f"{task.label}: {task.error}")
+            elif task.status == image_jobs.STATUS_QUEUED:
+                st.info(f"{task.label}: 送信待ち")
+            else:
+                st.info(f"{task.label}: 生成中...")
+
+# --- スタイル ---
+# 画面全体のCSSは1つの <style> にまとめる (生成中のループやギャラリーの中では出さない)
+APP_CSS = """
     @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@300;400;700&display=swap');
     
     html, body, [class*="css"] {
@@ -201,8 +210,53 @@ st.markdown("""
         font-size: 0.85rem;
         line-height: 1.4;
     }
-</style>
-""", unsafe_allow_html=True)
+
+    /* 生成結果ギャラリー (Tab 1) */
+    .gallery-container {
+        display: grid;
+        grid-template-columns: repeat(auto-fit, minmax(250px, 1fr));
+        gap: 1rem;
+        padding: 1rem 0;
+    }
+    .gallery-item {
+        background: white;
+        padding: 10px;
+        border-radius: 8px;
+        box-shadow: 0 2px 5px rgba(0,0,0,0.1);
+        text-align: center;
+    }
+    .gallery-item img {
+        width: 100%;
+        border-radius: 4px;
+        margin-bottom: 8px;
+    }
+    .gallery-label {
+        font-weight: bold;
+        color: #555;
+        font-size: 0.9rem;
+    }
+
+    /* コミュニティギャラリー */
+    .community-gallery-container {
+        display: grid;
+        grid-template-columns: repeat(auto-fill, minmax(200px, 1fr));
+        gap: 1rem;
+        padding: 1rem 0;
+    }
+"""
+
+@st.cache_resource
+def app_styles():
+    """コメント・空白を除いた <style> 要素 (整形はプロセスで1回だけ)"""
+    css = re.sub(r"/\*.*?\*/", "", APP_CSS, flags=re.S)
+    return "<style>" + re.sub(r"\s+", " ", css).strip() + "</style>"
+
+# --- UI構築 ---
+st.set_page_config(page_title="ishitomo-home AI パース β版", layout="wide")
+
+# カスタムCSSの注入
+# Streamlit は再実行で出力されなかった要素を消すため、CSS も毎回出す (中身は同じなので再描画はされない)
+st.markdown(app_styles(), unsafe_allow_html=True)
 
 st.markdown('<div class="main-header">ishitomo-home AI パース <span style="font-size: 1rem; color: #e74c3c; vertical-align: middle;">β版</span></div>', unsafe_allow_html=True)
 st.markdown('<div class="sub-header">手書きスケッチや簡易モデルから、フォトリアルな建築パースを生成します。</div>', unsafe_allow_html=True)
@@ -263,22 +317,30 @@ with tab1:
         aspect_ratio = st.selectbox("アスペクト比", ["16:9", "1:1", "9:16", "4:3", "3:4"], index=0)
         
         # モデル選択
-        model_options = ["Nano Banana Pro", "Flux 2 Flex", "Seedream 4.5 Edit", "GPT Image 1.5"]
+        model_options = engines.get_registry().names()
         selected_models = st.multiselect("使用するモデル (複数選択可)", model_options, default=["Seedream 4.5 Edit", "Nano Banana Pro", "Flux 2 Flex"])
         
-        st.info(f"ℹ️ 選択された {len(selected_models)} つのエンジンで同時に生成します。")
+        # 最初の N 件: 先にそろった結果だけを待ち、残りはバックグラウンドで生成を続ける
+        first_n = None
+        if st.toggle("最初の N 件がそろったら完了にする", key="image_first_n_mode",
+                     help="時間を決めるのは一番速いエンジンになります。残りの結果も完了したらコミュニティギャラリーに追加されます。"):
+            max_results = max(len(selected_models) * max(len(uploaded_files or []), 1), 1)
+            first_n = int(st.number_input("必要な結果の件数 (N)", min_value=1, max_value=max_results, value=1, step=1, key="image_first_n"))
+            st.info(f"ℹ️ 選択された {len(selected_models)} つのエンジンで同時に生成し、最初の {first_n} 件がそろった時点で完了します。")
+        else:
+            st.info(f"ℹ️ 選択された {len(selected_models)} つのエンジンで同時に生成します。")
 
         run_button = st.button("パースを生成する", type="primary")
 
     # --- 実行処理 ---
+    image_manager = image_jobs.get_job_manager()
+    image_session_id = st.session_state.setdefault("image_session_id", uuid.uuid4().hex)
     if run_button and uploaded_files:
         if not API_KEY:
             st.error("KIEAI API Keyが必要です。")
             st.stop()
 
         with col_result:
-            st.subheader("3. 結果ギャラリー")
-            
             try:
                 with st.spinner('画像を処理してAPIに送信中...'):
                     headers = {
@@ -287,22 +349,22 @@ with tab1:
                     }
 
                     # 1. 画像の前処理 & アップロード (複数対応)
-                    input_urls = []
+                    # エンジンごとの比率・解像度に合わせて切り抜き・縮小し、同じ画像になるエンジン同士は1回のアップロードを共有する
+                    input_urls = []  # 画像ごとの {エンジン: URL}
                     
+                    from PIL import Image
                     for i, uploaded_file in enumerate(uploaded_files):
                         image = Image.open(uploaded_file)
+                        image.load()
+                        targets, variants, engine_variants = preprocess.plan_inputs(image, selected_models, aspect_ratio, resolution)
                         
-                        # リサイズ
-                        image.thumbnail((1024, 1024)) 
-                        base64_image = image_to_base64(image)
-                        
-                        # アップロード (共通)
-                        img_url = upload_image_to_kieai(headers, base64_image)
-                        if img_url:
-                            input_urls.append(img_url)
-                        else:
-                            st.error(f"画像のアップロードに失敗しました ({i+1})")
-                            st.stop()
+                        variant_urls = {}
+                        for key, variant in variants.items():
+                            variant_urls[key] = upload_image_to_kieai(headers, image_to_base64(variant))
+                            if not variant_urls[key]:
+                                st.error(f"画像のアップロードに失敗しました ({i+1})")
+                                st.stop()
+                        input_urls.append({engine: variant_urls[key] for engine, key in engine_variants.items()})
                     
                     if not input_urls:
                          st.error("画像が正しくアップロードされませんでした。")
@@ -315,245 +377,88 @@ with tab1:
                         st.stop()
                     callback_url = f"https://webhook.site/{wh_uuid}"
                     
-                    # C. タスク作成
-                    url = "https://api.kie.ai/api/v1/jobs/createTask"
-                    
-                    tasks = {} # {task_id: {"engine": name, "status": "pending", "result_url": None}}
-                    
-                    # Payloads construction
-                    payloads = []
-                    
-                    # Iterate over each uploaded image to create separate tasks
-                    for img_idx, single_img_url in enumerate(input_urls):
-                        img_label = f"#{img_idx + 1}"
-                        single_input_list = [single_img_url] # API expects a list
-
-                        # 1. Nano Banana Pro
-                        if "Nano Banana Pro" in selected_models:
-                            payloads.append((f"Nano Banana Pro {img_label}", {
-                                "model": "nano-banana-pro",
-                                "callBackUrl": callback_url,
-                                "input": {
-                                    "prompt": prompt,
-                                    "image_input": single_input_list,
-                                    "aspect_ratio": aspect_ratio,
-                                    "resolution": resolution,
-                                    "output_format": "png"
-                                }
-                            }))
-                        
-                        # 2. Flux 2 Flex
-                        if "Flux 2 Flex" in selected_models:
-                            # Fix: Flux 2 does not support 4K, so map 4K -> 2K
-                            flux_resolution = "2K" if resolution == "4K" else resolution
-                            
-                            payloads.append((f"Flux 2 Flex {img_label}", {
-                                "model": "flux-2/flex-image-to-image",
-                                "callBackUrl": callback_url,
-                                "input": {
-                                    "input_urls": single_input_list,
-                                    "prompt": prompt,
-                                    "aspect_ratio": aspect_ratio if aspect_ratio != "auto" else "1:1",
-                                    "resolution": flux_resolution,
-                                    "strength": strength
-                                }
-                            }))
-
-                        # 3. Seedream 4.5 Edit
-                        if "Seedream 4.5 Edit" in selected_models:
-                            # Quality param mapping
-                            sd_quality = "high" if resolution == "4K" else "basic"
-                            
-                            payloads.append((f"Seedream 4.5 Edit {img_label}", {
-                                "model": "seedream/4.5-edit",
-                                "callBackUrl": callback_url,
-                                "input": {
-                                    "prompt": prompt,
-                                    "image_urls": single_input_list,
-                                    "aspect_ratio": aspect_ratio,
-                                    "quality": sd_quality
-                                }
-                            }))
-                        
-                        # 4. GPT Image 1.5 (KIE AI)
-                        if "GPT Image 1.5" in selected_models:
-                            # GPT Image 1.5のアスペクト比マッピング (サポート: 1:1, 2:3, 3:2)
-                            gpt_ar_mapping = {
-                                "16:9": "3:2",  # 横長 -> 3:2
-                                "9:16": "2:3",  # 縦長 -> 2:3
-                                "1:1": "1:1",   # 正方形
-                                "4:3": "3:2",   # 横長 -> 3:2
-                                "3:4": "2:3"    # 縦長 -> 2:3
-                            }
-                            gpt_aspect = gpt_ar_mapping.get(aspect_ratio, "3:2")
-                            
-                            # Quality: 4Kの場合はhigh、それ以外はmedium
-                            gpt_quality = "high" if resolution == "4K" else "medium"
-                            
-                            # プロンプトを最大1000文字に切り詰め (API制限)
-                            gpt_prompt = prompt[:1000] if len(prompt) > 1000 else prompt
-                            
-                            payloads.append((f"GPT Image 1.5 {img_label}", {
-                                "model": "gpt-image/1.5-image-to-image",
-                                "callBackUrl": callback_url,
-                                "input": {
-                                    "input_urls": single_input_list,
-                                    "prompt": gpt_prompt,
-                                    "aspect_ratio": gpt_aspect,
-                                    "quality": gpt_quality
-                                }
-                            }))
-
-                    # Send Requests
-                    for engine_name, payload in payloads:
-                        try:
-                            res = requests.post(url, headers=headers, data=json.dumps(payload))
-                            if res.status_code == 200:
-                                r_data = res.json()
-                                if r_data.get("code") == 200:
-                                    tid = r_data["data"]["taskId"]
-                                    tasks[tid] = {"engine": engine_name, "status": "pending", "result_url": None}
-                                    st.toast(f"{engine_name} タスク開始: {tid}")
-                                else:
-                                    st.error(f"{engine_name} 開始エラー: {r_data.get('msg')}")
-                            else:
-                                st.error(f"{engine_name} APIエラー: {res.status_code}")
-                        except Exception as e:
-                            st.error(f"{engine_name} 送信エラー: {e}")
-
-                    if not tasks:
+                    # C. タスク作成 (エンジンごとの payload はレジストリで組み立てる)
+                    # 比率・解像度はエンジンごとのプロファイルで受け付ける値に変換済み (preprocess.PROFILES)
+                    # 直近のレイテンシ・失敗率から、速く安定しているエンジンを先に送る
+                    engine_registry = engines.get_registry()
+                    submit_order = engine_registry.submission_order(selected_models)
+                    queued = []  # [(エンジン名, 表示名, payload), ...]
+                    for img_idx, engine_urls in enumerate(input_urls):
+                        for engine_name in submit_order:
+                            queued.append((engine_name, f"{engine_name} #{img_idx + 1}", engine_registry.get(engine_name).build_payload(
+                                prompt, engine_urls[engine_name], targets[engine_name], callback_url, strength=strength)))
+                    if not queued:
+                        st.warning("使用するモデルを選択してください。")
                         st.stop()
 
-                    # D. ポーリング & ギャラリー表示
-                    st.markdown("### 生成中...")
-                    progress_bar = st.progress(0)
-                    gallery_placeholder = st.empty()
-                    
-                    poll_wh_url = f"https://webhook.site/token/{wh_uuid}/requests"
-                    
-                    # ポーリングループ
-                    start_time = time.time()
-                    while True:
-                        # タイムアウト判定 (300秒)
-                        if time.time() - start_time > 300:
-                            st.error("タイムアウトしました。")
-                            break
-                            
-                        # 全タスク完了判定
-                        pending_tasks = [tid for tid, info in tasks.items() if info["status"] == "pending"]
-                        if not pending_tasks:
-                            progress_bar.progress(1.0)
-                            st.success("全タスク完了！")
-                            break
-                        
-                        # 進捗バー更新 (簡易)
-                        elapsed = time.time() - start_time
-                        progress_bar.progress(min(elapsed / 60, 0.95)) # 60秒で95%まで
-                        
-                        try:
-                            wh_reqs = requests.get(poll_wh_url, timeout=10)
-                            if wh_reqs.status_code == 200:
-                                reqs_data = wh_reqs.json()
-                                data_list = reqs_data.get("data", [])
-                                
-                                for req in data_list:
-                                    content = req.get("content")
-                                    if content:
-                                        try:
-                                            body = json.loads(content)
-                                            data_body = body.get("data", {})
-                                            rec_tid = data_body.get("taskId")
-                                            
-                                            if rec_tid in tasks and tasks[rec_tid]["status"] == "pending":
-                                                state = data_body.get("state")
-                                                
-                                                if state == "success":
-                                                    # 結果URL取得
-                                                    res_url = None
-                                                    if "resultUrls" in data_body and data_body["resultUrls"]:
-                                                        res_url = data_body["resultUrls"][0]
-                                                    elif "resultJson" in data_body:
-                                                        rj = json.loads(data_body["resultJson"])
-                                                        if "resultUrls" in rj and rj["resultUrls"]:
-                                                            res_url = rj["resultUrls"][0]
-                                                    
-                                                    if res_url:
-                                                        tasks[rec_tid]["status"] = "success"
-                                                        tasks[rec_tid]["result_url"] = res_url
-                                                        st.toast(f"{tasks[rec_tid]['engine']} 完了！")
-                                                        
-                                                        # DBに保存
-                                                        db.save_result(res_url, prompt, tasks[rec_tid]['engine'])
-                                                
-                                                elif state == "fail":
-                                                    tasks[rec_tid]["status"] = "failed"
-                                                    st.error(f"{tasks[rec_tid]['engine']} 失敗: {data_body.get('msg')}")
-                                        except:
-                                            pass
-                        except Exception:
-                            pass
-                        
-                        # ギャラリー更新 (Grid表示)
-                        with gallery_placeholder.container():
-                            # CSS Grid for Gallery
-                            st.markdown("""
-                            <style>
-                            .gallery-container {
-                                display: grid;
-                                grid-template-columns: repeat(auto-fit, minmax(250px, 1fr));
-                                gap: 1rem;
-                                padding: 1rem 0;
-                            }
-                            .gallery-item {
-                                background: white;
-                                padding: 10px;
-                                border-radius: 8px;
-                                box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-                                text-align: center;
-                            }
-                            .gallery-item img {
-                                width: 100%;
-                                border-radius: 4px;
-                                margin-bottom: 8px;
-                            }
-                            .gallery-label {
-                                font-weight: bold;
-                                color: #555;
-                                font-size: 0.9rem;
-                            }
-                            </style>
-                            """, unsafe_allow_html=True)
-                            
-                            cols = st.columns(2) # 2列で表示
-                            
-                            # 表示順序: Nano, Flux
-                            task_items = list(tasks.values())
-                            
-                            for idx, task_info in enumerate(task_items):
-                                with cols[idx % 2]:
-                                    if task_info["result_url"]:
-                                        st.image(task_info["result_url"], use_container_width=True)
-                                        st.markdown(f"**{task_info['engine']}**")
-                                        # ダウンロードボタンなど追加可能
-                                    elif task_info["status"] == "failed":
-                                        st.error(f"{task_info['engine']}: 生成失敗")
-                                    else:
-                                        st.info(f"{task_info['engine']}: 生成中...")
-
-                        time.sleep(3)
+                # 送信・完了確認・ギャラリーへの保存はバックグラウンドで行い、結果は下の render_image_results で表示する
+                # (エンジンごとの同時実行数の上限を超える分は、空きができてから送られる)
+                image_manager.start_run(image_session_id, API_KEY, wh_uuid, prompt, queued, first_n=first_n)
 
             except Exception as e:
                 st.error(f"システムエラー: {e}")
 
     elif run_button and not uploaded_files:
         st.warning("画像をアップロードしてください。")
+
+    # --- 生成結果 (live) ---
+    # 生成中のタスクがある間だけ、この部分だけを定期的に再実行する (ギャラリー・CSS・DBの読み込みは再実行しない)
+    # 「最初の N 件」モードでは N 件そろった時点で完了と表示し、残りのタスクの状態は引き続き更新する
+    @st.fragment(run_every=image_jobs.POLL_INTERVAL if image_manager.has_active_runs(image_session_id) else None)
+    def render_image_results():
+        runs = image_manager.runs_for(image_session_id)
+        if not runs:
+            return
+        run = runs[0]
+        st.subheader("3. 結果ギャラリー")
+        # 終了したタスクは1回だけ通知する
+        notified = st.session_state.setdefault("image_notified", set())
+        for task in run.tasks:
+            if not task.active and (run.run_id, task.label) not in notified:
+                notified.add((run.run_id, task.label))
+                st.toast(f"{task.label} 完了！" if task.status == image_jobs.STATUS_SUCCESS else f"{task.label} 失敗")
+
+        if not run.satisfied:
+            st.markdown("### 生成中...")
+            # 進捗バー (エンジンごとの直近のレイテンシから推定)
+            expected = max(engines.get_registry().expected_latency(task.engine) for task in run.tasks)
+            if run.first_n:
+                done_ratio = len(run.successes) / run.first_n
+            else:
+                done_ratio = sum(not task.active for task in run.tasks) / len(run.tasks)
+            st.progress(min(max((time.time() - run.created_at) / expected, done_ratio), 0.95))
+        render_image_run(run)
+        if run.satisfied:
+            remaining = sum(task.active for task in run.tasks)
+            if remaining:
+                st.success(f"{len(run.successes)} 件の結果がそろいました。残りの {remaining} 件はバックグラウンドで生成を続け、完了したらコミュニティギャラリーに追加されます。")
+            elif any(task.status == image_jobs.STATUS_TIMEOUT for task in run.tasks):
+                st.error("タイムアウトしました。")
+            else:
+                st.success("全タスク完了！")
+        background = sum(task.active for other in runs[1:] for task in other.tasks)
+        if background:
+            st.caption(f"以前の実行の {background} 件をバックグラウンドで生成中です。")
+
+        active = image_manager.has_active_runs(image_session_id)
+        if not active and st.session_state.get("image_runs_active"):
+            # 定期実行の停止と、新しい結果をコミュニティギャラリーに出すため、全体を1回だけ再実行する
+            st.session_state.image_runs_active = False
+            gallery_state = st.session_state.get("community_gallery")
+            if gallery_state and len(gallery_state["cursors"]) == 1:
+                gallery_state["page"] = None
+            st.rerun()
+        st.session_state.image_runs_active = active
+
+    with col_result:
+        render_image_results()
     
     # --- Community Gallery (Tab 1) ---
     st.markdown("---")
     st.subheader("🌐 コミュニティギャラリー")
     
     # DB接続チェック
-    if not db.get_connection():
+    if not db.is_available():
         st.warning("⚠️ ギャラリー機能を使用するには、Google Cloudの設定が必要です。")
         with st.expander("設定方法を見る"):
             st.markdown("""
@@ -562,42 +467,43 @@ with tab1:
             3. `.streamlit/secrets.toml` に `[gcp_service_account]` セクションを追加してJSONの内容を貼り付けてください。
             """)
     else:
-        st.markdown("他のユーザーが生成したパース一覧 (最新50件)")
-
-        # DBから取得
-        recent_results = db.get_recent_results(limit=50)
+        st.markdown("他のユーザーが生成したパース一覧")
+
+        # DBから1ページ分だけ取得
+        recent_results, gallery_next_cursor, gallery_page_no = get_gallery_page("community_gallery", page_size=24)
+        collapse_duplicates = st.checkbox("似ている画像をまとめる", value=True, key="gallery_collapse_duplicates")
+        # 近似重複はバッチ (gallery_index.py) で計算済みのハッシュだけで判定する
+        if collapse_duplicates:
+            import gallery_index
+            gallery_items = gallery_index.get_gallery_index().collapse_duplicates(recent_results)
+        else:
+            gallery_items = [(record, 1) for record in recent_results]
 
         if recent_results:
-            # CSS Grid for Gallery (Reusable)
-            st.markdown("""
-            <style>
-            .community-gallery-container {
-                display: grid;
-                grid-template-columns: repeat(auto-fill, minmax(200px, 1fr));
-                gap: 1rem;
-                padding: 1rem 0;
-            }
-            </style>
-            """, unsafe_allow_html=True)
             
             # Streamlitのcolumnsを使ってグリッド風に表示 (4列)
             cols = st.columns(4)
-            for idx, record in enumerate(recent_results):
+            media_tiles.probe_many(record['image_url'] for record, _ in gallery_items if db.is_video_url(record['image_url']))
+            for idx, (record, duplicate_count) in enumerate(gallery_items):
                 with cols[idx % 4]:
                     try:
-                        # 拡張子で判定して動画または画像を表示
+                        # 拡張子で判定して動画または画像を表示 (動画はクリックしたときだけプレーヤーを読み込む)
                         url = record['image_url']
-                        if url and (url.endswith(".mp4") or url.endswith(".mov") or url.endswith(".webm")):
-                            st.video(url)
+                        if db.is_video_url(url):
+                            media_tiles.render_video_tile(url, key=f"gallery_{record.get('_row', idx)}")
                             st.markdown(f"[🔗 動画を開く(保存)]({url})")
                         else:
                             st.image(url, use_container_width=True)
                             
                         st.caption(f"{record['engine']} | {record['timestamp']}")
+                        if duplicate_count > 1:
+                            st.caption(f"🗂️ 似ている画像 {duplicate_count}件")
                         with st.expander("プロンプト"):
                             st.text(record['prompt'])
                     except:
                         pass
+
+            render_gallery_pager("community_gallery", gallery_next_cursor, gallery_page_no)
         else:
             st.info("まだ生成結果がありません。")
 
@@ -618,10 +524,18 @@ with tab2:
     
     # 1. Generation Type
     gen_type = st.radio("生成タイプ (Generation Type)", ["Text to Video", "Image to Video"], horizontal=True)
+    # バッチ生成: プロンプト × シード × 比率 × モデル の組み合わせをまとめて生成する
+    batch_mode = st.toggle("バッチ生成 (複数の組み合わせ)", key="veo_batch_mode",
+                           help=f"同じシーンをシード・比率・モデルを変えて一度に生成します (最大{veo_jobs.MAX_BATCH_JOBS}件)")
     
     # 2. Model Selection
     model_friendly_names = {"Veo 3.1 Fast": "veo3_fast", "Veo 3.1 Quality": "veo3"}
-    selected_model_name = st.radio("モデル (Model)", list(model_friendly_names.keys()), horizontal=True)
+    if batch_mode:
+        selected_model_names = st.multiselect("モデル (Model)", list(model_friendly_names.keys()), default=["Veo 3.1 Fast"])
+        selected_model_name = selected_model_names[0] if selected_model_names else "Veo 3.1 Fast"
+    else:
+        selected_model_name = st.radio("モデル (Model)", list(model_friendly_names.keys()), horizontal=True)
+        selected_model_names = [selected_model_name]
     selected_model_id = model_friendly_names[selected_model_name]
 
     # Initialize Session State for Video Results
@@ -640,23 +554,47 @@ with tab2:
             
     # 4. Prompt
     st.markdown("### 生成プロンプト (Prompt)")
-    v_prompt = st.text_area("動画の内容を記述してください", value="", height=100, placeholder="A cinematic shot of...", key="veo_prompt")
+    v_prompt = st.text_area(
+        "動画の内容を記述してください" + (" (1行に1つ)" if batch_mode else ""),
+        value="", height=100, placeholder="A cinematic shot of...", key="veo_prompt"
+    )
     
     # 5. Aspect Ratio
     col_ar, col_seed = st.columns(2)
-    with col_ar:
-        ar_options = ["16:9", "9:16", "1:1", "4:3", "3:4"]
-        aspect_ratio = st.selectbox("比率 (Aspect Ratio)", ar_options, index=0)
-        
-    with col_seed:
-        seed = st.number_input("シード (Seed, 任意)", min_value=0, value=0, help="0はランダム")
-        if seed == 0:
-            seed = None
+    ar_options = ["16:9", "9:16", "1:1", "4:3", "3:4"]
+    if batch_mode:
+        with col_ar:
+            aspect_ratios = st.multiselect("比率 (Aspect Ratio)", ar_options, default=["16:9"])
+        with col_seed:
+            seed_text = st.text_input("シード (カンマ区切り)", value="0", help="0はランダム。例: 1, 2, 3")
+        try:
+            seeds = [int(s) or None for s in seed_text.split(",") if s.strip()] or [None]
+        except ValueError:
+            st.error("シードは数字をカンマ区切りで入力してください。")
+            seeds = []
+        batch_prompts = [line.strip() for line in v_prompt.splitlines() if line.strip()]
+        batch_models = [(model_friendly_names[name], name) for name in selected_model_names]
+        batch_count = len(batch_prompts) * len(seeds) * len(aspect_ratios) * len(batch_models)
+        st.caption(f"組み合わせ: {len(batch_prompts)} プロンプト × {len(seeds)} シード × {len(aspect_ratios)} 比率 × {len(batch_models)} モデル = **{batch_count} 件**")
+        aspect_ratio = aspect_ratios[0] if aspect_ratios else ar_options[0]
+        seed = None
+    else:
+        with col_ar:
+            aspect_ratio = st.selectbox("比率 (Aspect Ratio)", ar_options, index=0)
+            
+        with col_seed:
+            seed = st.number_input("シード (Seed, 任意)", min_value=0, value=0, help="0はランダム")
+            if seed == 0:
+                seed = None
 
     # --- Run Button ---
     run_veo_btn = st.button("動画を生成する (Generate Video)", type="primary", use_container_width=True)
 
     # --- Processing ---
+    # タスクを送信したらすぐに戻り、状態の確認はバックグラウンドのジョブマネージャーに任せる
+    veo_manager = veo_jobs.get_job_manager()
+    veo_session_id = st.session_state.setdefault("veo_session_id", uuid.uuid4().hex)
+
     if run_veo_btn:
         if not API_KEY:
             st.error("API Keyが必要です。")
@@ -670,167 +608,127 @@ with tab2:
             st.error("画像をアップロードしてください。")
             st.stop()
 
-        # Output Area
-        result_container = st.container()
-        
-        with result_container:
-            status_text = st.empty()
-            prog_bar = st.progress(0)
-            
-            try:
-                # 1. Upload Image (if needed)
-                image_urls = []
-                if gen_type == "Image to Video" and v_uploaded_file:
-                    with st.spinner("画像をアップロード中..."):
-                        headers = {
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {API_KEY}"
-                        }
-                        
-                        image = Image.open(v_uploaded_file)
-                        if image_to_base64: 
-                            b64_img = image_to_base64(image)
-                            input_url = upload_image_to_kieai(headers, b64_img) 
-                            
-                            if input_url:
-                                image_urls.append(input_url)
-                            else:
+        if batch_mode and not batch_count:
+            st.error("モデル・比率・シードをそれぞれ1つ以上指定してください。")
+            st.stop()
+
+        try:
+            # 1. Upload Image (if needed)
+            # 開始フレームは比率ごとに切り抜き・縮小し (最大 1080p)、同じ比率の組み合わせでは1回のアップロードを共有する
+            image_urls_by_aspect = {}
+            if gen_type == "Image to Video" and v_uploaded_file:
+                with st.spinner("画像をアップロード中..."):
+                    headers = {
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {API_KEY}"
+                    }
+                    
+                    from PIL import Image
+                    image = Image.open(v_uploaded_file)
+                    image.load()
+                    veo_profile = preprocess.get_profile("Veo 3.1")
+                    variant_urls = {}
+                    for ar in (aspect_ratios if batch_mode else [aspect_ratio]):
+                        veo_target = veo_profile.target(ar)
+                        key = preprocess.variant_geometry(image.size, veo_target.aspect_ratio, veo_target.input_edge)
+                        if key not in variant_urls:
+                            variant_urls[key] = upload_image_to_kieai(headers, image_to_base64(preprocess.render_variant(image, *key)))
+                            if not variant_urls[key]:
                                 st.error("画像のアップロードに失敗しました。")
                                 st.stop()
+                        image_urls_by_aspect[ar] = [variant_urls[key]]
 
-                # 2. Prepare Payload
-                wh_uuid = get_webhook_token()
-                callback_url = f"https://webhook.site/{wh_uuid}"
-                
-                # API Endpoint
-                generate_url = "https://api.kie.ai/api/v1/veo/generate"
-                
-                payload = {
-                    "prompt": v_prompt,
-                    "model": selected_model_id,
-                    "aspectRatio": aspect_ratio,
-                    "callBackUrl": callback_url
-                }
-                
-                if image_urls:
-                    payload["imageUrls"] = image_urls
-                
-                if seed:
-                    payload["seed"] = seed
-
-                # 3. Submit Task
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {API_KEY}"
-                }
-                
-                status_text.info("タスクを送信中...")
-                res = requests.post(generate_url, headers=headers, json=payload)
-                
-                if res.status_code != 200:
-                    st.error(f"API Error ({res.status_code}): {res.text}")
-                    st.stop()
-                    
-                resp_data = res.json()
-                if resp_data.get("code") != 200:
-                    st.error(f"Request Failed: {resp_data.get('msg')}")
-                    st.stop()
-                    
-                task_id = resp_data["data"]["taskId"]
-                st.toast(f"タスク開始: {task_id}")
-                
-                # 4. Polling
-                start_ts = time.time()
-                poll_url = f"https://api.kie.ai/api/v1/veo/record-info?taskId={task_id}"
-                
-                status_text.markdown(f"**生成中...** (Task ID: `{task_id}`)")
-                
-                while True:
-                    elapsed = time.time() - start_ts
-                    if elapsed > 600: # 10 minutes timeout
-                        st.error("タイムアウトしました。")
-                        break
-                        
-                    # Progress simulation (approx 2 mins for fast, 5 for quality)
-                    estimated_duration = 120 if "fast" in selected_model_id else 300
-                    prog_bar.progress(min(elapsed / estimated_duration, 0.95))
-                    
-                    try:
-                        poll_res = requests.get(poll_url, headers=headers)
-                        if poll_res.status_code == 200:
-                            poll_data = poll_res.json()
-                            if poll_data.get("code") == 200:
-                                data = poll_data["data"]
-                                success_flag = data.get("successFlag")
-                                
-                                # 0: Generating, 1: Success, 2/3: Failed
-                                if success_flag == 1:
-                                    prog_bar.progress(1.0)
-                                    status_text.success("生成完了！")
-                                    
-                                    # Parse result URLs
-                                    video_urls = []
-                                    if "response" in data and "resultUrls" in data["response"]:
-                                        video_urls = data["response"]["resultUrls"]
-                                    elif "resultUrls" in data:
-                                        # Fallback or older API style
-                                        if isinstance(data["resultUrls"], str):
-                                            video_urls = json.loads(data["resultUrls"])
-                                        else:
-                                            video_urls = data["resultUrls"]
-                                    
-                                    if video_urls:
-                                        for i, v_url in enumerate(video_urls):
-                                            st.video(v_url)
-                                            
-                                            # Fetch and Store for Persistence
-                                            try:
-                                                v_response = requests.get(v_url)
-                                                if v_response.status_code == 200:
-                                                    # Store in session state
-                                                    st.session_state.video_results.append({
-                                                        "url": v_url,
-                                                        "content": v_response.content,
-                                                        "prompt": v_prompt,
-                                                        "model": selected_model_name,
-                                                        "timestamp": int(time.time())
-                                                    })
-                                                    
-                                                    # Show immediate download button
-                                                    st.download_button(
-                                                        label="📥 動画をダウンロード",
-                                                        data=v_response.content,
-                                                        file_name=f"veo_video_{int(time.time())}_{i+1}.mp4",
-                                                        mime="video/mp4",
-                                                        key=f"dl_btn_immediate_{task_id}_{i}"
-                                                    )
-                                            except Exception as e:
-                                                print(f"Download preparation failed: {e}")
-
-                                            st.success(f"Video URL: {v_url}")
-                                            
-                                            # Save to DB
-                                            db.save_result(v_url, v_prompt, f"Veo 3.1 ({selected_model_name})")
-                                            st.toast("コミュニティギャラリーに保存しました！")
-                                    break
-                                
-                                elif success_flag in [2, 3]:
-                                    st.error(f"生成失敗: {poll_data.get('msg', 'Unknown error')}")
-                                    break
-                    except Exception as e:
-                        # print(f"Polling error: {e}")
-                        pass
-                    
-                    time.sleep(5) # Poll every 5 seconds
-                    
-            except Exception as e:
-                st.error(f"システムエラー: {e}")
+            # 2. Prepare Payload
+            wh_uuid = get_webhook_token()
+            callback_url = f"https://webhook.site/{wh_uuid}"
+            
+            payload = {
+                "prompt": v_prompt,
+                "model": selected_model_id,
+                "aspectRatio": aspect_ratio,
+                "callBackUrl": callback_url
+            }
+            
+            if image_urls_by_aspect:
+                payload["imageUrls"] = image_urls_by_aspect[aspect_ratio]
+            
+            if seed:
+                payload["seed"] = seed
+
+            # 3. Submit Task
+            if batch_mode:
+                # 開始フレーム画像は比率ごとに1回だけアップロードし、同じ比率の組み合わせで同じURLを使う
+                batch_id, batch_jobs = veo_manager.submit_batch(
+                    veo_session_id, API_KEY,
+                    veo_jobs.batch_payloads(payload, batch_prompts, seeds, aspect_ratios, batch_models,
+                                            image_urls_by_aspect=image_urls_by_aspect),
+                )
+                st.toast(f"バッチ開始: {len(batch_jobs)} 件")
+            else:
+                veo_manager.submit(veo_session_id, API_KEY, payload, selected_model_name)
+                st.toast("タスクを受け付けました")
+        except veo_jobs.VeoSubmitError as e:
+            st.error(str(e))
+        except Exception as e:
+            st.error(f"システムエラー: {e}")
+
+    # --- Job List (live) ---
+    # 生成中のジョブがある間だけ、この部分だけを定期的に再実行する
+    @st.fragment(run_every=veo_jobs.POLL_INTERVAL if veo_manager.has_active_jobs(veo_session_id) else None)
+    def render_veo_jobs():
+        jobs = veo_manager.jobs_for(veo_session_id)
+        if not jobs:
+            return
+        st.markdown("### 生成ジョブ")
+        # バッチごとの進み具合
+        batches = {}
+        for job in jobs:
+            if job.batch_id:
+                batches.setdefault(job.batch_id, []).append(job)
+        for batch_jobs in batches.values():
+            done = sum(not job.active for job in batch_jobs)
+            wall_time = max(job.elapsed for job in batch_jobs)
+            st.progress(done / len(batch_jobs), text=f"バッチ: {done} / {len(batch_jobs)} 件完了 ({int(wall_time)}秒)")
+        for job in jobs:
+            with st.container(border=True):
+                st.markdown(f"**{job.prompt[:60]}**" + (f" (`{job.task_id}`)" if job.task_id else ""))
+                st.caption(f"{job.model_name} | {job.aspect_ratio} | seed {job.seed or 'random'} | {int(job.elapsed)}秒")
+                if job.status == veo_jobs.STATUS_QUEUED:
+                    st.progress(0.0, text="送信待ち (同時実行数の上限)")
+                elif job.active:
+                    st.progress(job.progress, text="生成中...")
+                elif job.status == veo_jobs.STATUS_SUCCEEDED:
+                    st.success("生成完了！")
+                else:
+                    st.error(job.error or "生成失敗")
+                    st.button("閉じる", key=f"veo_dismiss_{job.job_id}", on_click=veo_manager.dismiss, args=(job.job_id,))
+
+        # 完了した動画をセッションのギャラリーへ移す
+        finished = veo_manager.take_results(veo_session_id)
+        for job, v_url, video_path in finished:
+            st.session_state.video_results.append({
+                "url": v_url,
+                "path": video_path,
+                "prompt": job.prompt,
+                "model": job.model_name,
+                "timestamp": int(job.finished_at or time.time())
+            })
+        if finished:
+            st.toast("コミュニティギャラリーに保存しました！")
+        if finished or (not veo_manager.has_active_jobs(veo_session_id) and st.session_state.get("veo_jobs_active")):
+            # ギャラリーの更新と定期実行の停止のため、全体を再実行する
+            st.session_state.veo_jobs_active = False
+            st.rerun()
+        st.session_state.veo_jobs_active = veo_manager.has_active_jobs(veo_session_id)
+
+    render_veo_jobs()
 
     # --- Session Gallery ---
     st.markdown("---")
     st.subheader("🎥 生成ビデオギャラリー (Session)")
 
     if st.session_state.video_results:
+        media_store = media_budget.get_budget()
         # Display in grid
         v_cols = st.columns(2)
         # Reverse to show newest first
@@ -840,14 +738,18 @@ with tab2:
                 
                 col_dl, col_pmt = st.columns([1, 2])
                 with col_dl:
-                    if v_item.get("content"):
+                    # 動画はメディア予算の管理下 (ディスク → URL から取り直し)。読み込みはボタンを押したときだけ
+                    if v_item.get("path") and media_store.has(v_item["path"]):
+                        media_store.touch(v_item["path"])
                         st.download_button(
                             label="📥 ダウンロード",
-                            data=v_item["content"],
+                            data=functools.partial(media_store.read, v_item["path"]),
                             file_name=f"veo_{v_item['timestamp']}_{i}.mp4",
                             mime="video/mp4",
                             key=f"gallery_dl_{i}"
                         )
+                    elif v_item.get("path"):
+                        st.caption("⏳ ダウンロード準備中...")
                 with col_pmt:
                     with st.expander("プロンプト"):
                         st.caption(f"Model: {v_item.get('model', 'Unknown')}")
@@ -857,22 +759,50 @@ with tab2:
 
     # --- History from DB ---
     st.markdown("---")
-    st.subheader("🕑 過去の生成履歴 (Recent 10)")
+    st.subheader("🕑 過去の生成履歴")
     
-    # DBから最新の動画を取得
-    recent_videos = [r for r in db.get_recent_results(limit=20) if r['image_url'].endswith((".mp4", ".mov", ".webm"))]
+    # DBから動画だけを1ページ分取得
+    recent_videos, history_next_cursor, history_page_no = get_gallery_page("video_history", page_size=10, media="video")
     
     if recent_videos:
         h_cols = st.columns(2)
-        for i, h_item in enumerate(recent_videos[:10]):
+        media_tiles.probe_many(h_item['image_url'] for h_item in recent_videos)
+        for i, h_item in enumerate(recent_videos):
             with h_cols[i % 2]:
-                st.video(h_item['image_url'])
+                media_tiles.render_video_tile(h_item['image_url'], key=f"history_{h_item.get('_row', i)}")
                 st.markdown(f"[🔗 動画を開く(保存)]({h_item['image_url']})")
                 st.caption(f"{h_item['timestamp']}")
+
+        render_gallery_pager("video_history", history_next_cursor, history_page_no)
     else:
         st.write("履歴がありません。")
 
 
+# --- 管理者向け: システム状態 ---
+with st.sidebar.expander("📊 システム状態 (管理者向け)"):
+    # 閉じていても中身は毎回実行されるため、メトリクスの集計はトグルを入れたときだけ行う
+    if st.toggle("メトリクスを表示", key="admin_show_metrics"):
+        import categorization_cache
+        st.caption(f"DB backend: {db.get_backend().name}")
+        if db.get_backend().name == "sheets":
+            st.caption("Google Sheets API スケジューラ")
+            st.json(db.get_scheduler_metrics())
+        st.caption("分類キャッシュ (内容ハッシュ)")
+        st.json(categorization_cache.get_cache().stats())
+        st.caption("画像生成ジョブ (全セッション)")
+        st.json(image_jobs.get_job_manager().metrics())
+        st.caption("画像生成エンジン (全セッション)")
+        st.json(engines.get_registry().metrics())
+        st.caption("Veo ジョブ (全セッション)")
+        st.json(veo_jobs.get_job_manager().metrics())
+        st.caption("メディア予算 (全セッション)")
+        media_usage = media_budget.get_budget().usage()
+        st.progress(min(media_usage["disk_mb"] / max(media_usage["disk_budget_mb"], 1), 1.0),
+                    text=f"ディスク {media_usage['disk_mb']} / {media_usage['disk_budget_mb']} MB")
+        st.json(media_usage)
+        st.caption("動画ダウンロード")
+        st.json(video_downloader.get_downloader().statuses())
+
 # --- フッター (Credits) ---
 st.markdown("""
 <div style="
@@ -0,0 +1,97 @@
+"""ストレージバックエンドの読み書きレイテンシ比較ベンチマーク
+
+使い方:
+    python bench_db_backends.py                       # SQLiteのみ (10k / 100k 行)
+    python bench_db_backends.py --sheets --sheet-key KEY   # ベンチ専用シートでSheetsも計測
+
+Sheetsは本番シートを汚さないよう、必ずベンチ専用のスプレッドシートを指定してください。
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import db
+from db_sqlite import SQLiteBackend
+from sheets_scheduler import get_scheduler
+
+CATEGORIES = ["リビング", "ダイニング", "キッチン", "寝室", "バスルーム", "玄関", "外観", "庭", "その他"]
+ENGINES = ["Nano Banana Pro", "Flux 2 Flex", "Seedream 4.5 Edit", "GPT Image 1.5"]
+
+
+def make_rows(n):
+    """ダミーの gallery_data / categorized_images 行を生成"""
+    base = datetime.datetime(2024, 1, 1)
+    gallery, categorized = [], []
+    for i in range(n):
+        ts = (base + datetime.timedelta(seconds=i * 37)).strftime("%Y-%m-%d %H:%M:%S")
+        gallery.append([ts, f"https://example.com/{i}.png", f"prompt {i}", random.choice(ENGINES), "bench"])
+        categorized.append([ts, f"file_{i}", f"https://example.com/c{i}.jpg", random.choice(CATEGORIES), "説明", "folder"])
+    return gallery, categorized
+
+
+def seed(backend, n):
+    gallery, categorized = make_rows(n)
+    if isinstance(backend, SQLiteBackend):
+        backend.import_rows("gallery_data", gallery)
+        backend.import_rows("categorized_images", categorized)
+        return
+    for table, rows in (("gallery_data", gallery), ("categorized_images", categorized)):
+        worksheet = backend.worksheet(table)
+        for start in range(0, len(rows), 5000):
+            get_scheduler().write(worksheet.append_rows, rows[start:start + 5000])
+    backend.invalidate_category_index()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+def run(backend, n, repeat):
+    seed(backend, n)
+    results = {
+        "save_result": timed(lambda: backend.save_result("https://example.com/x.png", "bench", "bench"), repeat),
+        "save_categorized_image": timed(
+            lambda: backend.save_categorized_image(f"bench_{time.time_ns()}", "u", "キッチン", "d", "f"), repeat
+        ),
+        "get_recent_results(50)": timed(lambda: backend.get_recent_results(limit=50), repeat),
+        "get_categorized_images(cat,100)": timed(lambda: backend.get_categorized_images("キッチン", limit=100), repeat),
+        "get_category_counts": timed(backend.get_category_counts, repeat),
+    }
+    print(f"\n[{backend.name}] rows={n}")
+    for op, (p50, p95) in results.items():
+        print(f"  {op:<34} p50={p50:9.2f} ms  p95={p95:9.2f} ms")
+    if backend.name == "sheets":
+        print(f"  scheduler: {db.get_scheduler_metrics()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DBバックエンドのベンチマーク")
+    parser.add_argument("--rows", default="10000,100000", help="計測する行数 (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--sheets", action="store_true", help="Google Sheetsも計測する")
+    parser.add_argument("--sheet-key", default=None, help="ベンチ専用スプレッドシートのキー")
+    args = parser.parse_args()
+
+    if args.sheets and not args.sheet_key:
+        parser.error("--sheets には --sheet-key (ベンチ専用シート) が必要です")
+
+    for n in [int(x) for x in args.rows.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(SQLiteBackend(os.path.join(tmp, "bench.db")), n, args.repeat)
+        if args.sheets:
+            # Sheetsは行が累積するため、行数ごとに空のシートを用意して実行すること
+            run(db.SheetsBackend(sheet_key=args.sheet_key), n, min(args.repeat, 5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""app.py の起動時間と再実行ごとのスクリプト時間を計測するベンチマーク
+
+使い方:
+    python bench_startup.py                  # 初回描画 (新しいプロセス) 5回 + 再実行 30回
+    python bench_startup.py --cold 10 --reruns 100
+
+- 初回描画: 新しい Python プロセスで streamlit を読み込んでから、app.py の1回目の実行が終わるまで
+- 再実行: 同じセッションで app.py をもう一度実行したときのスクリプト時間
+streamlit.testing の AppTest で実行するため、ブラウザやサーバーは不要です。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# 起動時に読み込まれていないことを確認したい重いモジュール
+HEAVY_MODULES = [
+    "google.generativeai", "google.api_core", "gspread", "oauth2client",
+    "googleapiclient", "numpy", "categorization_cache", "gallery_index",
+    "requests", "PIL.Image",
+]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+def child(timeout):
+    """新しいプロセスの中で1回だけ描画し、結果を JSON で出力する"""
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    t1 = time.perf_counter()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    t2 = time.perf_counter()
+    print(json.dumps({
+        "import_streamlit_ms": (t1 - t0) * 1000,
+        "first_render_ms": (t2 - t1) * 1000,
+        "exceptions": [str(e.value) for e in at.exception],
+        "loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def measure_cold(runs, timeout):
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--timeout", str(timeout)],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(APP_PATH),
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def measure_reruns(reruns, timeout):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    samples = []
+    for _ in range(reruns):
+        t0 = time.perf_counter()
+        at.run()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py の起動・再実行時間のベンチマーク")
+    parser.add_argument("--cold", type=int, default=5, help="初回描画を計測するプロセス数")
+    parser.add_argument("--reruns", type=int, default=30, help="再実行の回数")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.timeout)
+        return
+
+    if args.cold:
+        cold = measure_cold(args.cold, args.timeout)
+        p50, p95 = percentiles([r["first_render_ms"] for r in cold])
+        imp50, _ = percentiles([r["import_streamlit_ms"] for r in cold])
+        print(f"[初回描画] runs={args.cold}")
+        print(f"  import streamlit      p50={imp50:9.2f} ms")
+        print(f"  time-to-first-render  p50={p50:9.2f} ms  p95={p95:9.2f} ms")
+        print(f"  読み込まれた重いモジュール: {', '.join(cold[-1]['loaded']) or 'なし'}")
+        if cold[-1]["exceptions"]:
+            print(f"  例外: {cold[-1]['exceptions']}")
+
+    if args.reruns:
+        p50, p95 = percentiles(measure_reruns(args.reruns, args.timeout))
+        print(f"\n[再実行] reruns={args.reruns}")
+        print(f"  script time           p50={p50:9.2f} ms  p95={p95:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
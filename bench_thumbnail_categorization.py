@@ -0,0 +1,66 @@
+"""サムネイルによる分類の精度と転送量のベンチマーク
+
+使い方:
+    python bench_thumbnail_categorization.py FOLDER_ID [--sizes 256,512,1024] [--limit 50]
+
+原寸画像での分類結果を正解とみなし、各サイズのサムネイルで分類したときの
+カテゴリ一致率と Drive からの転送バイト数を比較します。
+Gemini APIキーは secrets の GEMINI_API_KEY または環境変数 GEMINI_API_KEY を使用します。
+"""
+import argparse
+import time
+
+import drive_utils
+import gemini_utils
+
+
+def category_of(result):
+    return result.category if result.ok else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サムネイル分類のベンチマーク")
+    parser.add_argument("folder_id")
+    parser.add_argument("--sizes", default="256,512,1024", help="長辺のピクセル数 (カンマ区切り)")
+    parser.add_argument("--limit", type=int, default=50, help="使用する画像の枚数")
+    args = parser.parse_args()
+
+    api_key = gemini_utils.get_api_key()
+    if not api_key:
+        parser.error("GEMINI_API_KEY が設定されていません")
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    files = drive_utils.list_images_in_folder(args.folder_id, limit=args.limit)
+    print(f"{len(files)} images")
+
+    # 正解: 原寸画像での分類
+    reference = {}
+    original_bytes = 0
+    t0 = time.perf_counter()
+    for file_id, data in drive_utils.download_images(files):
+        if data is None:
+            continue
+        original_bytes += len(data)
+        mime_type = next((f.get("mimeType") for f in files if f["id"] == file_id), "image/jpeg")
+        reference[file_id] = category_of(gemini_utils.categorize_image(data, api_key, mime_type=mime_type))
+    print(f"\n{'mode':<12} {'accuracy':>9} {'bytes':>14} {'bytes/img':>11} {'sec':>7}")
+    print(f"{'original':<12} {1.0:>9.2%} {original_bytes:>14,} {original_bytes // max(1, len(reference)):>11,} {time.perf_counter() - t0:>7.1f}")
+
+    for size in sizes:
+        matched = total = transferred = 0
+        t0 = time.perf_counter()
+        for file in files:
+            if reference.get(file["id"]) is None:
+                continue
+            data, n = drive_utils.get_image_thumbnail(file, size=size)
+            if data is None:
+                continue
+            transferred += n
+            total += 1
+            matched += category_of(gemini_utils.categorize_image(data, api_key)) == reference[file["id"]]
+        accuracy = matched / total if total else 0.0
+        print(f"{'s' + str(size):<12} {accuracy:>9.2%} {transferred:>14,} {transferred // max(1, total):>11,} {time.perf_counter() - t0:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import image_hash
+
+DEFAULT_CACHE_PATH = "data/categorization_cache.db"
+DEFAULT_MAX_ENTRIES = 50000
+# dHash のハミング距離がこれ以下なら同じ写真 (リサイズ・再圧縮されたコピー) とみなす
+DEFAULT_MAX_DISTANCE = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS categorization_cache (
+    content_hash TEXT PRIMARY KEY,
+    phash INTEGER,
+    category TEXT NOT NULL,
+    description TEXT,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_last_used ON categorization_cache (last_used);
+"""
+
+
+def content_hash(image_bytes):
+    """画像バイト列のハッシュ (Drive の md5Checksum と同じ値になるよう MD5 を使う)"""
+    return hashlib.md5(image_bytes).hexdigest()
+
+
+def _to_signed(value):
+    # SQLiteのINTEGERは符号付き64bitのため変換して保存する
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class CategorizationCache:
+    """画像の内容ハッシュをキーにした分類結果のキャッシュ (LRUで件数を制限)
+
+    - 完全一致: 画像バイト列の MD5 (Drive の md5Checksum を渡せばダウンロード前に照会できる)
+    - 近似一致: dHash のハミング距離が max_distance 以下 (use_perceptual=True の場合)
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 use_perceptual=True, max_distance=DEFAULT_MAX_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.use_perceptual = use_perceptual
+        self.max_distance = max_distance
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "perceptual_hits": 0, "misses": 0, "evictions": 0}
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # 近似検索用に dHash を uint64 配列のインデックスとしてメモリに載せておく
+            self._phashes = image_hash.HashIndex()
+            for key, value in conn.execute("SELECT content_hash, phash FROM categorization_cache WHERE phash IS NOT NULL"):
+                self._phashes.add(key, _to_unsigned(value))
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _perceptual_hash(self, image_bytes):
+        if not self.use_perceptual or image_bytes is None:
+            return None
+        try:
+            return image_hash.dhash(image_bytes)
+        except Exception:
+            return None
+
+    def _find_similar(self, phash):
+        found = self._phashes.nearest(phash, self.max_distance)
+        return found[0] if found else None
+
+    def _get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT category, description FROM categorization_cache WHERE content_hash = ?", (key,)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE categorization_cache SET last_used = ? WHERE content_hash = ?", (time.time(), key))
+        return {"category": row[0], "description": row[1]} if row else None
+
+    def lookup(self, image_bytes=None, key=None):
+        """キャッシュ済みの分類結果を返す (なければ None)
+
+        key: 内容ハッシュ (省略時は image_bytes から計算)。Drive の md5Checksum を渡してもよい。
+        """
+        key = key or (content_hash(image_bytes) if image_bytes is not None else None)
+        result = self._get(key) if key else None
+        if result:
+            with self._lock:
+                self._stats["exact_hits"] += 1
+            return result
+
+        phash = self._perceptual_hash(image_bytes)
+        if phash is not None:
+            similar_key = self._find_similar(phash)
+            result = self._get(similar_key) if similar_key else None
+            if result:
+                with self._lock:
+                    self._stats["perceptual_hits"] += 1
+                return result
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def store(self, result, image_bytes=None, key=None):
+        """分類結果を保存する (result は CategorizationResult または {"category", "description"})
+
+        key と image_bytes のどちらかが必要 (両方ないときは ValueError)。
+        """
+        if key is None and image_bytes is None:
+            raise ValueError("store() には key か image_bytes のどちらかが必要です")
+        if not isinstance(result, dict):
+            if not getattr(result, "ok", False):
+                return
+            result = {"category": result.category, "description": result.description}
+        if not result.get("category"):
+            return
+        key = key or content_hash(image_bytes)
+        phash = self._perceptual_hash(image_bytes)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO categorization_cache (content_hash, phash, category, description, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, _to_signed(phash) if phash is not None else None, result["category"], result.get("description", ""), time.time()),
+            )
+        if phash is not None:
+            self._phashes.add(key, phash)
+        self._evict()
+
+    def _evict(self):
+        """max_entries を超えた分を、最後に使われたのが古い順に削除する"""
+        with self._connect() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM categorization_cache").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow <= 0:
+                return
+            keys = [row[0] for row in conn.execute(
+                "SELECT content_hash FROM categorization_cache ORDER BY last_used LIMIT ?", (overflow,)
+            )]
+            conn.executemany("DELETE FROM categorization_cache WHERE content_hash = ?", [(k,) for k in keys])
+        for k in keys:
+            self._phashes.remove(k)
+        with self._lock:
+            self._stats["evictions"] += len(keys)
+
+    def stats(self):
+        """ヒット率などの統計"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["exact_hits"] + stats["perceptual_hits"] + stats["misses"]
+        stats["lookups"] = lookups
+        stats["hit_rate"] = (stats["exact_hits"] + stats["perceptual_hits"]) / lookups if lookups else 0.0
+        stats["entries"] = self._connect().execute("SELECT COUNT(*) FROM categorization_cache").fetchone()[0]
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """プロセス共通のキャッシュを取得"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CategorizationCache()
+        return _cache
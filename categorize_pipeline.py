@@ -0,0 +1,418 @@
+"""Drive → Gemini → DB の画像分類パイプライン (ヘッドレス実行)
+
+使い方:
+    python categorize_pipeline.py FOLDER_ID [--recursive] [--changes-only]
+        [--download-workers 8] [--categorize-workers 2] [--persist-workers 2]
+        [--batch-size 8] [--queue-size 64] [--thumbnail-size 512] [--async-concurrency 16]
+
+一覧取得 → ダウンロード → 分類 → 保存 の各ステージを上限付きキューでつなぎ、
+ステージごとに並列数を設定できます。全体の速度は最も遅いステージで決まり、
+それより速いステージはキューが埋まると待機します (バックプレッシャー)。
+
+保存済みのファイル (file_id と md5Checksum) はチェックポイントファイルに追記されるため、
+中断しても同じコマンドで続きから再開できます。--changes-only を付けると Drive の
+Changes API で前回以降に追加・更新された画像だけを処理します (--recursive でサブフォルダも対象)。
+一覧取得に失敗したときは Changes API のトークンを進めません。
+
+--async-concurrency を指定すると、分類ステージはバッチではなく asyncio の
+クライアント (gemini_utils.AsyncCategorizer) で1枚ずつ並行にリクエストします。
+"""
+import argparse
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+import categorization_cache
+import db
+import drive_sync
+import drive_utils
+import gemini_utils
+
+CHECKPOINT_DIR = "data/pipeline_checkpoints"
+REPORT_INTERVAL = 10
+
+_DONE = object()  # ステージ終了の合図
+
+
+class StageStats:
+    """ステージごとの処理件数・稼働時間"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, count=1, failed=0):
+        with self._lock:
+            self.items += count
+            self.failed += failed
+            self.busy += seconds
+
+    def line(self, elapsed, q=None):
+        rate = self.items / elapsed if elapsed else 0.0
+        # 1ワーカーあたりの処理能力 (稼働時間あたり) から、ボトルネックのステージが分かる
+        capacity = self.items / self.busy * self.workers if self.busy else 0.0
+        depth = f" queue={q.qsize():>4}" if q is not None else ""
+        return (f"  {self.name:<11} done={self.items:>6} failed={self.failed:>4} "
+                f"{rate:7.2f}/s (capacity {capacity:7.2f}/s, workers={self.workers}){depth}")
+
+
+def _file_version(file):
+    """ファイルの内容の版 (更新されると変わる)"""
+    return file.get("md5Checksum") or file.get("modifiedTime")
+
+
+class Checkpoint:
+    """保存済みの (file_id, 版) を1行ずつ追記するチェックポイント
+
+    版 (md5Checksum、なければ modifiedTime) も記録するので、更新されたファイルは再び処理される。
+    """
+
+    def __init__(self, folder_id):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self.path = os.path.join(CHECKPOINT_DIR, f"{folder_id}.jsonl")
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.done.add((entry["file_id"], entry.get("version")))
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def is_done(self, file):
+        return (file["id"], _file_version(file)) in self.done
+
+    def mark(self, file):
+        entry = {"file_id": file["id"], "version": _file_version(file)}
+        with self._lock:
+            self.done.add((entry["file_id"], entry["version"]))
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CategorizePipeline:
+    def __init__(self, folder_id, api_key, recursive=False, changes_only=False,
+                 download_workers=8, categorize_workers=2, persist_workers=2,
+                 batch_size=gemini_utils.BATCH_SIZE, queue_size=64,
+                 thumbnail_size=drive_utils.CATEGORIZE_IMAGE_SIZE, async_concurrency=0):
+        self.folder_id = folder_id
+        self.api_key = api_key
+        self.recursive = recursive
+        self.changes_only = changes_only
+        self.batch_size = batch_size
+        self.thumbnail_size = thumbnail_size
+        self.async_concurrency = async_concurrency
+        self.cache = categorization_cache.get_cache()
+        self.checkpoint = Checkpoint(folder_id)
+
+        # ステージ間の上限付きキュー
+        self.download_q = queue.Queue(maxsize=queue_size)
+        self.categorize_q = queue.Queue(maxsize=queue_size)
+        self.persist_q = queue.Queue(maxsize=queue_size)
+
+        self.stats = {
+            "enumerate": StageStats("enumerate", 1),
+            "download": StageStats("download", download_workers),
+            "categorize": StageStats("categorize", async_concurrency or categorize_workers),
+            "persist": StageStats("persist", persist_workers),
+        }
+        self.cache_hits = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    # --- ステージ ---
+    # 1件の例外でステージのスレッドが止まると、上流が上限付きキューの put() で待ち続けて全体が止まる。
+    # そのため各ステージは1件 (1バッチ) ごとに例外を捕まえて失敗として数え、終了の合図は finally で必ず送る。
+    # それでもワーカーが異常終了したときは、残りを読み捨てて (失敗として数えて) 上流を止めない。
+    def _fail(self, stage, file, e, t0, count=1):
+        print(f"[{stage}] {file.get('id') if isinstance(file, dict) else file}: {type(e).__name__}: {e}")
+        self.stats[stage].record(time.perf_counter() - t0, count=0, failed=count)
+
+    def _finish_stage(self, q, stage, received_done):
+        if not received_done:
+            while True:
+                item = q.get()
+                if item is _DONE:
+                    break
+                self.stats[stage].record(0.0, count=0, failed=1)
+        q.put(_DONE)  # 他のワーカーにも終了を伝える
+
+    def _lookup_cache(self, data=None, key=None):
+        """キャッシュの確認 (失敗してもキャッシュなしとして処理を続ける)"""
+        try:
+            return self.cache.lookup(data, key=key)
+        except Exception as e:
+            print(f"Cache lookup error: {e}")
+            return None
+
+    def _enumerate(self):
+        try:
+            if self.changes_only:
+                tracker = drive_sync.FolderChangeTracker()
+                files, self.next_page_token = tracker.pending_files(self.folder_id, recursive=self.recursive)
+            else:
+                files = drive_utils.iter_images_in_folder(self.folder_id, recursive=self.recursive, raise_errors=True)
+            for file in files:
+                t0 = time.perf_counter()
+                if self.checkpoint.is_done(file):
+                    self.skipped += 1
+                    continue
+                # 同じ内容の写真が分類済みならダウンロードも分類もしない
+                cached = self._lookup_cache(key=file.get("md5Checksum")) if file.get("md5Checksum") else None
+                self.stats["enumerate"].record(time.perf_counter() - t0)
+                if cached:
+                    self._count_cache_hit()
+                    self.persist_q.put((file, gemini_utils.CategorizationResult(
+                        category=cached["category"], description=cached["description"], cached=True)))
+                else:
+                    self.download_q.put(file)
+        except Exception as e:
+            # 途中で切れた一覧を全件として扱わない (失敗として数え、トークンを進めない)
+            print(f"Error listing files: {e}")
+            self.stats["enumerate"].record(0.0, count=0, failed=1)
+        finally:
+            self.download_q.put(_DONE)
+
+    def _download(self):
+        received_done = False
+        try:
+            while True:
+                file = self.download_q.get()
+                if file is _DONE:
+                    received_done = True
+                    return
+                t0 = time.perf_counter()
+                try:
+                    data, _ = drive_utils.get_image_thumbnail(file, size=self.thumbnail_size)
+                except Exception as e:
+                    self._fail("download", file, e, t0)
+                    continue
+                # ほぼ同じ画像 (再アップロード・リサイズ) が分類済みなら Gemini に送らない
+                cached = self._lookup_cache(data) if data is not None else None
+                self.stats["download"].record(time.perf_counter() - t0, count=int(data is not None), failed=int(data is None))
+                if cached:
+                    self._count_cache_hit()
+                    self.persist_q.put((file, gemini_utils.CategorizationResult(
+                        category=cached["category"], description=cached["description"], cached=True)))
+                elif data is not None:
+                    self.categorize_q.put((file, data))
+        finally:
+            self._finish_stage(self.download_q, "download", received_done)
+
+    def _categorize(self):
+        finished = False
+        try:
+            while not finished:
+                # batch_size 件たまるか、キューが空になるまで集めてから1リクエストで分類
+                batch = []
+                item = self.categorize_q.get()
+                while True:
+                    if item is _DONE:
+                        finished = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self.categorize_q.get(timeout=0.5)
+                    except queue.Empty:
+                        break
+                if not batch:
+                    continue
+
+                t0 = time.perf_counter()
+                try:
+                    results = gemini_utils.categorize_images_batch(
+                        [(file["id"], data, "image/jpeg") for file, data in batch], self.api_key, batch_size=self.batch_size
+                    )
+                except Exception as e:
+                    self._fail("categorize", batch[0][0], e, t0, count=len(batch))
+                    continue
+                failed = 0
+                for file, data in batch:
+                    failed += not self._handle_result(file, data, results.get(file["id"]))
+                self.stats["categorize"].record(time.perf_counter() - t0, count=len(batch) - failed, failed=failed)
+        finally:
+            self._finish_stage(self.categorize_q, "categorize", finished)
+
+    def _count_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def _handle_result(self, file, data, result):
+        """成功した結果をキャッシュに保存して保存ステージへ渡す"""
+        if result is None or not result.ok:
+            return False
+        try:
+            self.cache.store(result, data, key=file.get("md5Checksum"))
+        except Exception as e:
+            # キャッシュに書けなくても分類結果は保存する
+            print(f"Cache store error ({file['id']}): {e}")
+        self.persist_q.put((file, result))
+        return True
+
+    def _categorize_async(self):
+        """1スレッドのイベントループで async_concurrency 件まで並行に分類する"""
+        received_done = False
+        try:
+            received_done = asyncio.run(self._categorize_async_loop())
+        except Exception as e:
+            print(f"[categorize] {type(e).__name__}: {e}")
+        finally:
+            self._finish_stage(self.categorize_q, "categorize", received_done)
+
+    async def _categorize_async_loop(self):
+        categorizer = gemini_utils.AsyncCategorizer(self.api_key, max_concurrency=self.async_concurrency)
+        loop = asyncio.get_running_loop()
+        running = set()
+
+        async def run(file, data):
+            t0 = time.perf_counter()
+            try:
+                result = await categorizer.categorize(data)
+                # 保存ステージのキューが詰まってもイベントループを止めない
+                ok = await loop.run_in_executor(None, self._handle_result, file, data, result)
+            except Exception as e:
+                self._fail("categorize", file, e, t0)
+                return
+            self.stats["categorize"].record(time.perf_counter() - t0, count=int(ok), failed=int(not ok))
+
+        while True:
+            item = await loop.run_in_executor(None, self.categorize_q.get)
+            if item is _DONE:
+                break
+            task = asyncio.ensure_future(run(*item))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            # 実行中が上限に達したら1件終わるまで受け取らない (バックプレッシャー)
+            if len(running) >= self.async_concurrency:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        if running:
+            await asyncio.wait(running)
+        return True
+
+    def _persist(self):
+        received_done = False
+        try:
+            while True:
+                item = self.persist_q.get()
+                if item is _DONE:
+                    received_done = True
+                    return
+                file, result = item
+                t0 = time.perf_counter()
+                try:
+                    ok = db.save_categorized_image(
+                        file["id"],
+                        file.get("webViewLink", ""),
+                        result.category,
+                        result.description,
+                        self.folder_id,
+                    )
+                    if ok:
+                        self.checkpoint.mark(file)
+                except Exception as e:
+                    self._fail("persist", file, e, t0)
+                    continue
+                self.stats["persist"].record(time.perf_counter() - t0, count=1 if ok else 0, failed=0 if ok else 1)
+        finally:
+            self._finish_stage(self.persist_q, "persist", received_done)
+
+    # --- 実行 ---
+    def _start(self, target, count, name):
+        threads = [threading.Thread(target=target, name=f"{name}-{i}", daemon=True) for i in range(count)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def report(self, elapsed):
+        print(f"[{elapsed:7.1f}s] skipped(checkpoint)={self.skipped} cache_hits={self.cache_hits}")
+        print(self.stats["enumerate"].line(elapsed))
+        print(self.stats["download"].line(elapsed, self.download_q))
+        print(self.stats["categorize"].line(elapsed, self.categorize_q))
+        print(self.stats["persist"].line(elapsed, self.persist_q))
+
+    def run(self):
+        self.next_page_token = None
+        start = time.perf_counter()
+        enumerate_threads = self._start(self._enumerate, 1, "enumerate")
+        download_threads = self._start(self._download, self.stats["download"].workers, "download")
+        if self.async_concurrency:
+            categorize_threads = self._start(self._categorize_async, 1, "categorize")
+        else:
+            categorize_threads = self._start(self._categorize, self.stats["categorize"].workers, "categorize")
+        persist_threads = self._start(self._persist, self.stats["persist"].workers, "persist")
+
+        # 前のステージが全員終わってから次のステージへ終了を伝える
+        for threads, next_q in (
+            (enumerate_threads, None),
+            (download_threads, self.categorize_q),
+            (categorize_threads, self.persist_q),
+            (persist_threads, None),
+        ):
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=REPORT_INTERVAL)
+                    if t.is_alive():
+                        self.report(time.perf_counter() - start)
+            if next_q is not None:
+                next_q.put(_DONE)
+
+        self.report(time.perf_counter() - start)
+        self.checkpoint.close()
+
+        failed = sum(s.failed for s in self.stats.values())
+        if self.changes_only and failed == 0:
+            # 全件処理できたときだけ Changes API のトークンを進める
+            drive_sync.FolderChangeTracker().commit(self.folder_id, self.next_page_token, recursive=self.recursive)
+        print(f"cache: {self.cache.stats()}")
+        return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive画像の一括分類パイプライン")
+    parser.add_argument("folder_id")
+    parser.add_argument("--recursive", action="store_true", help="サブフォルダも対象にする")
+    parser.add_argument("--changes-only", action="store_true", help="前回以降に追加・更新された画像だけを処理する")
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--categorize-workers", type=int, default=2)
+    parser.add_argument("--persist-workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=gemini_utils.BATCH_SIZE, help="1リクエストで分類する枚数")
+    parser.add_argument("--queue-size", type=int, default=64, help="ステージ間キューの上限")
+    parser.add_argument("--thumbnail-size", type=int, default=drive_utils.CATEGORIZE_IMAGE_SIZE)
+    parser.add_argument("--async-concurrency", type=int, default=0, help="非同期クライアントで同時に分類する枚数 (0: バッチ分類)")
+    args = parser.parse_args()
+
+    api_key = gemini_utils.get_api_key()
+    if not api_key:
+        parser.error("GEMINI_API_KEY が設定されていません")
+
+    pipeline = CategorizePipeline(
+        args.folder_id, api_key,
+        recursive=args.recursive,
+        changes_only=args.changes_only,
+        download_workers=args.download_workers,
+        categorize_workers=args.categorize_workers,
+        persist_workers=args.persist_workers,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+        thumbnail_size=args.thumbnail_size,
+        async_concurrency=args.async_concurrency,
+    )
+    failed = pipeline.run()
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
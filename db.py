@@ -1,52 +1,107 @@
 import streamlit as st
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import datetime
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from sheets_scheduler import get_scheduler, SheetsQuotaError, PRIORITY_USER, PRIORITY_BACKGROUND
 
 # Google Sheetsの設定
 SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
 
+GALLERY_HEADER = ["timestamp", "image_url", "prompt", "engine", "user_id"]
+CATEGORIZED_HEADER = ["timestamp", "file_id", "image_url", "category", "description", "source_folder_id"]
+TABLE_HEADERS = {
+    "gallery_data": GALLERY_HEADER,
+    "categorized_images": CATEGORIZED_HEADER,
+}
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".webm")
+
+# 行インデックス (カテゴリ別・ギャラリー時系列) の再構築間隔 (秒)
+# 他プロセスからの追記を取りこぼさないよう、一定時間で再構築する。
+CATEGORY_INDEX_TTL = 300
+
+# 使用するバックエンド (get_backend() で遅延生成)
+_backend = None
+_backend_lock = threading.Lock()
+
+# --- Sheets API 呼び出し (すべてクォータ対応スケジューラを経由) ---
+def _sheets_read(key, fn, *args, priority=PRIORITY_USER, **kwargs):
+    """読み込み系のAPI呼び出し (同じ key の同時呼び出しは1回にまとめる)"""
+    return get_scheduler().read(key, fn, *args, priority=priority, **kwargs)
+
+def _sheets_write(fn, *args, priority=PRIORITY_BACKGROUND, **kwargs):
+    """書き込み系のAPI呼び出し"""
+    return get_scheduler().write(fn, *args, priority=priority, **kwargs)
+
+def _ws_key(worksheet, *parts):
+    return (worksheet.spreadsheet_id, worksheet.id) + parts
+
+def _report_fetch_error(e):
+    """読み込みエラーの通知 (クォータ超過は空のギャラリーと区別できるよう表示する)"""
+    if isinstance(e, SheetsQuotaError):
+        st.warning("Google Sheetsの利用制限に達しました。しばらくしてから再読み込みしてください。")
+
+def get_scheduler_metrics():
+    """Sheets APIスケジューラのメトリクス (キューの深さ・スロットル回数など)"""
+    return get_scheduler().metrics()
+
+_client = None
+_client_lock = threading.Lock()
+
 def get_connection():
-    """Google Sheetsへの接続を確立する"""
+    """Google Sheetsへの接続を確立する (認証済みのクライアントはプロセス内で使い回す)"""
+    global _client
     try:
         # st.secretsから認証情報を取得
-        if "gcp_service_account" in st.secrets:
-            creds_dict = st.secrets["gcp_service_account"]
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-            client = gspread.authorize(creds)
-            return client
-        else:
+        if "gcp_service_account" not in st.secrets:
             return None
+        with _client_lock:
+            if _client is None:
+                # gspread / oauth2client は Sheets を使うときだけ読み込む (SQLite バックエンドでは不要)
+                import gspread
+                from oauth2client.service_account import ServiceAccountCredentials
+                creds_dict = st.secrets["gcp_service_account"]
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+                _client = gspread.authorize(creds)
+            return _client
     except Exception as e:
         st.error(f"Database connection error: {e}")
         return None
 
-def init_db(sheet_name="gallery_data"):
+def init_db(sheet_name="gallery_data", sheet_key=None):
     """シートが存在しない場合は作成し、ヘッダーを設定する (簡易版)"""
     client = get_connection()
     if not client:
         return None
+    import gspread
         
     try:
         # スプレッドシートを開く (名前で指定、なければエラーになるので運用時は事前に作成推奨)
         # ここでは既存のシート "architecture-app-db" を想定、または secrets で指定
-        sheet_key = st.secrets.get("SHEET_KEY") # シートIDがあれば確実
+        sheet_key = sheet_key or st.secrets.get("SHEET_KEY") # シートIDがあれば確実
         if sheet_key:
             try:
-                sh = client.open_by_key(sheet_key)
+                sh = _sheets_read(("open_by_key", sheet_key), client.open_by_key, sheet_key)
+            except SheetsQuotaError:
+                # 利用制限はシートがないのとは別 (呼び出し元で通知する)
+                raise
             except:
                 st.warning(f"指定されたシートキー {sheet_key} が見つかりません。")
                 return None
         else:
             # 名前で検索 (ユニークな名前推奨)
             try:
-                sh = client.open("architecture-app-db")
+                sh = _sheets_read(("open", "architecture-app-db"), client.open, "architecture-app-db")
             except gspread.SpreadsheetNotFound:
                 # シートがない場合は作成する (サービスアカウントのドライブに作成される)
                 try:
-                    sh = client.create("architecture-app-db")
+                    sh = _sheets_write(client.create, "architecture-app-db", priority=PRIORITY_USER)
                     # 誰でも閲覧可能にする（オプション: 必要に応じて変更）
-                    sh.share(None, perm_type='anyone', role='reader')
+                    _sheets_write(sh.share, None, perm_type='anyone', role='reader', priority=PRIORITY_USER)
                     st.toast("新しいデータベース(スプレッドシート)を作成しました。")
                 except Exception as e:
                     if "quota" in str(e).lower():
@@ -64,85 +119,424 @@ def init_db(sheet_name="gallery_data"):
             
         # ワークシート取得 (なければ作成)
         try:
-            worksheet = sh.worksheet(sheet_name)
-        except:
-            worksheet = sh.add_worksheet(title=sheet_name, rows=1000, cols=10)
+            worksheet = _sheets_read(("worksheet", sh.id, sheet_name), sh.worksheet, sheet_name)
+        except gspread.WorksheetNotFound:
+            worksheet = _sheets_write(sh.add_worksheet, title=sheet_name, rows=1000, cols=10, priority=PRIORITY_USER)
             # ヘッダー作成
             if sheet_name == "gallery_data":
-                worksheet.append_row(["timestamp", "image_url", "prompt", "engine", "user_id"])
+                _sheets_write(worksheet.append_row, GALLERY_HEADER, priority=PRIORITY_USER)
             elif sheet_name == "categorized_images":
-                worksheet.append_row(["timestamp", "file_id", "image_url", "category", "description", "source_folder_id"])
+                _sheets_write(worksheet.append_row, CATEGORIZED_HEADER, priority=PRIORITY_USER)
             
         return worksheet
-    except Exception as e:
+    except SheetsQuotaError:
+        raise
+    except Exception:
         # st.error(f"Sheet init error: {e}")
         return None
 
-def save_result(image_url, prompt, engine, user_id="anonymous"):
-    """生成結果をDB(Sheet)に保存"""
-    worksheet = init_db("gallery_data")
-    if worksheet:
+def is_video_url(url):
+    """URLの拡張子から動画かどうかを判定"""
+    return bool(url) and str(url).lower().endswith(VIDEO_EXTENSIONS)
+
+def _row_from_append_response(response):
+    """append_rowのレスポンス (updatedRange) から追記された行番号を取り出す"""
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+def _entries_after(entries, cursor):
+    """新しい順の [(timestamp, row), ...] から、cursor より古い要素の開始位置を二分探索で求める"""
+    if cursor is None:
+        return 0
+    cursor = (str(cursor[0]), int(cursor[1]))
+    lo, hi = 0, len(entries)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if entries[mid] >= cursor:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class StorageBackend:
+    """ストレージバックエンドの共通インターフェース"""
+
+    name = "base"
+
+    def is_available(self):
+        """バックエンドが利用可能か"""
+        raise NotImplementedError
+
+    def save_result(self, image_url, prompt, engine, user_id="anonymous"):
+        raise NotImplementedError
+
+    def get_recent_results(self, limit=50):
+        raise NotImplementedError
+
+    def get_results_page(self, cursor=None, page_size=20, media=None):
+        """(timestamp, row) カーソルによるキーセットページネーション
+
+        cursor より古い結果を新しい順に page_size 件返す。
+        戻り値は (records, next_cursor)。次のページがなければ next_cursor は None。
+        media: None (全件) / "video" (動画のみ) / "image" (画像のみ)
+        """
+        raise NotImplementedError
+
+    def save_categorized_image(self, file_id, image_url, category, description, source_folder_id):
+        raise NotImplementedError
+
+    def get_categorized_images(self, category=None, limit=100):
+        raise NotImplementedError
+
+    def get_category_counts(self):
+        raise NotImplementedError
+
+    def iter_row_chunks(self, table, after_row=0, chunk_size=5000):
+        """table の行を after_row より後ろから chunk_size 件ずつ、行番号順に返すジェネレータ
+
+        各行は列名をキーにしたdict (行番号は "_row")。全件をメモリに載せずに読み出すためのAPI。
+        """
+        raise NotImplementedError
+
+
+class SheetsBackend(StorageBackend):
+    """Google Sheetsバックエンド"""
+
+    name = "sheets"
+
+    def __init__(self, sheet_key=None):
+        self.sheet_key = sheet_key
+        # 開いたワークシートはプロセス内で使い回す (open_by_key / worksheet の呼び出しを節約)
+        self._worksheets = {}
+        self._worksheets_lock = threading.Lock()
+        # --- カテゴリ別インデックス (プロセス内キャッシュ) ---
+        # {"category": [(timestamp, row), ...]} を新しい順で保持し、挿入時に更新する。
+        self._category_index = None
+        self._category_index_built_at = 0.0
+        self._category_index_lock = threading.Lock()
+        # --- ギャラリー時系列インデックス ---
+        # [(timestamp, row), ...] (新しい順) と動画の行番号セット
+        self._gallery_index = None
+        self._gallery_video_rows = set()
+        self._gallery_index_built_at = 0.0
+        self._gallery_index_lock = threading.Lock()
+
+    def is_available(self):
+        return get_connection() is not None
+
+    def worksheet(self, sheet_name):
+        with self._worksheets_lock:
+            worksheet = self._worksheets.get(sheet_name)
+        if worksheet is None:
+            worksheet = init_db(sheet_name, sheet_key=self.sheet_key)
+            if worksheet:
+                with self._worksheets_lock:
+                    self._worksheets[sheet_name] = worksheet
+        return worksheet
+
+    def save_result(self, image_url, prompt, engine, user_id="anonymous"):
+        """生成結果をDB(Sheet)に保存"""
         try:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            worksheet.append_row([timestamp, image_url, prompt, engine, user_id])
-            return True
-        except Exception as e:
+            worksheet = self.worksheet("gallery_data")
+        except SheetsQuotaError as e:
             st.error(f"Save error: {e}")
             return False
-    return False
+        if worksheet:
+            try:
+                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                response = _sheets_write(worksheet.append_row, [timestamp, image_url, prompt, engine, user_id])
+                self._index_gallery_insert(response, timestamp, image_url)
+                return True
+            except Exception as e:
+                st.error(f"Save error: {e}")
+                return False
+        return False
 
-def get_recent_results(limit=50):
-    """最新の生成結果を取得"""
-    worksheet = init_db("gallery_data")
-    if worksheet:
-        try:
-            # 全データを取得 (行数が多いと遅くなるので注意。本番ではAPIで範囲指定推奨)
-            all_records = worksheet.get_all_records()
-            # 新しい順にソート
-            sorted_records = sorted(all_records, key=lambda x: x['timestamp'], reverse=True)
-            return sorted_records[:limit]
-        except Exception as e:
-            # st.error(f"Fetch error: {e}")
-            return []
-    return []
+    def _build_gallery_index(self, worksheet):
+        """timestamp列とimage_url列だけを読み、時系列の行番号インデックスを作る"""
+        timestamps, urls = _sheets_read(_ws_key(worksheet, "batch_get", "A2:A", "B2:B"), worksheet.batch_get, ["A2:A", "B2:B"])
+        entries = []
+        video_rows = set()
+        for offset, ts_row in enumerate(timestamps):
+            if not ts_row or not ts_row[0]:
+                continue
+            row = offset + 2
+            entries.append((str(ts_row[0]), row))
+            if offset < len(urls) and urls[offset] and is_video_url(urls[offset][0]):
+                video_rows.add(row)
+        entries.sort(reverse=True)
+        return entries, video_rows
 
-def save_categorized_image(file_id, image_url, category, description, source_folder_id):
-    """カテゴリ分けされた画像をDBに保存"""
-    worksheet = init_db("categorized_images")
-    if worksheet:
+    def _get_gallery_index(self, worksheet):
+        """ギャラリー時系列インデックスを取得 (未構築 or 期限切れなら再構築)"""
+        with self._gallery_index_lock:
+            if self._gallery_index is None or time.time() - self._gallery_index_built_at > CATEGORY_INDEX_TTL:
+                self._gallery_index, self._gallery_video_rows = self._build_gallery_index(worksheet)
+                self._gallery_index_built_at = time.time()
+            return self._gallery_index, self._gallery_video_rows
+
+    def _index_gallery_insert(self, response, timestamp, image_url):
+        """追記した行をギャラリー時系列インデックスの先頭に追加する"""
+        with self._gallery_index_lock:
+            if self._gallery_index is None:
+                return
+            row = _row_from_append_response(response)
+            if row is None:
+                self._gallery_index = None
+                return
+            self._gallery_index.insert(0, (timestamp, row))
+            if is_video_url(image_url):
+                self._gallery_video_rows.add(row)
+
+    def _fetch_rows(self, worksheet, rows, header):
+        """指定した行だけを batch_get でまとめて読み、ヘッダーをキーにしたdictにする"""
+        last_col = chr(ord("A") + len(header) - 1)
+        ranges = [f"A{row}:{last_col}{row}" for row in rows]
+        value_ranges = _sheets_read(_ws_key(worksheet, "batch_get", *ranges), worksheet.batch_get, ranges)
+        records = []
+        for row, value_range in zip(rows, value_ranges):
+            values = value_range[0] if value_range else []
+            values = list(values) + [""] * (len(header) - len(values))
+            record = dict(zip(header, values))
+            record["_row"] = row
+            records.append(record)
+        return records
+
+    def get_recent_results(self, limit=50):
+        """最新の生成結果を取得"""
+        records, _ = self.get_results_page(page_size=limit)
+        return records
+
+    def get_results_page(self, cursor=None, page_size=20, media=None):
+        """(timestamp, row) カーソルで1ページ分の生成結果を取得 (該当行だけを読む)"""
         try:
-            # 重複チェック (簡易)
-            # 全件取得してfile_idがあるか確認するのは非効率だが、小規模ならOK
-            # 本来はDB側でユニーク制約をかけたいが、Spreadsheetなのでコードでチェック
+            worksheet = self.worksheet("gallery_data")
+        except SheetsQuotaError as e:
+            _report_fetch_error(e)
+            return [], None
+        if worksheet:
             try:
-                cell = worksheet.find(file_id)
-                if cell:
-                    return True # 既に存在するのでスキップ
-            except:
-                pass # 見つからない場合は続行
+                entries, video_rows = self._get_gallery_index(worksheet)
+                page = []
+                # 1件多く取って次ページの有無を判定する
+                for entry in itertools.islice(entries, _entries_after(entries, cursor), None):
+                    if media == "video" and entry[1] not in video_rows:
+                        continue
+                    if media == "image" and entry[1] in video_rows:
+                        continue
+                    page.append(entry)
+                    if len(page) > page_size:
+                        break
+                has_more = len(page) > page_size
+                page = page[:page_size]
+                if not page:
+                    return [], None
+                records = self._fetch_rows(worksheet, [row for _, row in page], GALLERY_HEADER)
+                return records, (page[-1] if has_more else None)
+            except Exception as e:
+                # st.error(f"Fetch error: {e}")
+                _report_fetch_error(e)
+                return [], None
+        return [], None
 
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            worksheet.append_row([timestamp, file_id, image_url, category, description, source_folder_id])
-            return True
-        except Exception as e:
+    def _build_category_index(self, worksheet):
+        """timestamp列とcategory列だけを読み、カテゴリ別の行番号インデックスを作る"""
+        timestamps, categories = _sheets_read(_ws_key(worksheet, "batch_get", "A2:A", "D2:D"), worksheet.batch_get, ["A2:A", "D2:D"])
+        index = {}
+        for offset, ts_row in enumerate(timestamps):
+            if not ts_row or not ts_row[0]:
+                continue
+            category = categories[offset][0] if offset < len(categories) and categories[offset] else ""
+            index.setdefault(category, []).append((str(ts_row[0]), offset + 2))
+        for entries in index.values():
+            entries.sort(reverse=True)
+        return index
+
+    def _get_category_index(self, worksheet):
+        """カテゴリ別インデックスを取得 (未構築 or 期限切れなら再構築)"""
+        with self._category_index_lock:
+            if self._category_index is None or time.time() - self._category_index_built_at > CATEGORY_INDEX_TTL:
+                self._category_index = self._build_category_index(worksheet)
+                self._category_index_built_at = time.time()
+            return self._category_index
+
+    def _index_categorized_insert(self, response, timestamp, category):
+        """append_rowのレスポンスから行番号を取り出し、インデックスの先頭に追加する"""
+        with self._category_index_lock:
+            if self._category_index is None:
+                return
+            row = _row_from_append_response(response)
+            if row is None:
+                # 行番号が分からない場合は次回読み込み時に再構築
+                self._category_index = None
+                return
+            self._category_index.setdefault(category, []).insert(0, (timestamp, row))
+
+    def invalidate_category_index(self):
+        """カテゴリ別インデックスを破棄する (次回読み込み時に再構築)"""
+        with self._category_index_lock:
+            self._category_index = None
+
+    def save_categorized_image(self, file_id, image_url, category, description, source_folder_id):
+        """カテゴリ分けされた画像をDBに保存"""
+        try:
+            worksheet = self.worksheet("categorized_images")
+        except SheetsQuotaError as e:
             st.error(f"Save categorized image error: {e}")
             return False
-    return False
+        if worksheet:
+            try:
+                # 重複チェック (簡易)
+                # 全件取得してfile_idがあるか確認するのは非効率だが、小規模ならOK
+                # 本来はDB側でユニーク制約をかけたいが、Spreadsheetなのでコードでチェック
+                cell = None
+                try:
+                    cell = _sheets_read(_ws_key(worksheet, "find", file_id), worksheet.find, file_id, priority=PRIORITY_BACKGROUND)
+                except SheetsQuotaError:
+                    raise
+                except:
+                    pass # 見つからない場合は続行
+                if cell:
+                    # 既に存在する (更新されたファイルの再分類) ので、カテゴリと説明だけ書き換える
+                    _sheets_write(worksheet.batch_update, [{"range": f"D{cell.row}:E{cell.row}", "values": [[category, description]]}])
+                    self.invalidate_category_index()
+                    return True
 
-def get_categorized_images(category=None, limit=100):
-    """カテゴリ分けされた画像を取得"""
-    worksheet = init_db("categorized_images")
-    if worksheet:
+                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                response = _sheets_write(worksheet.append_row, [timestamp, file_id, image_url, category, description, source_folder_id])
+                self._index_categorized_insert(response, timestamp, category)
+                return True
+            except Exception as e:
+                st.error(f"Save categorized image error: {e}")
+                return False
+        return False
+
+    def get_categorized_images(self, category=None, limit=100):
+        """カテゴリ分けされた画像を取得 (インデックスで該当行だけを読む)"""
         try:
-            all_records = worksheet.get_all_records()
-            if category and category != "All":
-                filtered_records = [r for r in all_records if r.get('category') == category]
-            else:
-                filtered_records = all_records
-            
-            # 新しい順
-            sorted_records = sorted(filtered_records, key=lambda x: x['timestamp'], reverse=True)
-            return sorted_records[:limit]
-        except Exception as e:
+            worksheet = self.worksheet("categorized_images")
+        except SheetsQuotaError as e:
+            _report_fetch_error(e)
             return []
-    return []
+        if worksheet:
+            try:
+                index = self._get_category_index(worksheet)
+                if category and category != "All":
+                    entries = index.get(category, [])[:limit]
+                else:
+                    # 各カテゴリは新しい順なのでマージするだけで全体も新しい順になる
+                    entries = list(itertools.islice(heapq.merge(*index.values(), reverse=True), limit))
+                if not entries:
+                    return []
+
+                return self._fetch_rows(worksheet, [row for _, row in entries], CATEGORIZED_HEADER)
+            except Exception as e:
+                _report_fetch_error(e)
+                return []
+        return []
+
+    def get_category_counts(self):
+        """カテゴリごとの件数を取得 (UIのファセット表示用、インデックスから算出)"""
+        try:
+            worksheet = self.worksheet("categorized_images")
+        except SheetsQuotaError as e:
+            _report_fetch_error(e)
+            return {}
+        if worksheet:
+            try:
+                index = self._get_category_index(worksheet)
+                return {category: len(entries) for category, entries in index.items()}
+            except Exception as e:
+                _report_fetch_error(e)
+                return {}
+        return {}
+
+    def iter_row_chunks(self, table, after_row=0, chunk_size=5000):
+        """行範囲 (A{start}:F{end}) を指定して chunk_size 行ずつ読み出す"""
+        worksheet = self.worksheet(table)
+        if not worksheet:
+            return
+        header = TABLE_HEADERS[table]
+        last_col = chr(ord("A") + len(header) - 1)
+        start = max(2, after_row + 1)  # 1行目はヘッダー
+        while True:
+            end = start + chunk_size - 1
+            rng = f"A{start}:{last_col}{end}"
+            rows = _sheets_read(_ws_key(worksheet, "get", rng), worksheet.get, rng, priority=PRIORITY_BACKGROUND)
+            chunk = []
+            for offset, values in enumerate(rows):
+                if not values or not values[0]:
+                    continue
+                values = list(values) + [""] * (len(header) - len(values))
+                record = dict(zip(header, values))
+                record["_row"] = start + offset
+                chunk.append(record)
+            if chunk:
+                yield chunk
+            if len(rows) < chunk_size:
+                break
+            start = end + 1
+
+
+def create_backend(name=None, **kwargs):
+    """バックエンドを生成する (name: "sheets" / "sqlite")"""
+    if name is None:
+        try:
+            name = st.secrets.get("DB_BACKEND", "sheets")
+        except Exception:
+            name = "sheets"
+    if name == "sqlite":
+        from db_sqlite import SQLiteBackend
+        if "path" not in kwargs:
+            try:
+                kwargs["path"] = st.secrets.get("SQLITE_PATH", "data/app.db")
+            except Exception:
+                kwargs["path"] = "data/app.db"
+        return SQLiteBackend(**kwargs)
+    if name == "sheets":
+        return SheetsBackend(**kwargs)
+    raise ValueError(f"Unknown DB backend: {name}")
+
+def get_backend():
+    """プロセス共通のバックエンドを取得 (secretsの DB_BACKEND で切り替え)"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+def set_backend(backend):
+    """使用するバックエンドを差し替える (移行ツール・ベンチマーク用)"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+# --- 公開API (選択中のバックエンドに委譲) ---
+def is_available():
+    """DBが利用可能か"""
+    return get_backend().is_available()
+
+def save_result(image_url, prompt, engine, user_id="anonymous"):
+    """生成結果をDBに保存"""
+    return get_backend().save_result(image_url, prompt, engine, user_id)
+
+def get_recent_results(limit=50):
+    """最新の生成結果を取得"""
+    return get_backend().get_recent_results(limit=limit)
+
+def get_results_page(cursor=None, page_size=20, media=None):
+    """生成結果を1ページ分取得 (戻り値: (records, next_cursor))"""
+    return get_backend().get_results_page(cursor=cursor, page_size=page_size, media=media)
+
+def save_categorized_image(file_id, image_url, category, description, source_folder_id):
+    """カテゴリ分けされた画像をDBに保存"""
+    return get_backend().save_categorized_image(file_id, image_url, category, description, source_folder_id)
+
+def get_categorized_images(category=None, limit=100):
+    """カテゴリ分けされた画像を取得"""
+    return get_backend().get_categorized_images(category=category, limit=limit)
+
+def get_category_counts():
+    """カテゴリごとの件数を取得"""
+    return get_backend().get_category_counts()
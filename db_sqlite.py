@@ -0,0 +1,177 @@
+import datetime
+import os
+import sqlite3
+import threading
+
+from db import StorageBackend, GALLERY_HEADER, CATEGORIZED_HEADER, TABLE_HEADERS, VIDEO_EXTENSIONS
+
+# テーブル定義 (列順はスプレッドシートのヘッダーと揃える)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gallery_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    image_url TEXT,
+    prompt TEXT,
+    engine TEXT,
+    user_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_gallery_timestamp ON gallery_data (timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_gallery_engine ON gallery_data (engine, timestamp);
+
+CREATE TABLE IF NOT EXISTS categorized_images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    image_url TEXT,
+    category TEXT,
+    description TEXT,
+    source_folder_id TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_categorized_file_id ON categorized_images (file_id);
+CREATE INDEX IF NOT EXISTS idx_categorized_timestamp ON categorized_images (timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_categorized_category ON categorized_images (category, timestamp, id);
+"""
+
+
+class SQLiteBackend(StorageBackend):
+    """ローカルSQLiteバックエンド (インデックス付き、行数・クォータ制限なし)"""
+
+    name = "sqlite"
+
+    def __init__(self, path="data/app.db"):
+        self.path = path
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # sqlite3の接続はスレッド間で共有できないため、スレッドごとに持つ
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def is_available(self):
+        return True
+
+    def _now(self):
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def save_result(self, image_url, prompt, engine, user_id="anonymous"):
+        """生成結果を保存"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO gallery_data (timestamp, image_url, prompt, engine, user_id) VALUES (?, ?, ?, ?, ?)",
+                (self._now(), image_url, prompt, engine, user_id),
+            )
+        return True
+
+    def get_recent_results(self, limit=50):
+        """最新の生成結果を取得"""
+        records, _ = self.get_results_page(page_size=limit)
+        return records
+
+    def get_results_page(self, cursor=None, page_size=20, media=None):
+        """(timestamp, id) カーソルで1ページ分の生成結果を取得 (idx_gallery_timestamp を使用)"""
+        where, params = [], []
+        if cursor is not None:
+            where.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params += [str(cursor[0]), str(cursor[0]), int(cursor[1])]
+        if media in ("video", "image"):
+            video_match = " OR ".join("lower(image_url) LIKE ?" for _ in VIDEO_EXTENSIONS)
+            where.append(f"({video_match})" if media == "video" else f"NOT ({video_match})")
+            params += [f"%{ext}" for ext in VIDEO_EXTENSIONS]
+        sql = f"SELECT {', '.join(GALLERY_HEADER)}, id AS _row FROM gallery_data"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # 1件多く取って次ページの有無を判定する
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        rows = self._connect().execute(sql, params + [page_size + 1]).fetchall()
+        records = [dict(row) for row in rows[:page_size]]
+        next_cursor = None
+        if len(rows) > page_size and records:
+            next_cursor = (records[-1]["timestamp"], records[-1]["_row"])
+        return records, next_cursor
+
+    def save_categorized_image(self, file_id, image_url, category, description, source_folder_id):
+        """カテゴリ分けされた画像を保存 (同じfile_idがあればカテゴリと説明を更新する: 更新されたファイルの再分類)"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO categorized_images "
+                "(timestamp, file_id, image_url, category, description, source_folder_id) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(file_id) DO UPDATE SET category = excluded.category, description = excluded.description",
+                (self._now(), file_id, image_url, category, description, source_folder_id),
+            )
+        return True
+
+    def get_categorized_images(self, category=None, limit=100):
+        """カテゴリ分けされた画像を取得"""
+        columns = ", ".join(CATEGORIZED_HEADER) + ", id AS _row"
+        if category and category != "All":
+            rows = self._connect().execute(
+                f"SELECT {columns} FROM categorized_images WHERE category = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (category, limit),
+            ).fetchall()
+        else:
+            rows = self._connect().execute(
+                f"SELECT {columns} FROM categorized_images ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_category_counts(self):
+        """カテゴリごとの件数を取得"""
+        rows = self._connect().execute(
+            "SELECT category, COUNT(*) FROM categorized_images GROUP BY category"
+        ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def import_rows(self, table, rows):
+        """スプレッドシートの行 (ヘッダー順の値リスト) をそのまま一括登録する (移行用)"""
+        columns = TABLE_HEADERS[table]
+        normalized = [
+            tuple(list(row[:len(columns)]) + [""] * (len(columns) - len(row)))
+            for row in rows
+            if row and row[0]
+        ]
+        placeholders = ", ".join("?" for _ in columns)
+        verb = "INSERT OR IGNORE" if table == "categorized_images" else "INSERT"
+        with self._connect() as conn:
+            conn.executemany(
+                f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                normalized,
+            )
+        return len(normalized)
+
+    def count_rows(self, table):
+        """テーブルの行数 (移行先が空かどうかの確認用)"""
+        return self._connect().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def clear_table(self, table):
+        """テーブルの行をすべて削除する (移行のやり直し用)"""
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {table}")
+
+    def iter_row_chunks(self, table, after_row=0, chunk_size=5000):
+        """id > after_row の行を id順に chunk_size 件ずつ返す"""
+        columns = ", ".join(TABLE_HEADERS[table]) + ", id AS _row"
+        last = after_row
+        while True:
+            rows = self._connect().execute(
+                f"SELECT {columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (last, chunk_size),
+            ).fetchall()
+            if not rows:
+                break
+            chunk = [dict(row) for row in rows]
+            yield chunk
+            last = chunk[-1]["_row"]
+            if len(rows) < chunk_size:
+                break
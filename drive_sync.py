@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+
+import drive_utils
+
+DEFAULT_STATE_PATH = "data/drive_sync_state.json"
+
+
+class FolderChangeTracker:
+    """監視フォルダごとに Changes API のページトークンを保存し、前回以降に追加・更新された画像だけを返す
+
+    使い方:
+        tracker = FolderChangeTracker()
+        files, token = tracker.pending_files(folder_id)
+        ... files を処理 ...
+        tracker.commit(folder_id, token)   # 処理が終わってからトークンを進める
+    recursive=True で追跡するときは pending_files と commit の両方に渡す。
+    """
+
+    def __init__(self, state_path=DEFAULT_STATE_PATH):
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._state = self._load()
+
+    def _load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _save(self):
+        if os.path.dirname(self.state_path):
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def _key(folder_id, recursive):
+        # 直下だけの追跡とサブフォルダを含む追跡は別のトークンで管理する
+        return f"{folder_id}:recursive" if recursive else folder_id
+
+    def get_token(self, folder_id, recursive=False):
+        with self._lock:
+            return self._state.get(self._key(folder_id, recursive), {}).get("page_token")
+
+    def pending_files(self, folder_id, recursive=False):
+        """前回 commit 以降に folder_id 直下 (recursive=True ならサブフォルダも) へ追加・更新された画像と、次回用のトークンを返す
+
+        初回 (トークン未保存) はフォルダ全体を一覧して返す。
+        一覧の前にトークンを取るので、一覧中に追加されたファイルも次回に拾える。
+        一覧取得に失敗したときは例外を送出する (途中までの一覧でトークンを進めないため)。
+        """
+        token = self.get_token(folder_id, recursive)
+        if token is None:
+            start_token = drive_utils.get_start_page_token()
+            files = drive_utils.iter_images_in_folder(folder_id, recursive=recursive, raise_errors=True)
+            return list(files), start_token
+
+        changes, new_token = drive_utils.list_changes(token)
+        folders = drive_utils.list_folder_tree(folder_id) if recursive else {folder_id}
+        files = {}
+        for change in changes:
+            file = change.get("file") or {}
+            if change.get("removed") or file.get("trashed"):
+                continue
+            if folders.isdisjoint(file.get("parents", [])):
+                continue
+            if not file.get("mimeType", "").startswith("image/"):
+                continue
+            # 同じファイルの複数回の変更は最後のものだけを使う
+            files[file["id"]] = file
+        return list(files.values()), new_token
+
+    def commit(self, folder_id, page_token, recursive=False):
+        """処理済みとしてトークンを保存する"""
+        if not page_token:
+            return
+        with self._lock:
+            self._state.setdefault(self._key(folder_id, recursive), {})["page_token"] = page_token
+            self._save()
+
+    def reset(self, folder_id, recursive=False):
+        """トークンを破棄する (次回はフォルダ全体を処理)"""
+        with self._lock:
+            self._state.pop(self._key(folder_id, recursive), None)
+            self._save()
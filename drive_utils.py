@@ -3,49 +3,255 @@ from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 import httplib2
 import io
-from googleapiclient.http import MediaIoBaseDownload
+import itertools
+import logging
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload
+from PIL import Image
 
 # Google Drive API Scope
 SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
 
+HTTP_TIMEOUT = 60
+
+# バックグラウンドのスレッドからのエラーは画面ではなくログに出す
+logger = logging.getLogger(__name__)
+
+# Driveクライアントはプロセス内で1つだけ生成して使い回す
+_service = None
+_service_email = None
+_credentials = None
+_service_lock = threading.Lock()
+# httplib2.Http はスレッドセーフではないため、スレッドごとに接続 (keep-alive) を持つ
+_local = threading.local()
+
+def _thread_http():
+    """現在のスレッド用の認証付きHttp (トークンの期限切れ・401時はoauth2clientが自動更新)"""
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = _credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+        _local.http = http
+    return http
+
+def _build_request(http, *args, **kwargs):
+    """リクエストごとに呼び出し元スレッドのHttpを使う (サービスを複数スレッドで共有するため)"""
+    return HttpRequest(_thread_http(), *args, **kwargs)
+
 def get_drive_service():
-    """Google Drive APIサービスを取得する"""
+    """Google Drive APIサービスを取得する (初回のみ生成し、以降はキャッシュを返す)"""
+    global _service, _service_email, _credentials
+    if _service is not None:
+        return _service, _service_email
     try:
-        if "gcp_service_account" in st.secrets:
-            creds_dict = st.secrets["gcp_service_account"]
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-            
-            # oauth2clientのcredsを使ってserviceをビルド
-            http = creds.authorize(httplib2.Http())
-            service = build('drive', 'v3', http=http)
-            
-            return service, creds.service_account_email
-        else:
-            return None, None
+        with _service_lock:
+            if _service is None:
+                if "gcp_service_account" not in st.secrets:
+                    return None, None
+                creds_dict = st.secrets["gcp_service_account"]
+                _credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+
+                # 同梱のディスカバリー文書を使い、ネットワーク経由の取得を省く
+                _service = build(
+                    'drive', 'v3',
+                    http=_thread_http(),
+                    requestBuilder=_build_request,
+                    static_discovery=True,
+                    cache_discovery=False,
+                )
+                _service_email = _credentials.service_account_email
+        return _service, _service_email
     except Exception as e:
         st.error(f"Drive connection error: {e}")
         return None, None
 
-def list_images_in_folder(folder_id, limit=20):
-    """指定フォルダ内の画像ファイルをリストする"""
+# files().list で取得する項目 (thumbnailLinkを取得するには fields に含める必要がある)
+FILE_FIELDS = "id, name, mimeType, parents, size, md5Checksum, modifiedTime, webContentLink, webViewLink, thumbnailLink"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+MAX_PAGE_SIZE = 1000
+
+def _iter_folder_pages(service, query, page_size):
+    """nextPageToken をたどって1ページずつ files を返す"""
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=query,
+            pageSize=page_size,
+            pageToken=page_token,
+            fields=f"nextPageToken, files({FILE_FIELDS})"
+        ).execute()
+        yield results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+def iter_images_in_folder(folder_id, recursive=False, page_size=MAX_PAGE_SIZE, max_workers=4, raise_errors=False):
+    """指定フォルダ内の画像ファイルを、取得したページから順に1件ずつ返すジェネレータ
+
+    recursive=True の場合はサブフォルダもたどり、フォルダごとの一覧取得を max_workers 並列で行う。
+    raise_errors=True の場合、一覧取得のエラーを画面に表示せずに送出する
+    (ヘッドレス実行で、途中で切れた一覧を全件と取り違えないため)。
+    """
     service, _ = get_drive_service()
     if not service:
-        return []
+        if raise_errors:
+            raise RuntimeError("Google Drive に接続できません")
+        return
 
-    try:
-        # 画像ファイルのみ検索
-        # thumbnailLinkを取得するには fields に含める必要がある
+    if not recursive:
         query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false"
-        results = service.files().list(
-            q=query,
-            pageSize=limit,
-            fields="nextPageToken, files(id, name, mimeType, webContentLink, webViewLink, thumbnailLink)"
+        try:
+            for files in _iter_folder_pages(service, query, page_size):
+                yield from files
+        except Exception as e:
+            if raise_errors:
+                raise
+            st.error(f"Error listing files: {e}")
+        return
+
+    # --- 再帰: フォルダごとにワーカーで一覧を取り、結果をキュー経由で受け取る ---
+    results = queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()
+    visited = {folder_id}
+    pending = [1]  # 一覧取得中のフォルダ数
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive-list")
+
+    def walk(target_id):
+        query = (
+            f"'{target_id}' in parents and trashed = false and "
+            f"(mimeType contains 'image/' or mimeType = '{FOLDER_MIME_TYPE}')"
+        )
+        try:
+            for files in _iter_folder_pages(service, query, page_size):
+                if stop.is_set():
+                    return
+                for item in files:
+                    if item.get('mimeType') == FOLDER_MIME_TYPE:
+                        with lock:
+                            if item['id'] in visited:
+                                continue
+                            visited.add(item['id'])
+                            pending[0] += 1
+                        executor.submit(walk, item['id'])
+                    else:
+                        results.put(("file", item))
+        except Exception as e:
+            results.put(("error", e))
+        finally:
+            results.put(("done", target_id))
+
+    executor.submit(walk, folder_id)
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == "file":
+                yield value
+            elif kind == "error":
+                if raise_errors:
+                    raise value
+                st.error(f"Error listing files: {value}")
+            else:
+                with lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        break
+    finally:
+        # 途中で消費をやめた場合もワーカーを止める
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def list_folder_tree(folder_id, page_size=MAX_PAGE_SIZE):
+    """folder_id とその配下のすべてのフォルダの ID を返す (一覧取得のエラーは送出する)"""
+    service, _ = get_drive_service()
+    if not service:
+        raise RuntimeError("Google Drive に接続できません")
+    tree = {folder_id}
+    stack = [folder_id]
+    while stack:
+        query = f"'{stack.pop()}' in parents and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+        for files in _iter_folder_pages(service, query, page_size):
+            for item in files:
+                if item['id'] not in tree:
+                    tree.add(item['id'])
+                    stack.append(item['id'])
+    return tree
+
+def list_images_in_folder(folder_id, limit=20, recursive=False):
+    """指定フォルダ内の画像ファイルをリストする (limit件まで、ページをたどって取得)"""
+    return list(itertools.islice(
+        iter_images_in_folder(folder_id, recursive=recursive, page_size=min(limit, MAX_PAGE_SIZE)),
+        limit,
+    ))
+
+# --- 変更の追跡 (Changes API) ---
+def get_start_page_token():
+    """現在時点の変更ページトークンを取得する (これ以降の変更が changes.list で取れる)"""
+    service, _ = get_drive_service()
+    if not service:
+        return None
+    return service.changes().getStartPageToken().execute().get('startPageToken')
+
+def list_changes(page_token, page_size=MAX_PAGE_SIZE):
+    """page_token 以降の変更をすべて取得し、(changes, 次回用のトークン) を返す"""
+    service, _ = get_drive_service()
+    if not service:
+        return [], page_token
+
+    changes = []
+    while True:
+        results = service.changes().list(
+            pageToken=page_token,
+            pageSize=page_size,
+            spaces='drive',
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}, trashed))"
         ).execute()
-        items = results.get('files', [])
-        return items
-    except Exception as e:
-        st.error(f"Error listing files: {e}")
-        return []
+        changes.extend(results.get('changes', []))
+        if 'newStartPageToken' in results:
+            return changes, results['newStartPageToken']
+        page_token = results['nextPageToken']
+
+# --- ダウンロード ---
+# 1チャンク = 1リクエスト。画像は1回で取り切り、大きなファイルはリトライ単位を小さくする
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def _is_retryable(e):
+    if isinstance(e, HttpError):
+        return e.resp.status in RETRYABLE_STATUS
+    # 接続断・タイムアウトなど
+    return isinstance(e, (OSError, httplib2.HttpLib2Error))
+
+def _chunk_size_for(size, chunk_size):
+    """サイズが分かっていれば1リクエストで取り切れるチャンクサイズにする"""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return chunk_size
+    return max(256 * 1024, min(size, chunk_size))
+
+def _download(service, file_id, fh, chunk_size=DOWNLOAD_CHUNK_SIZE, size=None, max_retries=5):
+    """fh にファイル本体を書き込む (429/5xx は指数バックオフで同じチャンクから再開)"""
+    request = service.files().get_media(fileId=file_id)
+    downloader = MediaIoBaseDownload(fh, request, chunksize=_chunk_size_for(size, chunk_size))
+    done = False
+    retries = 0
+    while done is False:
+        try:
+            status, done = downloader.next_chunk()
+            retries = 0
+        except Exception as e:
+            if retries >= max_retries or not _is_retryable(e):
+                raise
+            time.sleep(min(32, 2 ** retries) + random.uniform(0, 1))
+            retries += 1
 
 def get_image_data(file_id):
     """Google Driveから画像データをバイナリとして取得する"""
@@ -54,14 +260,103 @@ def get_image_data(file_id):
         return None
 
     try:
-        request = service.files().get_media(fileId=file_id)
         fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        
+        _download(service, file_id, fh)
         return fh.getvalue()
     except Exception as e:
         st.error(f"Error downloading file {file_id}: {e}")
         return None
+
+def download_images(files, max_workers=8, to_file=False, temp_dir=None, chunk_size=DOWNLOAD_CHUNK_SIZE, max_retries=5):
+    """複数ファイルを並列でダウンロードし、完了した順に (file_id, データ) を返すジェネレータ
+
+    files: file_id、または list_images_in_folder が返すメタデータ (sizeがあればチャンクサイズに使う)
+    to_file=False なら bytes、True なら一時ファイルへ書き出してそのパスを返す (呼び出し側で削除すること)。
+    リトライしても失敗したファイルは (file_id, None) を返す。
+    Drive に接続できないときは RuntimeError を送出する (空の結果と取り違えないため)。
+    """
+    service, _ = get_drive_service()
+    if not service:
+        raise RuntimeError("Google Drive に接続できません")
+
+    def fetch(file_id, size):
+        if not to_file:
+            fh = io.BytesIO()
+            _download(service, file_id, fh, chunk_size=chunk_size, size=size, max_retries=max_retries)
+            return fh.getvalue()
+        tmp = tempfile.NamedTemporaryFile(prefix="drive_", suffix=".bin", dir=temp_dir, delete=False)
+        try:
+            with tmp:
+                _download(service, file_id, tmp, chunk_size=chunk_size, size=size, max_retries=max_retries)
+            return tmp.name
+        except Exception:
+            os.remove(tmp.name)
+            raise
+
+    # 実行中のダウンロードは max_workers * 2 件までに抑え、files がジェネレータでも先読みしすぎない
+    items = iter(files)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive-download") as executor:
+        in_flight = {}
+        while True:
+            for item in itertools.islice(items, max(0, max_workers * 2 - len(in_flight))):
+                file_id, size = (item["id"], item.get("size")) if isinstance(item, dict) else (item, None)
+                in_flight[executor.submit(fetch, file_id, size)] = file_id
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                file_id = in_flight.pop(future)
+                try:
+                    yield file_id, future.result()
+                except Exception as e:
+                    logger.warning("Error downloading file %s: %s", file_id, e)
+                    yield file_id, None
+
+# --- 分類用の縮小画像 ---
+# Geminiでの部屋の種類の判定には数百px程度で十分なため、原寸の写真を転送しない
+CATEGORIZE_IMAGE_SIZE = 512
+
+def _resize_to_jpeg(source, size):
+    """画像ファイル (パス or ファイルオブジェクト) を長辺 size px のJPEG bytesにする"""
+    with Image.open(source) as image:
+        # JPEGはデコード時に縮小できる (draft) ので、原寸の画素を展開せずに済む
+        image.draft("RGB", (size, size))
+        image.thumbnail((size, size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=85)
+        return out.getvalue()
+
+def get_image_thumbnail(file, size=CATEGORIZE_IMAGE_SIZE):
+    """分類用に長辺 size px 程度の画像を取得し、(JPEG bytes, 転送したバイト数) を返す
+
+    file は list_images_in_folder が返すメタデータ、または file_id。
+    thumbnailLink があればサイズ指定 (=s{size}) のサムネイルを取得し、
+    なければ原本を一時ファイルへストリーミングしてからローカルで縮小する。
+    失敗時は (None, 0)。
+    """
+    service, _ = get_drive_service()
+    if not service:
+        return None, 0
+
+    try:
+        if not isinstance(file, dict):
+            file = service.files().get(fileId=file, fields=FILE_FIELDS).execute()
+
+        thumbnail_link = file.get('thumbnailLink')
+        if thumbnail_link:
+            url = re.sub(r"=s\d+$", "", thumbnail_link) + f"=s{size}"
+            resp, content = _thread_http().request(url)
+            if resp.status == 200 and content:
+                return content, len(content)
+
+        # サムネイルがない場合: 原本をメモリに載せずに一時ファイルへ書き出して縮小
+        with tempfile.TemporaryFile() as tmp:
+            _download(service, file['id'], tmp, size=file.get('size'))
+            transferred = tmp.tell()
+            tmp.seek(0)
+            return _resize_to_jpeg(tmp, size), transferred
+    except Exception as e:
+        logger.warning("Error fetching thumbnail %s: %s", file.get('id') if isinstance(file, dict) else file, e)
+        return None, 0
@@ -0,0 +1,258 @@
+"""画像生成エンジンのレジストリ
+
+各エンジンについて、createTask の payload の組み立て方・入力条件 (capabilities)・
+実行時の統計 (直近のレイテンシ・失敗率・生成中のタスク数) をまとめて持つ。
+送信の順番と、エンジンごとに同時に送るタスク数はこの統計から決める。
+エンジンを追加するときは ENGINES にエントリを1つ (と preprocess.PROFILES にプロファイルを) 追加する。
+"""
+import itertools
+import statistics
+import threading
+import time
+from collections import deque
+
+import preprocess
+
+DEFAULT_MAX_IN_FLIGHT = 4   # 1エンジンで同時に生成中にしておくタスク数
+DEFAULT_LATENCY = 60.0      # 統計がないときの完了までの目安 (秒)
+STATS_WINDOW = 50           # 直近何件でレイテンシ・失敗率を計算するか
+IN_FLIGHT_TTL = 600         # 完了を確認できなかったタスクを生成中から外すまでの時間 (秒)
+
+
+class Engine:
+    """1つの画像生成エンジン
+
+    model_id: createTask の model
+    image_field: 入力画像URLのリストを渡すキー
+    resolution_field: 解像度 (プロファイルで変換済みの値) を渡すキー
+    max_prompt_chars: プロンプトの最大文字数 (None は制限なし)
+    supports_strength: strength を渡せるか
+    extra_input: input に常に含める値
+    max_in_flight: 同時に生成中にしておくタスク数の上限
+    expected_latency: 統計がたまるまでに使う完了までの目安 (秒)
+    """
+
+    def __init__(self, name, model_id, image_field, resolution_field="resolution", max_prompt_chars=None,
+                 supports_strength=False, extra_input=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 expected_latency=DEFAULT_LATENCY):
+        self.name = name
+        self.model_id = model_id
+        self.image_field = image_field
+        self.resolution_field = resolution_field
+        self.max_prompt_chars = max_prompt_chars
+        self.supports_strength = supports_strength
+        self.extra_input = extra_input or {}
+        self.max_in_flight = max_in_flight
+        self.expected_latency = expected_latency
+
+    @property
+    def profile(self):
+        return preprocess.get_profile(self.name)
+
+    def build_payload(self, prompt, image_url, target, callback_url, strength=None):
+        """createTask の payload を作る (target: preprocess.Target)"""
+        if self.max_prompt_chars:
+            prompt = prompt[:self.max_prompt_chars]
+        engine_input = {
+            "prompt": prompt,
+            self.image_field: [image_url],
+            "aspect_ratio": target.aspect_ratio,
+            self.resolution_field: target.resolution,
+        }
+        if self.supports_strength and strength is not None:
+            engine_input["strength"] = strength
+        engine_input.update(self.extra_input)
+        return {"model": self.model_id, "callBackUrl": callback_url, "input": engine_input}
+
+    def capabilities(self):
+        profile = self.profile
+        return {
+            "aspect_ratios": sorted(set(profile.aspect_ratios.values())),
+            "resolutions": sorted(set(value for value, _ in profile.resolutions.values())),
+            "max_input_edge": profile.max_input_edge,
+            "input_edge": profile.input_edge,
+            "max_prompt_chars": self.max_prompt_chars,
+            "supports_strength": self.supports_strength,
+        }
+
+
+ENGINES = [
+    Engine("Nano Banana Pro", "nano-banana-pro", "image_input",
+           extra_input={"output_format": "png"}, expected_latency=40),
+    # Flux 2 は 4K 非対応 (プロファイルで 2K に変換)
+    Engine("Flux 2 Flex", "flux-2/flex-image-to-image", "input_urls",
+           supports_strength=True, expected_latency=30),
+    # Seedream は解像度を quality (basic / high) で指定する
+    Engine("Seedream 4.5 Edit", "seedream/4.5-edit", "image_urls",
+           resolution_field="quality", expected_latency=30),
+    # GPT Image 1.5 はプロンプトが最大1000文字 (API制限)
+    Engine("GPT Image 1.5", "gpt-image/1.5-image-to-image", "input_urls",
+           resolution_field="quality", max_prompt_chars=1000, expected_latency=60),
+]
+
+
+class _EngineStats:
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)  # 成功したタスクの送信〜完了 (秒)
+        self.outcomes = deque(maxlen=window)   # True: 成功 / False: 失敗
+        self.in_flight = {}                    # task_id (送信前は予約) -> 送信時刻
+        self.submitted = 0
+
+
+class EngineRegistry:
+    """エンジンの一覧と実行時の統計 (プロセス共通)
+
+    - start() / finish() で送信・完了を記録し、直近のレイテンシ・失敗率を更新する
+    - submission_order() は速く失敗の少ないエンジンから並べる
+    - take_ready() はエンジンごとの生成中タスク数が max_in_flight を超えない分だけ送信待ちから取り出し、
+      その分の枠を予約する (送信に成功したら start()、失敗したら record_submit_failure() に予約を渡す)
+    """
+
+    def __init__(self, engines=ENGINES, max_in_flight=None, window=STATS_WINDOW, in_flight_ttl=IN_FLIGHT_TTL):
+        self._engines = {engine.name: engine for engine in engines}
+        self._max_in_flight = {name: engine.max_in_flight for name, engine in self._engines.items()}
+        self._max_in_flight.update(max_in_flight or {})
+        self.in_flight_ttl = in_flight_ttl
+        self._stats = {name: _EngineStats(window) for name in self._engines}
+        self._task_engines = {}  # task_id (または予約) -> エンジン名
+        self._reservation_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    # --- エンジン ---
+    def names(self):
+        return list(self._engines)
+
+    def get(self, name):
+        return self._engines[name]
+
+    # --- 統計 ---
+    def start(self, name, task_id, reservation=None):
+        """タスクを送信したことを記録する (reservation: take_ready() で予約した枠)"""
+        with self._lock:
+            stats = self._stats[name]
+            self._release(reservation)
+            stats.in_flight[task_id] = time.time()
+            stats.submitted += 1
+            self._task_engines[task_id] = name
+
+    def finish(self, task_id, ok):
+        """タスクの完了 (ok=False は失敗・タイムアウト) を記録する"""
+        with self._lock:
+            name = self._task_engines.pop(task_id, None)
+            if name is None:
+                return
+            stats = self._stats[name]
+            started_at = stats.in_flight.pop(task_id, None)
+            stats.outcomes.append(ok)
+            if ok and started_at is not None:
+                stats.latencies.append(time.time() - started_at)
+
+    def record_submit_failure(self, name, reservation=None):
+        """送信自体に失敗した (タスクが作られなかった)。予約した枠は空ける"""
+        with self._lock:
+            self._release(reservation)
+            self._stats[name].outcomes.append(False)
+
+    def _release(self, reservation):
+        name = self._task_engines.pop(reservation, None)
+        if name is not None:
+            self._stats[name].in_flight.pop(reservation, None)
+
+    def _prune(self, stats):
+        # 完了を確認できないまま (ページの再読み込みなどで) 放置されたタスクは生成中から外す
+        deadline = time.time() - self.in_flight_ttl
+        for task_id, started_at in list(stats.in_flight.items()):
+            if started_at < deadline:
+                del stats.in_flight[task_id]
+                self._task_engines.pop(task_id, None)
+
+    def _expected_latency(self, name):
+        stats = self._stats[name]
+        if stats.latencies:
+            return statistics.median(stats.latencies)
+        return self._engines[name].expected_latency
+
+    def _failure_rate(self, name):
+        outcomes = self._stats[name].outcomes
+        return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+
+    def expected_latency(self, name):
+        with self._lock:
+            return self._expected_latency(name)
+
+    def failure_rate(self, name):
+        with self._lock:
+            return self._failure_rate(name)
+
+    # --- スケジューリング ---
+    def submission_order(self, names):
+        """速く (直近のレイテンシ中央値が小さく) 失敗の少ないエンジンから並べる"""
+        with self._lock:
+            def score(name):
+                return self._expected_latency(name) / max(1.0 - self._failure_rate(name), 0.1)
+            return sorted(names, key=score)
+
+    def available_slots(self, name):
+        with self._lock:
+            stats = self._stats[name]
+            self._prune(stats)
+            return max(self._max_in_flight[name] - len(stats.in_flight), 0)
+
+    def take_ready(self, queued):
+        """送信待ち [(エンジン名, ...), ...] から今送ってよいものを順番に取り出す (queued からは取り除く)
+
+        戻り値は [(予約, 要素), ...]。枠はこの時点で予約するので、並行して呼ばれても上限を超えない。
+        """
+        ready, waiting = [], []
+        with self._lock:
+            now = time.time()
+            for name in set(item[0] for item in queued):
+                self._prune(self._stats[name])
+            for item in queued:
+                stats = self._stats[item[0]]
+                if len(stats.in_flight) < self._max_in_flight[item[0]]:
+                    reservation = ("reserved", next(self._reservation_ids))
+                    stats.in_flight[reservation] = now
+                    self._task_engines[reservation] = item[0]
+                    ready.append((reservation, item))
+                else:
+                    waiting.append(item)
+        queued[:] = waiting
+        return ready
+
+    # --- 管理者向け ---
+    def metrics(self):
+        with self._lock:
+            result = {}
+            for name, stats in self._stats.items():
+                self._prune(stats)
+                latencies = sorted(stats.latencies)
+                result[name] = {
+                    "in_flight": len(stats.in_flight),
+                    "max_in_flight": self._max_in_flight[name],
+                    "submitted": stats.submitted,
+                    "latency_p50": round(self._expected_latency(name), 1),
+                    "latency_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1) if latencies else None,
+                    "failure_rate": round(self._failure_rate(name), 3),
+                    "samples": len(stats.outcomes),
+                }
+            return result
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """プロセス共通のレジストリを取得 (secrets の ENGINE_MAX_IN_FLIGHT でエンジンごとの上限を調整)"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            max_in_flight = {}
+            try:
+                import streamlit as st
+                max_in_flight = {name: int(cap) for name, cap in st.secrets.get("ENGINE_MAX_IN_FLIGHT", {}).items()}
+            except Exception:
+                pass
+            _registry = EngineRegistry(max_in_flight=max_in_flight)
+        return _registry
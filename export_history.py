@@ -0,0 +1,182 @@
+"""ギャラリー履歴を分析用に列指向フォーマットへエクスポートする
+
+使い方:
+    python export_history.py --out-dir export/                   # 前回以降の追加分だけをエクスポート
+    python export_history.py --out-dir export/ --full            # 全件をエクスポートし直す
+    python export_history.py --out-dir export/ --format jsonl    # pyarrow がない環境向け
+
+gallery_data / categorized_images を行範囲ごとにストリーミングで読み出し、
+Parquet (既定) / Arrow IPC / JSONL に書き出します。シート全体をメモリに載せません。
+Parquet / Arrow は実行ごとに <table>/part-<開始行>.<拡張子> を追加し、JSONL は <table>.jsonl に追記します。
+前回エクスポートした最終行は <out-dir>/_export_state.json に保存されます。
+"""
+import argparse
+import json
+import os
+import shutil
+
+import db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+STATE_FILE = "_export_state.json"
+FORMAT_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow", "jsonl": "jsonl"}
+
+
+def load_state(out_dir):
+    path = os.path.join(out_dir, STATE_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def arrow_schema(table):
+    fields = [pa.field(column, pa.string()) for column in db.TABLE_HEADERS[table]]
+    fields.append(pa.field("_row", pa.int64()))
+    return pa.schema(fields)
+
+
+def to_record_batch(chunk, schema):
+    columns = []
+    for field in schema:
+        if field.name == "_row":
+            columns.append(pa.array([int(r["_row"]) for r in chunk], type=pa.int64()))
+        else:
+            columns.append(pa.array([None if r.get(field.name) is None else str(r[field.name]) for r in chunk], type=pa.string()))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+class ChunkWriter:
+    """チャンクを1つずつ書き込むライター (Parquet / Arrow IPC / JSONL)"""
+
+    def __init__(self, out_dir, table, fmt, after_row=0):
+        self.fmt = fmt
+        self.rows = 0
+        # 先頭からのエクスポートでは既存の出力を置き換える
+        self.truncate = after_row == 0
+        # 途中で失敗しても中途半端なファイルを残さないよう、一時ファイルに書いてから成功時だけ反映する
+        if fmt == "jsonl":
+            self.path = os.path.join(out_dir, f"{table}.jsonl")
+            self.tmp_path = self.path + ".tmp"
+            self._file = open(self.tmp_path, "w", encoding="utf-8")
+            return
+        self.table_dir = os.path.join(out_dir, table)
+        os.makedirs(self.table_dir, exist_ok=True)
+        self.path = os.path.join(self.table_dir, f"part-{after_row + 1:010d}.{FORMAT_EXTENSIONS[fmt]}")
+        self.tmp_path = self.path + ".tmp"
+        self.schema = arrow_schema(table)
+        if fmt == "parquet":
+            self._writer = pq.ParquetWriter(self.tmp_path, self.schema, compression="zstd")
+        else:
+            self._sink = pa.OSFile(self.tmp_path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def write(self, chunk):
+        self.rows += len(chunk)
+        if self.fmt == "jsonl":
+            for record in chunk:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self._file.flush()
+            return
+        self._writer.write_batch(to_record_batch(chunk, self.schema))
+
+    def _close_files(self):
+        if self.fmt == "jsonl":
+            self._file.close()
+            return
+        self._writer.close()
+        if self.fmt == "arrow":
+            self._sink.close()
+
+    def close(self):
+        """書き込みを確定する (1行も書いていなければ空のパートは残さない)"""
+        self._close_files()
+        if self.fmt == "jsonl":
+            if self.truncate:
+                os.replace(self.tmp_path, self.path)
+                return
+            # 追記は成功した分だけまとめて行う (失敗後の再実行で同じ行が重複しない)
+            with open(self.tmp_path, "rb") as src, open(self.path, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.tmp_path)
+            return
+        if not self.rows:
+            os.remove(self.tmp_path)
+            return
+        if self.truncate:
+            suffix = "." + FORMAT_EXTENSIONS[self.fmt]
+            for name in os.listdir(self.table_dir):
+                if name.startswith("part-") and name.endswith(suffix):
+                    os.remove(os.path.join(self.table_dir, name))
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """失敗したエクスポートを破棄する (一時ファイルを消し、既存の出力には触れない)"""
+        try:
+            self._close_files()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+def export_table(backend, table, out_dir, fmt, after_row=0, chunk_size=5000):
+    """after_row より後ろの行をエクスポートし、最後に書き出した行番号を返す"""
+    writer = ChunkWriter(out_dir, table, fmt, after_row=after_row)
+    last_row = after_row
+    try:
+        for chunk in backend.iter_row_chunks(table, after_row=after_row, chunk_size=chunk_size):
+            writer.write(chunk)
+            last_row = chunk[-1]["_row"]
+            print(f"  {table}: {writer.rows} rows")
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    print(f"[done] {table}: {writer.rows} rows -> {writer.path if writer.rows else '(no new rows)'}")
+    return last_row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ギャラリー履歴の分析用エクスポート")
+    parser.add_argument("--out-dir", default="export")
+    parser.add_argument("--format", choices=list(FORMAT_EXTENSIONS), default="parquet" if pa else "jsonl")
+    parser.add_argument("--tables", default=",".join(db.TABLE_HEADERS), help="対象テーブル (カンマ区切り)")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="1回に読み出す行数")
+    parser.add_argument("--full", action="store_true", help="前回の位置を無視して全件をエクスポートする")
+    parser.add_argument("--backend", default=None, help="sheets / sqlite (省略時は secrets の DB_BACKEND)")
+    args = parser.parse_args()
+
+    if args.format != "jsonl" and pa is None:
+        parser.error("Parquet / Arrow 形式には pyarrow が必要です (--format jsonl を使用してください)")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    backend = db.create_backend(args.backend)
+    state = load_state(args.out_dir)
+    state_key = f"{backend.name}:{args.format}"
+    if args.full:
+        state[state_key] = {}
+    positions = state.setdefault(state_key, {})
+
+    for table in args.tables.split(","):
+        positions[table] = export_table(
+            backend, table, args.out_dir, args.format,
+            after_row=positions.get(table, 0), chunk_size=args.chunk_size,
+        )
+        save_state(args.out_dir, state)
+
+
+if __name__ == "__main__":
+    main()
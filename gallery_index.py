@@ -0,0 +1,158 @@
+"""生成結果ギャラリーの近似重複インデックス
+
+使い方:
+    python gallery_index.py                      # 前回以降に追加された画像のハッシュを計算する
+    python gallery_index.py --full               # 全件を計算し直す
+    python gallery_index.py --similar 123        # 行 123 に似た生成結果を表示する
+    python gallery_index.py --groups             # 重複グループの一覧を表示する
+
+gallery_data の画像を取得して dHash を計算し、行番号 (_row) をキーに
+data/gallery_hashes.npz に保存します。アプリはこのインデックスを読むだけで、
+表示中にハッシュの計算や画像の取得はしません。
+"""
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import db
+import image_hash
+
+DEFAULT_INDEX_PATH = "data/gallery_hashes.npz"
+# dHash のハミング距離がこれ以下なら同じ画像 (別エンジンの同じ入力・再生成) とみなす
+DUPLICATE_DISTANCE = 6
+SIMILAR_DISTANCE = 12
+FETCH_TIMEOUT = 30
+
+
+class GalleryIndex:
+    """行番号 → dHash のインデックス (最後に取り込んだ行番号も保存する)"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.state_path = os.path.splitext(path)[0] + ".json"
+        self.last_row = 0
+        self.index = image_hash.HashIndex()
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        """ファイルが更新されていれば読み直す"""
+        if not os.path.exists(self.path):
+            return
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return
+        self.index = image_hash.HashIndex.load(self.path)
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                self.last_row = json.load(f).get("last_row", 0)
+        self._mtime = mtime
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.index.save(self.path)
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump({"last_row": self.last_row}, f)
+        self._mtime = os.path.getmtime(self.path)
+
+    def collapse_duplicates(self, records, max_distance=DUPLICATE_DISTANCE):
+        """ページ内の近似重複をまとめ、[(代表レコード, 重複件数), ...] を返す
+
+        ハッシュ未計算の行はそのまま残す。
+        """
+        kept = []  # [(record, hash, count)]
+        for record in records:
+            value = self.index.get(record.get("_row"))
+            if value is not None:
+                for i, (_, kept_value, count) in enumerate(kept):
+                    if kept_value is not None and image_hash.hamming_distance(value, kept_value) <= max_distance:
+                        kept[i] = (kept[i][0], kept_value, count + 1)
+                        break
+                else:
+                    kept.append((record, value, 1))
+            else:
+                kept.append((record, None, 1))
+        return [(record, count) for record, _, count in kept]
+
+    def similar(self, row, max_distance=SIMILAR_DISTANCE, limit=20):
+        """row に似た行を近い順に [(行番号, 距離), ...] で返す"""
+        value = self.index.get(row)
+        if value is None:
+            return []
+        return [(key, d) for key, d in self.index.query(value, max_distance, limit=limit + 1) if key != row][:limit]
+
+
+def _fetch_dhash(url):
+    try:
+        response = requests.get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return image_hash.dhash(response.content)
+    except Exception:
+        return None
+
+
+def update_index(gallery_index, backend, chunk_size=500, max_workers=8):
+    """last_row より後ろの画像を取得してハッシュを追加し、追加件数を返す"""
+    added = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for chunk in backend.iter_row_chunks("gallery_data", after_row=gallery_index.last_row, chunk_size=chunk_size):
+            images = [r for r in chunk if r.get("image_url") and not db.is_video_url(r["image_url"])]
+            for record, value in zip(images, pool.map(_fetch_dhash, [r["image_url"] for r in images])):
+                if value is not None:
+                    gallery_index.index.add(int(record["_row"]), value)
+                    added += 1
+            gallery_index.last_row = int(chunk[-1]["_row"])
+            gallery_index.save()
+            print(f"  rows <= {gallery_index.last_row}: {len(gallery_index.index)} hashes")
+    return added
+
+
+_gallery_index = None
+_gallery_index_lock = threading.Lock()
+
+
+def get_gallery_index():
+    """プロセス共通のインデックスを取得 (ファイルが更新されていれば読み直す)"""
+    global _gallery_index
+    with _gallery_index_lock:
+        if _gallery_index is None:
+            _gallery_index = GalleryIndex()
+        else:
+            _gallery_index.reload()
+        return _gallery_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成結果ギャラリーの近似重複インデックス")
+    parser.add_argument("--path", default=DEFAULT_INDEX_PATH)
+    parser.add_argument("--full", action="store_true", help="全件を計算し直す")
+    parser.add_argument("--similar", type=int, metavar="ROW", help="指定した行に似た生成結果を表示する")
+    parser.add_argument("--groups", action="store_true", help="重複グループの一覧を表示する")
+    parser.add_argument("--max-distance", type=int, default=None)
+    parser.add_argument("--backend", default=None, help="sheets / sqlite (省略時は secrets の DB_BACKEND)")
+    args = parser.parse_args()
+
+    gallery_index = GalleryIndex(args.path)
+    if args.similar is not None:
+        for row, distance in gallery_index.similar(args.similar, args.max_distance or SIMILAR_DISTANCE):
+            print(f"row {row}: distance {distance}")
+        return
+    if args.groups:
+        for group in gallery_index.index.duplicate_groups(args.max_distance or DUPLICATE_DISTANCE):
+            print(" ".join(str(row) for row in sorted(group)))
+        return
+
+    if args.full:
+        gallery_index.index = image_hash.HashIndex()
+        gallery_index.last_row = 0
+    added = update_index(gallery_index, db.create_backend(args.backend))
+    print(f"[done] added {added} hashes ({len(gallery_index.index)} total)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import streamlit as st
+
+import categorization_cache
+
+GEMINI_MODEL = 'gemini-flash-latest'
+
+CATEGORIES = ["リビング", "ダイニング", "キッチン", "寝室", "バスルーム", "玄関", "外観", "庭", "その他"]
+
+CATEGORIZE_PROMPT = """
+この画像を解析し、以下のカテゴリのいずれか1つに分類してください:
+[リビング, ダイニング, キッチン, 寝室, バスルーム, 玄関, 外観, 庭, その他]
+
+また、画像の内容を短い日本語で説明してください（最大20文字）。
+
+結果を以下のJSON形式で返してください:
+{
+    "category": "カテゴリ名",
+    "description": "短い説明"
+}
+"""
+
+@dataclass
+class CategorizationResult:
+    """分類結果 (失敗時は category が None で error に内容が入る)"""
+    category: Optional[str] = None
+    description: str = ""
+    error: Optional[str] = None
+    cached: bool = False
+    attempts: int = 0
+
+    @property
+    def ok(self):
+        return self.category is not None and self.error is None
+
+    def to_dict(self):
+        return asdict(self)
+
+def parse_json_text(text):
+    """レスポンスからJSON部分を抽出する (Markdownのコードブロックを除去)"""
+    if "```json" in text:
+        text = text.split("```json")[1].split("```")[0]
+    elif "```" in text:
+        text = text.split("```")[1].split("```")[0]
+    return json.loads(text)
+
+# 1リクエストにまとめる画像の枚数
+BATCH_SIZE = 8
+# まとめたリクエストがクォータ超過・一時的なエラーのときの再試行
+BATCH_MAX_RETRIES = 4
+BATCH_BASE_DELAY = 2.0
+BATCH_MAX_DELAY = 60.0
+
+BATCH_PROMPT = """
+以下の {count} 枚の画像をそれぞれ解析し、各画像を次のカテゴリのいずれか1つに分類してください:
+[リビング, ダイニング, キッチン, 寝室, バスルーム, 玄関, 外観, 庭, その他]
+
+また、各画像の内容を短い日本語で説明してください（最大20文字）。
+各画像の直前に「画像 番号」と記載しています。結果は画像ごとに index にその番号を入れ、
+JSON配列で返してください。
+"""
+
+# バッチ分類のレスポンススキーマ (画像ごとに index / category / description)
+BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer"},
+            "category": {"type": "string", "enum": CATEGORIES},
+            "description": {"type": "string"},
+        },
+        "required": ["index", "category", "description"],
+    },
+}
+
+def get_api_key():
+    """Gemini APIキーを secrets の GEMINI_API_KEY、なければ環境変数から取得 (ヘッドレス実行用)"""
+    try:
+        if "GEMINI_API_KEY" in st.secrets:
+            return st.secrets["GEMINI_API_KEY"]
+    except Exception:
+        pass
+    return os.environ.get("GEMINI_API_KEY")
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model(api_key):
+    """APIキーごとに設定済みのモデルを1つだけ生成して使い回す"""
+    with _models_lock:
+        model = _models.get(api_key)
+        if model is None:
+            # SDK の読み込みは重い (0.5秒程度) ので、分類を使うときに初めて import する
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(GEMINI_MODEL)
+            _models[api_key] = model
+        return model
+
+def _result_from_json(data, attempts=1):
+    """{"category", "description"} を CategorizationResult にする"""
+    if not isinstance(data, dict) or not data.get("category"):
+        return CategorizationResult(error=f"Unexpected response: {data!r}", attempts=attempts)
+    return CategorizationResult(category=data["category"], description=data.get("description", ""), attempts=attempts)
+
+def categorize_image(image_bytes, api_key, mime_type="image/jpeg"):
+    """Geminiで画像を分類する (CategorizationResult を返す)"""
+    try:
+        model = get_model(api_key)
+
+        image_part = {"mime_type": mime_type, "data": image_bytes}
+        response = model.generate_content([CATEGORIZE_PROMPT, image_part])
+        return _result_from_json(parse_json_text(response.text))
+    except Exception as e:
+        return CategorizationResult(error=str(e), attempts=1)
+
+def categorize_image_cached(image_bytes, api_key, mime_type="image/jpeg", cache=None, key=None):
+    """内容ハッシュのキャッシュを確認してから分類する (key: Driveの md5Checksum など)"""
+    cache = cache or categorization_cache.get_cache()
+    cached = cache.lookup(image_bytes, key=key)
+    if cached:
+        return CategorizationResult(category=cached["category"], description=cached["description"], cached=True)
+    result = categorize_image(image_bytes, api_key, mime_type=mime_type)
+    cache.store(result, image_bytes, key=key)
+    return result
+
+def _categorize_batch_request(model, batch):
+    """batch ([(key, bytes, mime_type), ...]) を1リクエストで分類し、{番号: 結果} を返す"""
+    import google.generativeai as genai
+    contents = [BATCH_PROMPT.format(count=len(batch))]
+    for i, (_, image_bytes, mime_type) in enumerate(batch):
+        contents.append(f"画像 {i}")
+        contents.append({"mime_type": mime_type, "data": image_bytes})
+    response = model.generate_content(
+        contents,
+        generation_config=genai.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=BATCH_RESPONSE_SCHEMA,
+        ),
+    )
+    parsed = {}
+    try:
+        items = parse_json_text(response.text)
+    except ValueError:
+        return parsed  # 解釈できないレスポンスは全件を1枚ずつ分類し直す
+    if not isinstance(items, list):
+        return parsed
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            index = int(item["index"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < len(batch) and item.get("category") in CATEGORIES and index not in parsed:
+            parsed[index] = CategorizationResult(category=item["category"], description=item.get("description", ""), attempts=1)
+    return parsed
+
+def _request_batch_with_retry(model, batch, retryable, max_retries=BATCH_MAX_RETRIES):
+    """クォータ超過・一時的なエラーはジッター付き指数バックオフでまとめたまま再試行する"""
+    for attempt in range(1, max_retries + 2):
+        try:
+            return _categorize_batch_request(model, batch), attempt
+        except retryable:
+            if attempt > max_retries:
+                raise
+            time.sleep(random.uniform(0, min(BATCH_MAX_DELAY, BATCH_BASE_DELAY * 2 ** attempt)))
+
+def categorize_images_batch(images, api_key, batch_size=BATCH_SIZE, cache=None):
+    """複数の画像を batch_size 枚ずつ1リクエストにまとめて分類する
+
+    images: [(key, image_bytes, mime_type), ...]
+    戻り値: {key: CategorizationResult}
+    レスポンスに含まれなかった (解釈できなかった) 画像だけ1枚ずつ categorize_image で分類し直す。
+    リクエスト自体が失敗したときは1枚ずつに分けず (クォータ超過を悪化させないため)、まとめてエラーにする。
+    cache を渡すと、キャッシュ済みの画像はリクエストに含めず、新しい結果はキャッシュに保存する。
+    """
+    model = get_model(api_key)
+    results = {}
+    if cache is not None:
+        uncached = []
+        for key, image_bytes, mime_type in images:
+            cached = cache.lookup(image_bytes)
+            if cached:
+                results[key] = CategorizationResult(category=cached["category"], description=cached["description"], cached=True)
+            else:
+                uncached.append((key, image_bytes, mime_type))
+        images = uncached
+    images = list(images)
+    retryable, _ = retryable_errors()
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        try:
+            parsed, attempts = _request_batch_with_retry(model, batch, retryable)
+        except Exception as e:
+            attempts = BATCH_MAX_RETRIES + 1 if isinstance(e, retryable) else 1
+            for key, _, _ in batch:
+                results[key] = CategorizationResult(error=f"{type(e).__name__}: {e}", attempts=attempts)
+            continue
+        for i, (key, image_bytes, mime_type) in enumerate(batch):
+            if i in parsed:
+                results[key] = parsed[i]
+                results[key].attempts = attempts
+            else:
+                results[key] = categorize_image(image_bytes, api_key, mime_type=mime_type)
+            if cache is not None:
+                cache.store(results[key], image_bytes)
+    return results
+
+
+# --- 非同期クライアント ---
+def retryable_errors():
+    """(再試行するエラー, クォータ超過のエラー) を返す
+
+    クォータ超過・一時的なエラーはバックオフして再試行する。
+    google.api_core は分類クライアントを作るときに初めて import する。
+    """
+    from google.api_core import exceptions as google_exceptions
+    quota_errors = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)  # 429
+    return quota_errors + (
+        google_exceptions.ServiceUnavailable,   # 503
+        google_exceptions.InternalServerError,  # 500
+        google_exceptions.DeadlineExceeded,
+        asyncio.TimeoutError,
+    ), quota_errors
+
+class AsyncCategorizer:
+    """asyncio ベースの分類クライアント
+
+    - 同時に実行するリクエスト数を max_concurrency に制限する
+    - 429/5xx/タイムアウトはジッター付き指数バックオフで最大 max_retries 回再試行する
+    - 1リクエストごとに deadline 秒の期限を設ける
+    - 結果は常に CategorizationResult (エラーで結果を失わない)
+    """
+
+    def __init__(self, api_key, max_concurrency=16, max_retries=6, deadline=60.0, base_delay=1.0, max_delay=60.0):
+        self.model = get_model(api_key)
+        self._retryable, self._quota_errors = retryable_errors()
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = None
+        self.stats = {"requests": 0, "retries": 0, "quota_errors": 0, "succeeded": 0, "failed": 0}
+
+    def _get_semaphore(self):
+        # セマフォは実行中のイベントループ上で作る
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def categorize(self, image_bytes, mime_type="image/jpeg"):
+        """1枚を分類して CategorizationResult を返す"""
+        contents = [CATEGORIZE_PROMPT, {"mime_type": mime_type, "data": image_bytes}]
+        last_error = None
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                async with self._get_semaphore():
+                    self.stats["requests"] += 1
+                    response = await asyncio.wait_for(
+                        self.model.generate_content_async(contents, request_options={"timeout": self.deadline}),
+                        timeout=self.deadline,
+                    )
+                result = _result_from_json(parse_json_text(response.text), attempts=attempt)
+                self.stats["succeeded" if result.ok else "failed"] += 1
+                return result
+            except self._retryable as e:
+                last_error = e
+                if isinstance(e, self._quota_errors):
+                    self.stats["quota_errors"] += 1
+                if attempt > self.max_retries:
+                    break
+                self.stats["retries"] += 1
+                # Full jitter: 0 〜 min(max_delay, base * 2^n) のランダムな待ち時間
+                await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            except Exception as e:
+                self.stats["failed"] += 1
+                return CategorizationResult(error=str(e), attempts=attempt)
+        self.stats["failed"] += 1
+        return CategorizationResult(error=f"{type(last_error).__name__}: {last_error}", attempts=self.max_retries + 1)
+
+    async def categorize_many(self, images):
+        """[(key, image_bytes, mime_type), ...] を並行して分類し、完了した順に (key, result) を返す"""
+        async def run(key, image_bytes, mime_type):
+            return key, await self.categorize(image_bytes, mime_type)
+
+        tasks = [asyncio.ensure_future(run(*item)) for item in images]
+        for future in asyncio.as_completed(tasks):
+            yield await future
@@ -0,0 +1,182 @@
+import io
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8  # 8x8 = 64bit
+PHASH_SCALE = 4  # pHash は 32x32 に縮小してから DCT をとる
+
+
+def _gray_pixels(image_bytes, width, height):
+    """縮小したグレースケール画像を float32 の配列 (height, width) で返す"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (width * 4, height * 4))
+        small = image.convert("L").resize((width, height), Image.LANCZOS)
+    return np.asarray(small, dtype=np.float32)
+
+
+def _bits_to_int(bits):
+    """bool配列 (先頭が最上位ビット) を整数にする"""
+    value = 0
+    for byte in np.packbits(bits.ravel()):
+        value = (value << 8) | int(byte)
+    return value
+
+
+def dhash(image_bytes, hash_size=HASH_SIZE):
+    """差分ハッシュ (dHash) を64bit整数で返す
+
+    縮小したグレースケール画像の隣り合う画素の明暗だけを見るため、
+    リサイズや再圧縮されたコピーでもほぼ同じ値になる。
+    """
+    pixels = _gray_pixels(image_bytes, hash_size + 1, hash_size)
+    return _bits_to_int(pixels[:, :-1] > pixels[:, 1:])
+
+
+def _dct_matrix(n):
+    """DCT-II の変換行列"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def phash(image_bytes, hash_size=HASH_SIZE):
+    """DCTベースの知覚ハッシュ (pHash) を64bit整数で返す
+
+    低周波成分が中央値より大きいかどうかを見るため、dHash より色調補正や
+    軽い加工に強い。
+    """
+    size = hash_size * PHASH_SCALE
+    pixels = _gray_pixels(image_bytes, size, size)
+    dct = _dct_matrix(size)
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    # 直流成分は明るさだけを表すので中央値の計算から除く
+    median = np.median(low.ravel()[1:])
+    return _bits_to_int(low > median)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(values):
+        return np.bitwise_count(values)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distances(hashes, value):
+    """uint64 配列の各要素と value とのハミング距離をまとめて計算する"""
+    return _popcount(np.bitwise_xor(hashes, np.uint64(value)))
+
+
+class HashIndex:
+    """64bitハッシュの近傍検索用インデックス
+
+    ハッシュを uint64 の連続した配列で持ち、ハミング距離の計算をベクトル化する
+    (10万件に対する1回の検索が数ミリ秒)。キーは任意のハッシュ可能な値。
+    """
+
+    def __init__(self, capacity=1024):
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._keys = []
+        self._positions = {}  # key -> 配列上の位置
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get(self, key):
+        with self._lock:
+            position = self._positions.get(key)
+            return int(self._hashes[position]) if position is not None else None
+
+    def add(self, key, value):
+        """ハッシュを登録する (同じキーがあれば置き換える)"""
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = len(self._keys)
+                if position == len(self._hashes):
+                    self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), dtype=np.uint64)])
+                self._keys.append(key)
+                self._positions[key] = position
+            self._hashes[position] = np.uint64(value)
+
+    def remove(self, key):
+        """登録を削除する (末尾の要素で穴を埋める)"""
+        with self._lock:
+            position = self._positions.pop(key, None)
+            if position is None:
+                return
+            last = len(self._keys) - 1
+            if position != last:
+                last_key = self._keys[last]
+                self._keys[position] = last_key
+                self._hashes[position] = self._hashes[last]
+                self._positions[last_key] = position
+            self._keys.pop()
+
+    def query(self, value, max_distance, limit=None):
+        """距離が max_distance 以下のキーを近い順に [(key, 距離), ...] で返す"""
+        with self._lock:
+            count = len(self._keys)
+            if not count:
+                return []
+            distances = hamming_distances(self._hashes[:count], value)
+            matches = np.flatnonzero(distances <= max_distance)
+            if limit is not None and len(matches) > limit:
+                matches = matches[np.argpartition(distances[matches], limit - 1)[:limit]]
+            matches = matches[np.argsort(distances[matches], kind="stable")]
+            return [(self._keys[i], int(distances[i])) for i in matches]
+
+    def nearest(self, value, max_distance):
+        """最も近いキーと距離を返す (max_distance 以内になければ None)"""
+        found = self.query(value, max_distance, limit=1)
+        return found[0] if found else None
+
+    def duplicate_groups(self, max_distance):
+        """互いに max_distance 以内のキーをまとめたグループ (2件以上のもの) を返す"""
+        with self._lock:
+            keys = list(self._keys)
+            hashes = self._hashes[:len(keys)].copy()
+        assigned = np.zeros(len(keys), dtype=bool)
+        groups = []
+        for i in range(len(keys)):
+            if assigned[i]:
+                continue
+            members = np.flatnonzero((hamming_distances(hashes, hashes[i]) <= max_distance) & ~assigned)
+            assigned[members] = True
+            if len(members) > 1:
+                groups.append([keys[j] for j in members])
+        return groups
+
+    def save(self, path):
+        """npz 形式で保存する (一時ファイルに書いてから置き換える)"""
+        with self._lock:
+            keys = np.array(self._keys)
+            hashes = self._hashes[:len(self._keys)].copy()
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, keys=keys, hashes=hashes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            keys, hashes = data["keys"].tolist(), data["hashes"]
+        index = cls(capacity=max(1024, len(keys)))
+        index._hashes[:len(keys)] = hashes
+        index._keys = keys
+        index._positions = {key: i for i, key in enumerate(keys)}
+        return index
@@ -0,0 +1,294 @@
+"""画像生成 (createTask) のタスクをバックグラウンドで追跡する
+
+- 1回の「パースを生成する」を ImageRun とし、送信・webhook.site での完了確認・ギャラリー (DB) への保存を
+  バックグラウンドスレッドで行う (スクリプトが途中で終わってもタスクは最後まで追跡される)
+- エンジンごとの同時実行数は engines.EngineRegistry に従い、空きができたら送信待ちを送る
+- first_n を指定した実行は、成功が first_n 件そろった時点で「そろった」とみなす (残りは追跡を続ける)
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import engines
+
+CREATE_TASK_URL = "https://api.kie.ai/api/v1/jobs/createTask"
+WEBHOOK_REQUESTS_URL = "https://webhook.site/token/{uuid}/requests"
+
+POLL_INTERVAL = 3        # webhook.site を確認する間隔 (秒)
+TASK_TIMEOUT = 300       # 送信から5分 (送信待ちは実行開始から5分) でタイムアウト
+POLL_WORKERS = 4
+FINISHED_RUN_TTL = 3600  # 終了した実行を一覧に残す時間 (秒)
+
+# タスクの状態
+STATUS_QUEUED = "queued"    # 送信待ち (エンジンの同時実行数の上限に達している)
+STATUS_PENDING = "pending"  # 生成中
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_PENDING)
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTask:
+    """1エンジン × 1入力画像のタスク (送信前は task_id が None)"""
+
+    def __init__(self, engine, label, payload):
+        self.engine = engine
+        self.label = label
+        self.payload = payload
+        self.task_id = None
+        self.status = STATUS_QUEUED
+        self.result_url = None
+        self.error = None
+        self.submitted_at = None
+        self.finished_at = None
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+
+class ImageRun:
+    """1回の生成の実行 (複数エンジン・複数画像のタスクをまとめたもの)"""
+
+    def __init__(self, session_id, api_key, webhook_uuid, prompt, tasks, first_n=None):
+        self.run_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.api_key = api_key
+        self.webhook_uuid = webhook_uuid
+        self.prompt = prompt
+        self.tasks = tasks
+        self.first_n = first_n
+        self.created_at = time.time()
+        self.satisfied_at = None  # 必要な件数がそろった (またはすべて終わった) 時刻
+        self.last_polled_at = None
+
+    @property
+    def active(self):
+        return any(task.active for task in self.tasks)
+
+    @property
+    def successes(self):
+        """成功したタスク (完了した順)"""
+        return sorted((task for task in self.tasks if task.status == STATUS_SUCCESS), key=lambda task: task.finished_at)
+
+    @property
+    def satisfied(self):
+        """必要な結果がそろったか (first_n 件の成功、または全タスクの終了)"""
+        return not self.active or (self.first_n is not None and len(self.successes) >= self.first_n)
+
+
+class ImageJobManager:
+    """画像生成の実行をプロセス共通で管理する
+
+    - start_run() はタスクをキューに入れてすぐに戻る (送信もバックグラウンドで行う)
+    - 1本のバックグラウンドスレッドが全セッションの実行を POLL_INTERVAL ごとに確認する
+    - 成功したタスクはギャラリー (DB) に保存し、エンジンのレジストリに結果を記録する
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL, timeout=TASK_TIMEOUT, poll_workers=POLL_WORKERS, registry=None):
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.registry = registry or engines.get_registry()
+        self._runs = {}  # run_id -> ImageRun
+        self._in_flight = set()  # 処理中の run_id
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="image-poll")
+        self._stats = {"runs": 0, "submitted": 0, "submit_errors": 0, "polls": 0, "poll_errors": 0,
+                       STATUS_SUCCESS: 0, STATUS_FAILED: 0, STATUS_TIMEOUT: 0, "finished_early": 0}
+        threading.Thread(target=self._poll_loop, name="image-poller", daemon=True).start()
+
+    # --- 投入 ---
+    def start_run(self, session_id, api_key, webhook_uuid, prompt, queued, first_n=None):
+        """[(エンジン名, 表示名, payload), ...] を送信順に並べたものから実行を作り、ImageRun を返す"""
+        tasks = [ImageTask(engine, label, payload) for engine, label, payload in queued]
+        run = ImageRun(session_id, api_key, webhook_uuid, prompt, tasks, first_n=first_n)
+        with self._lock:
+            self._runs[run.run_id] = run
+            self._stats["runs"] += 1
+        self._wakeup.set()
+        return run
+
+    # --- 参照 ---
+    def get_run(self, run_id):
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def runs_for(self, session_id):
+        """セッションの実行を新しい順に返す"""
+        with self._lock:
+            runs = [run for run in self._runs.values() if run.session_id == session_id]
+        return sorted(runs, key=lambda run: run.created_at, reverse=True)
+
+    def has_active_runs(self, session_id):
+        return any(run.active for run in self.runs_for(session_id))
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active_runs"] = sum(run.active for run in self._runs.values())
+            stats["active_tasks"] = sum(task.active for run in self._runs.values() for task in run.tasks)
+        return stats
+
+    # --- バックグラウンドの処理 ---
+    def _poll_loop(self):
+        while True:
+            self._wakeup.wait(timeout=self.poll_interval)
+            self._wakeup.clear()
+            now = time.time()
+            with self._lock:
+                due = [
+                    run for run in self._runs.values()
+                    if run.active and run.run_id not in self._in_flight
+                    and (run.last_polled_at is None or now - run.last_polled_at >= self.poll_interval)
+                ]
+                for run in due:
+                    run.last_polled_at = now
+                    self._in_flight.add(run.run_id)
+                # 終了から時間のたった実行は片付ける
+                for run_id, run in list(self._runs.items()):
+                    if not run.active and now - max(task.finished_at or 0 for task in run.tasks) > FINISHED_RUN_TTL:
+                        del self._runs[run_id]
+            for run in due:
+                self._pool.submit(self._process_run, run)
+
+    def _process_run(self, run):
+        try:
+            self._expire(run)
+            self._send_ready(run)
+            if any(task.status == STATUS_PENDING for task in run.tasks):
+                self._check_webhook(run)
+            if run.satisfied_at is None and run.satisfied:
+                run.satisfied_at = time.time()
+                if run.active:
+                    with self._lock:
+                        self._stats["finished_early"] += 1
+        except Exception as e:
+            with self._lock:
+                self._stats["poll_errors"] += 1
+            logger.warning("Image run error (%s): %s", run.run_id, e)
+        finally:
+            with self._lock:
+                self._in_flight.discard(run.run_id)
+
+    def _expire(self, run):
+        now = time.time()
+        for task in run.tasks:
+            if task.status == STATUS_PENDING and now - task.submitted_at > self.timeout:
+                self.registry.finish(task.task_id, ok=False)
+                self._finish(task, STATUS_TIMEOUT, error="タイムアウトしました。")
+            elif task.status == STATUS_QUEUED and now - run.created_at > self.timeout:
+                self._finish(task, STATUS_TIMEOUT, error="送信待ちのままタイムアウトしました。")
+
+    def _send_ready(self, run):
+        """エンジンごとの同時実行数に空きがある分だけ送信待ちを送る"""
+        import requests  # バックグラウンドスレッドで初めて使うときに読み込む (起動時間の短縮)
+        queued = [(task.engine, task) for task in run.tasks if task.status == STATUS_QUEUED]
+        if not queued:
+            return
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {run.api_key}"}
+        for reservation, (_, task) in self.registry.take_ready(queued):
+            try:
+                res = requests.post(CREATE_TASK_URL, headers=headers, data=json.dumps(task.payload), timeout=60)
+                if res.status_code != 200:
+                    raise RuntimeError(f"APIエラー: {res.status_code}")
+                r_data = res.json()
+                if r_data.get("code") != 200:
+                    raise RuntimeError(f"開始エラー: {r_data.get('msg')}")
+                task_id = r_data["data"]["taskId"]
+            except Exception as e:
+                self.registry.record_submit_failure(task.engine, reservation)
+                with self._lock:
+                    self._stats["submit_errors"] += 1
+                self._finish(task, STATUS_FAILED, error=str(e))
+                continue
+            self.registry.start(task.engine, task_id, reservation)
+            with self._lock:
+                task.task_id = task_id
+                task.submitted_at = time.time()
+                task.status = STATUS_PENDING
+                self._stats["submitted"] += 1
+
+    def _check_webhook(self, run):
+        """webhook.site に届いたコールバックから完了したタスクを探す"""
+        import requests
+        res = requests.get(WEBHOOK_REQUESTS_URL.format(uuid=run.webhook_uuid), timeout=10)
+        with self._lock:
+            self._stats["polls"] += 1
+        if res.status_code != 200:
+            return
+        pending = {task.task_id: task for task in run.tasks if task.status == STATUS_PENDING}
+        for req in res.json().get("data", []):
+            content = req.get("content")
+            if not content:
+                continue
+            try:
+                data_body = json.loads(content).get("data", {})
+            except (ValueError, AttributeError):
+                continue
+            task = pending.pop(data_body.get("taskId"), None)
+            if task is None:
+                continue
+            # 壊れたコールバックが1件あっても、他のタスクの確認は続ける (そのタスクだけ失敗にする)
+            try:
+                self._handle_callback(run, task, data_body)
+            except Exception as e:
+                if task.status == STATUS_PENDING:
+                    self.registry.finish(task.task_id, ok=False)
+                    self._finish(task, STATUS_FAILED, error=f"結果の処理に失敗しました: {e}")
+
+    def _handle_callback(self, run, task, data_body):
+        state = data_body.get("state")
+        if state == "success":
+            res_url = parse_result_url(data_body)
+            if res_url:
+                self.registry.finish(task.task_id, ok=True)
+                task.result_url = res_url
+                self._finish(task, STATUS_SUCCESS)
+                # ギャラリーに保存
+                db.save_result(res_url, run.prompt, task.label)
+            else:
+                raise ValueError("結果のURLがありません")
+        elif state == "fail":
+            self.registry.finish(task.task_id, ok=False)
+            self._finish(task, STATUS_FAILED, error=data_body.get("msg"))
+
+    def _finish(self, task, status, error=None):
+        with self._lock:
+            task.status = status
+            task.error = error
+            task.finished_at = time.time()
+            self._stats[status] += 1
+
+
+def parse_result_url(data_body):
+    """コールバックの data から結果画像のURLを取り出す"""
+    if data_body.get("resultUrls"):
+        return data_body["resultUrls"][0]
+    if "resultJson" in data_body:
+        try:
+            result_json = json.loads(data_body["resultJson"])
+        except (TypeError, ValueError):
+            return None
+        if isinstance(result_json, dict) and result_json.get("resultUrls"):
+            return result_json["resultUrls"][0]
+    return None
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """プロセス共通のジョブマネージャーを取得"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ImageJobManager()
+        return _manager
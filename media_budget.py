@@ -0,0 +1,179 @@
+"""プロセス全体のメディア (生成した動画) のディスク使用量の上限管理
+
+- 動画はセッションやプロセスのメモリには持たず、ダウンロード済みのファイルとして登録する
+- ディスク上の上限を超えたら、最後に見られたのが古いものからファイルを消す (URL は残して必要になったら取り直す)
+- 全セッション分をまとめて数えるため、1人のユーザーがサーバーのディスクを使い切ることはない
+- メモリに載るのは「ダウンロード」を押したときに read() で読んだ分だけ
+  (st.download_button が内容ごとに1つ保持する。表示しただけでは読み込まない)
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_DISK_BUDGET_MB = 4096
+SPOOL_DIR = "data/media_spool"
+REFETCH_TIMEOUT = (10, 120)
+
+
+class _Entry:
+    __slots__ = ("key", "url", "path", "disk_size", "session_id", "last_viewed")
+
+    def __init__(self, key, url=None, session_id=None):
+        self.key = key
+        self.url = url
+        self.path = None   # ディスク上のファイル
+        self.disk_size = 0
+        self.session_id = session_id
+        self.last_viewed = time.time()
+
+
+class MediaBudget:
+    def __init__(self, disk_budget=DEFAULT_DISK_BUDGET_MB * 1024 * 1024, spool_dir=SPOOL_DIR):
+        self.disk_budget = disk_budget
+        self.spool_dir = spool_dir
+        self._entries = OrderedDict()  # key -> _Entry (最後に見られた順)
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"disk_hits": 0, "refetches": 0, "dropped": 0}
+
+    # --- 登録 ---
+    def register_file(self, key, path, url=None, session_id=None):
+        """ディスク上のファイル (ダウンロード済みの動画など) を登録する"""
+        with self._lock:
+            entry = self._entry(key, url, session_id)
+            if entry.path != path:
+                self._set_path(entry, path)
+            self._enforce()
+
+    def touch(self, key):
+        """表示されたことを記録する (LRU の順番を更新)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_viewed = time.time()
+                self._entries.move_to_end(key)
+
+    def has(self, key):
+        with self._lock:
+            return key in self._entries
+
+    # --- 取得 ---
+    def read(self, key):
+        """内容をバイト列で返す (ディスク → URL から取り直し の順に探す。st.download_button に遅延で渡す用)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.last_viewed = time.time()
+            self._entries.move_to_end(key)
+            # _enforce() が同時にファイルを消さないよう、読み終わるまでロックを持つ
+            if entry.path:
+                try:
+                    with open(entry.path, "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    self._set_path(entry, None, 0)
+                else:
+                    self._stats["disk_hits"] += 1
+                    return data
+            url = entry.url
+        if not url:
+            return None
+        # 取り直したものはメモリではなく spool に書いてから読む
+        import requests  # 取り直しはまれなので、必要になったときだけ読み込む
+        path = self._spool_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with requests.get(url, timeout=REFETCH_TIMEOUT, stream=True) as res:
+            res.raise_for_status()
+            with open(tmp_path, "wb") as out:
+                for chunk in res.iter_content(chunk_size=1024 * 1024):
+                    out.write(chunk)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._stats["refetches"] += 1
+            with open(path, "rb") as f:
+                data = f.read()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._set_path(entry, path)
+                self._enforce()
+        return data
+
+    # --- 内部処理 (ロックを取った状態で呼ぶ) ---
+    def _entry(self, key, url, session_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(key, url, session_id)
+        else:
+            entry.url = url or entry.url
+            entry.session_id = session_id or entry.session_id
+            entry.last_viewed = time.time()
+            self._entries.move_to_end(key)
+        return entry
+
+    def _set_path(self, entry, path, size=None):
+        self._disk_bytes -= entry.disk_size
+        entry.path = path
+        entry.disk_size = size if size is not None else (os.path.getsize(path) if path and os.path.exists(path) else 0)
+        self._disk_bytes += entry.disk_size
+
+    def _spool_path(self, key):
+        return os.path.join(self.spool_dir, hashlib.md5(str(key).encode("utf-8")).hexdigest())
+
+    def _enforce(self):
+        # 古いものからファイルを消す (URL があれば後で取り直せる)
+        for key, entry in list(self._entries.items()):
+            if self._disk_bytes <= self.disk_budget:
+                break
+            if entry.path is None:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            self._set_path(entry, None, 0)
+            self._stats["dropped"] += 1
+            if not entry.url:
+                del self._entries[key]
+
+    # --- 管理者向け ---
+    def usage(self):
+        """現在の使用量 (ディスク・セッションごと)"""
+        with self._lock:
+            per_session = {}
+            for entry in self._entries.values():
+                if entry.disk_size:
+                    per_session[entry.session_id] = per_session.get(entry.session_id, 0) + entry.disk_size
+            usage = dict(self._stats)
+            usage.update({
+                "entries": len(self._entries),
+                "disk_mb": round(self._disk_bytes / 1024 / 1024, 1),
+                "disk_budget_mb": round(self.disk_budget / 1024 / 1024, 1),
+                "top_sessions_mb": {
+                    str(session_id)[:8]: round(size / 1024 / 1024, 1)
+                    for session_id, size in sorted(per_session.items(), key=lambda item: item[1], reverse=True)[:5]
+                },
+            })
+            return usage
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    """プロセス共通のメディア予算を取得 (secrets の MEDIA_DISK_BUDGET_MB で調整)"""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            disk_mb = DEFAULT_DISK_BUDGET_MB
+            try:
+                import streamlit as st
+                disk_mb = int(st.secrets.get("MEDIA_DISK_BUDGET_MB", disk_mb))
+            except Exception:
+                pass
+            _budget = MediaBudget(disk_mb * 1024 * 1024)
+        return _budget
@@ -0,0 +1,136 @@
+"""動画を多く含むギャラリー用の「クリックで読み込む」タイル
+
+最初はメタデータ (サイズ・形式) とポスター画像だけを表示し、
+「再生」を押したときに初めて st.video でプレーヤーを埋め込む。
+ページを開いただけでは動画本体を取得しない。
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+PROBE_TTL = 3600          # HEAD の結果をキャッシュする時間 (秒)
+PROBE_TIMEOUT = 5
+PROBE_CACHE_SIZE = 2000
+POSTER_DIR = "data/posters"
+POSTER_WIDTH = 480
+POSTER_TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+_probe_cache = {}  # url -> (取得時刻, {"size", "content_type"})
+_probe_lock = threading.Lock()
+
+# ポスター画像の生成には ffmpeg を使う (なければポスターなしで表示)
+FFMPEG = shutil.which("ffmpeg")
+_poster_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="poster")
+_poster_pending = set()
+
+
+def probe(url):
+    """HEAD リクエストでサイズと形式を調べる (結果は PROBE_TTL 秒キャッシュ)"""
+    import requests  # 起動時には読み込まない (動画の一覧を表示するときだけ使う)
+    now = time.time()
+    with _probe_lock:
+        cached = _probe_cache.get(url)
+        if cached and now - cached[0] < PROBE_TTL:
+            return cached[1]
+    info = {"size": None, "content_type": None}
+    try:
+        res = requests.head(url, allow_redirects=True, timeout=PROBE_TIMEOUT)
+        if res.status_code == 200:
+            length = res.headers.get("Content-Length")
+            info = {"size": int(length) if length else None, "content_type": res.headers.get("Content-Type")}
+    except requests.RequestException:
+        pass
+    with _probe_lock:
+        if len(_probe_cache) >= PROBE_CACHE_SIZE:
+            # 古いものから半分を捨てる
+            for old_url, _ in sorted(_probe_cache.items(), key=lambda item: item[1][0])[:PROBE_CACHE_SIZE // 2]:
+                del _probe_cache[old_url]
+        _probe_cache[url] = (now, info)
+    return info
+
+
+def probe_many(urls, max_workers=8):
+    """ページ内の動画をまとめて並列に probe してキャッシュに載せる"""
+    urls = list(dict.fromkeys(urls))
+    if len(urls) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(probe, urls))
+
+
+def format_size(size):
+    if size is None:
+        return "サイズ不明"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def _poster_file(url):
+    return os.path.join(POSTER_DIR, hashlib.md5(url.encode("utf-8")).hexdigest() + ".jpg")
+
+
+def _make_poster(url, path):
+    try:
+        os.makedirs(POSTER_DIR, exist_ok=True)
+        tmp_path = path + ".tmp.jpg"
+        # 先頭付近の1フレームだけを取得する (ffmpeg は必要な範囲だけを読む)
+        subprocess.run(
+            [FFMPEG, "-y", "-loglevel", "error", "-ss", "0.5", "-i", url,
+             "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2", tmp_path],
+            check=True, timeout=POSTER_TIMEOUT,
+        )
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning("Poster generation failed (%s): %s", url, e)
+    finally:
+        with _probe_lock:
+            _poster_pending.discard(url)
+
+
+def poster(url):
+    """キャッシュ済みのポスター画像のパスを返す (なければバックグラウンドで生成を始めて None)"""
+    path = _poster_file(url)
+    if os.path.exists(path):
+        return path
+    if FFMPEG:
+        with _probe_lock:
+            if url in _poster_pending:
+                return None
+            _poster_pending.add(url)
+        _poster_pool.submit(_make_poster, url, path)
+    return None
+
+
+def _load_player(state_key):
+    st.session_state[state_key] = True
+
+
+def render_video_tile(url, key):
+    """動画タイル: 「再生」を押すまでプレーヤーを埋め込まない"""
+    state_key = f"media_tile_{key}"
+    if st.session_state.get(state_key):
+        st.video(url)
+        return
+    poster_path = poster(url)
+    if poster_path:
+        st.image(poster_path, use_container_width=True)
+    else:
+        st.markdown(
+            '<div style="aspect-ratio: 16 / 9; background: #2c3e50; color: #ecf0f1; border-radius: 8px; '
+            'display: flex; align-items: center; justify-content: center; font-size: 2rem;">🎬</div>',
+            unsafe_allow_html=True,
+        )
+    info = probe(url)
+    st.caption(f"{info['content_type'] or '動画'} | {format_size(info['size'])}")
+    st.button("▶ 再生", key=f"{state_key}_btn", on_click=_load_player, args=(state_key,), use_container_width=True)
@@ -0,0 +1,72 @@
+"""Google Sheets のデータをローカルSQLiteへ移行 (エクスポート) するワンショットツール
+
+使い方:
+    python migrate_sheets_to_sqlite.py --sqlite data/app.db [--sheet-key KEY] [--csv-dir export/] [--force]
+
+移行先のテーブルにすでに行がある場合は何もせずに終了します (二重登録を防ぐため)。
+--force を付けると移行先のテーブルを空にしてから移行し直します。
+
+認証情報は .streamlit/secrets.toml の [gcp_service_account] を使用します。
+移行後に secrets で DB_BACKEND = "sqlite" を設定するとアプリがSQLiteを使います。
+"""
+import argparse
+import csv
+import os
+
+import db
+from db_sqlite import SQLiteBackend
+
+CHUNK_ROWS = 5000
+
+
+def migrate(sqlite_path, sheet_key=None, csv_dir=None, force=False):
+    target = SQLiteBackend(sqlite_path)
+    existing = {table: target.count_rows(table) for table in db.TABLE_HEADERS}
+    existing = {table: count for table, count in existing.items() if count}
+    if existing and not force:
+        detail = ", ".join(f"{table}: {count} rows" for table, count in existing.items())
+        raise SystemExit(f"移行先にすでにデータがあります ({detail})。やり直す場合は --force を指定してください。")
+
+    source = db.SheetsBackend(sheet_key=sheet_key)
+    for table, columns in db.TABLE_HEADERS.items():
+        if not source.worksheet(table):
+            print(f"[skip] {table}: シートを開けませんでした")
+            continue
+        if table in existing:
+            target.clear_table(table)
+            print(f"  {table}: 既存の {existing[table]} rows を削除しました (--force)")
+
+        csv_file = None
+        writer = None
+        if csv_dir:
+            os.makedirs(csv_dir, exist_ok=True)
+            csv_file = open(os.path.join(csv_dir, f"{table}.csv"), "w", newline="", encoding="utf-8")
+            writer = csv.writer(csv_file)
+            writer.writerow(columns)
+
+        total = 0
+        try:
+            for chunk in source.iter_row_chunks(table, chunk_size=CHUNK_ROWS):
+                rows = [[record[c] for c in columns] for record in chunk]
+                total += target.import_rows(table, rows)
+                if writer:
+                    writer.writerows(rows)
+                print(f"  {table}: {total} rows")
+        finally:
+            if csv_file:
+                csv_file.close()
+        print(f"[done] {table}: {total} rows -> {sqlite_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Google Sheets -> SQLite 移行ツール")
+    parser.add_argument("--sqlite", default="data/app.db", help="移行先のSQLiteファイル")
+    parser.add_argument("--sheet-key", default=None, help="移行元スプレッドシートのキー (省略時は secrets の SHEET_KEY)")
+    parser.add_argument("--csv-dir", default=None, help="指定するとCSVにもエクスポートする")
+    parser.add_argument("--force", action="store_true", help="移行先のテーブルを空にしてから移行し直す")
+    args = parser.parse_args()
+    migrate(args.sqlite, sheet_key=args.sheet_key, csv_dir=args.csv_dir, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""エンジンごとの入力画像の前処理プロファイル
+
+各エンジンが受け付けるアスペクト比・解像度と、入力画像として使える最大サイズを持ち、
+エンジンごとに「正しい比率に切り抜き、使える以上の画素を送らない」入力画像を作る。
+同じ切り抜き・サイズになるエンジン同士は1枚の画像 (1回のアップロード) を共有する。
+"""
+from collections import namedtuple
+
+RESOLUTION_EDGES = {"1K": 1024, "2K": 2048, "4K": 4096}
+# 送る入力画像の長辺の既定値 (以前の一律のサムネイルと同じ。アップロードの base64 を大きくしない)
+DEFAULT_INPUT_EDGE = 1024
+
+# aspect_ratio / resolution: エンジンに渡すパラメータの値、input_edge: 入力画像の長辺の上限
+Target = namedtuple("Target", ["aspect_ratio", "resolution", "input_edge"])
+
+
+def parse_ratio(aspect_ratio):
+    """ "16:9" → 16/9 """
+    width, height = aspect_ratio.split(":")
+    return int(width) / int(height)
+
+
+class Profile:
+    """1つのエンジンの入力条件
+
+    aspect_ratios: 指定された比率 → エンジンが受け付ける比率 (含まれない比率は default_aspect)
+    resolutions: 指定された解像度 → (エンジンに渡す値, 出力の長辺)
+    max_input_edge: 入力画像として意味のある長辺の上限 (これより大きい画像は送らない)
+    input_edge: 実際に送る入力画像の長辺 (既定は DEFAULT_INPUT_EDGE。より大きな入力が必要なプロファイルだけ指定する)
+    """
+
+    def __init__(self, name, aspect_ratios, resolutions, max_input_edge, default_aspect="1:1",
+                 input_edge=DEFAULT_INPUT_EDGE):
+        self.name = name
+        self.aspect_ratios = aspect_ratios
+        self.resolutions = resolutions
+        self.max_input_edge = max_input_edge
+        self.default_aspect = default_aspect
+        self.input_edge = input_edge
+
+    def target(self, aspect_ratio, resolution="1K"):
+        engine_aspect = self.aspect_ratios.get(aspect_ratio, self.default_aspect)
+        engine_resolution, output_edge = self.resolutions.get(resolution, self.resolutions["1K"])
+        return Target(engine_aspect, engine_resolution, min(output_edge, self.max_input_edge, self.input_edge))
+
+
+_STANDARD_ASPECTS = {ar: ar for ar in ("16:9", "1:1", "9:16", "4:3", "3:4")}
+_STANDARD_RESOLUTIONS = {name: (name, edge) for name, edge in RESOLUTION_EDGES.items()}
+
+PROFILES = {
+    "Nano Banana Pro": Profile("Nano Banana Pro", _STANDARD_ASPECTS, _STANDARD_RESOLUTIONS, max_input_edge=4096),
+    # Flux 2 は 4K 非対応のため 2K に落とす
+    "Flux 2 Flex": Profile(
+        "Flux 2 Flex", dict(_STANDARD_ASPECTS, auto="1:1"),
+        {"1K": ("1K", 1024), "2K": ("2K", 2048), "4K": ("2K", 2048)}, max_input_edge=2048,
+    ),
+    # Seedream は解像度ではなく quality (basic: 2K / high: 4K) で指定する
+    "Seedream 4.5 Edit": Profile(
+        "Seedream 4.5 Edit", _STANDARD_ASPECTS,
+        {"1K": ("basic", 2048), "2K": ("basic", 2048), "4K": ("high", 4096)}, max_input_edge=4096,
+    ),
+    # GPT Image 1.5 は 1:1 / 2:3 / 3:2 のみ (最大 1536px)
+    "GPT Image 1.5": Profile(
+        "GPT Image 1.5",
+        {"16:9": "3:2", "9:16": "2:3", "1:1": "1:1", "4:3": "3:2", "3:4": "2:3"},
+        {"1K": ("medium", 1536), "2K": ("medium", 1536), "4K": ("high", 1536)},
+        max_input_edge=1536, default_aspect="3:2",
+    ),
+    # Veo 3.1 の開始フレーム (出力は最大 1080p。以前は縮小せずに送っていたので 1080p までは送る)
+    "Veo 3.1": Profile("Veo 3.1", _STANDARD_ASPECTS, {"1K": ("1080p", 1920)}, max_input_edge=1920,
+                       default_aspect="16:9", input_edge=1920),
+}
+
+
+def get_profile(engine):
+    return PROFILES[engine]
+
+
+def variant_geometry(image_size, aspect_ratio, max_edge):
+    """中央で aspect_ratio に切り抜く範囲と、縮小後のサイズを返す (拡大はしない)"""
+    width, height = image_size
+    ratio = parse_ratio(aspect_ratio)
+    if width / height > ratio:
+        crop_width, crop_height = round(height * ratio), height
+    else:
+        crop_width, crop_height = width, round(width / ratio)
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    box = (left, top, left + crop_width, top + crop_height)
+    scale = min(1.0, max_edge / max(crop_width, crop_height))
+    return box, (max(1, round(crop_width * scale)), max(1, round(crop_height * scale)))
+
+
+def render_variant(image, box, size):
+    """切り抜き・縮小した画像を返す"""
+    from PIL import Image  # 渡される image が PIL の画像なので、ここでは読み込み済み
+    cropped = image.crop(box)
+    if cropped.size != size:
+        cropped = cropped.resize(size, Image.LANCZOS)
+    return cropped
+
+
+def plan_inputs(image, engines, aspect_ratio, resolution="1K"):
+    """エンジンごとの Target と、共有できる入力画像のバリエーションを作る
+
+    戻り値: (targets {エンジン: Target}, variants {キー: PIL画像}, engine_variants {エンジン: キー})
+    キーは (切り抜き範囲, サイズ) で、同じキーのエンジンは同じ画像を使う。
+    """
+    targets, variants, engine_variants = {}, {}, {}
+    for engine in engines:
+        target = get_profile(engine).target(aspect_ratio, resolution)
+        targets[engine] = target
+        key = variant_geometry(image.size, target.aspect_ratio, target.input_edge)
+        if key not in variants:
+            variants[key] = render_variant(image, *key)
+        engine_variants[engine] = key
+    return targets, variants, engine_variants
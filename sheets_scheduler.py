@@ -0,0 +1,275 @@
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeoutError
+
+# 優先度 (小さいほど先に実行)
+PRIORITY_USER = 0        # 画面表示のための読み込み
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKGROUND = 10 # 保存などのバックグラウンド書き込み
+
+# Sheets API のユーザー単位の既定クォータ (1分あたり)
+DEFAULT_READS_PER_MINUTE = 60
+DEFAULT_WRITES_PER_MINUTE = 60
+
+QUOTA_RETRIES = 5
+
+
+class SheetsQuotaError(Exception):
+    """リトライしてもクォータ超過が解消しなかった"""
+
+
+def is_quota_error(e):
+    """429 / RESOURCE_EXHAUSTED 系のエラーか判定 (メッセージの文字列ではなくステータスで判定する)"""
+    if getattr(getattr(e, "response", None), "status_code", None) == 429:
+        return True
+    # gspread.exceptions.APIError は API のエラー (code / status) を error に持つ
+    error = getattr(e, "error", None)
+    if isinstance(error, dict):
+        return error.get("code") == 429 or error.get("status") == "RESOURCE_EXHAUSTED"
+    return False
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute 回までの呼び出しを許可するトークンバケット"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        """トークンを1つ消費できれば0、できなければ次のトークンまでの秒数を返す"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        """クォータ超過を受けたときにバケットを空にする"""
+        self._refill()
+        self.tokens = 0.0
+
+
+class _Job:
+    __slots__ = ("kind", "fn", "args", "kwargs", "key", "priority", "future", "enqueued_at", "attempts", "not_before")
+
+    def __init__(self, kind, fn, args, kwargs, key, priority):
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.priority = priority
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.not_before = 0.0  # クォータ超過後の再実行時刻 (monotonic)
+
+
+class SheetsScheduler:
+    """Google Sheets へのすべての呼び出しを通すプロセス共通のスケジューラ
+
+    - 読み込み/書き込みそれぞれのトークンバケットでクォータ内に収める
+    - 同じキーの読み込みが待機中・実行中なら結果を共有する (coalesce)
+    - 優先度付きキューで画面表示の読み込みを書き込みより先に実行する
+    - 429 を受けたら指数バックオフ後の時刻を付けてキューに戻し、スロットル回数を記録する
+      (ワーカーは待たずに他のジョブを実行する)
+    """
+
+    def __init__(self, reads_per_minute=DEFAULT_READS_PER_MINUTE, writes_per_minute=DEFAULT_WRITES_PER_MINUTE, workers=2):
+        self._buckets = {
+            "read": TokenBucket(reads_per_minute),
+            "write": TokenBucket(writes_per_minute),
+        }
+        self._queue = []  # (priority, seq, job)
+        self._seq = itertools.count()
+        self._pending_reads = {}  # key -> job (待機中・実行中)
+        self._cond = threading.Condition()
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "coalesced": 0,
+            "timed_out": 0,       # 待ち時間を超えて取り消した回数
+            "throttled": 0,       # 429 を受けた回数
+            "bucket_waits": 0,    # トークン待ちになった回数
+            "in_flight": 0,
+            "queue_wait_ms_total": 0.0,
+        }
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"sheets-scheduler-{i}", daemon=True).start()
+
+    # --- 投入 ---
+    def submit(self, kind, fn, *args, key=None, priority=PRIORITY_DEFAULT, **kwargs):
+        """呼び出しをキューに入れて Future を返す (kind: "read" / "write")"""
+        with self._cond:
+            self._stats["submitted"] += 1
+            if kind == "read" and key is not None and key in self._pending_reads:
+                self._stats["coalesced"] += 1
+                return self._pending_reads[key].future
+            job = _Job(kind, fn, args, kwargs, key, priority)
+            if kind == "read" and key is not None:
+                self._pending_reads[key] = job
+            self._queue.append((priority, next(self._seq), job))
+            self._cond.notify()
+            return job.future
+
+    def read(self, key, fn, *args, priority=PRIORITY_USER, timeout=120, **kwargs):
+        """読み込みを実行して結果を返す (同じ key の同時読み込みはまとめる)"""
+        return self._result(self.submit("read", fn, *args, key=key, priority=priority, **kwargs), timeout)
+
+    def write(self, fn, *args, priority=PRIORITY_BACKGROUND, timeout=120, **kwargs):
+        """書き込みを実行して結果を返す"""
+        return self._result(self.submit("write", fn, *args, priority=priority, **kwargs), timeout)
+
+    def _result(self, future, timeout):
+        """結果を待つ。timeout 秒たってもキューに残っていれば取り消して SheetsQuotaError
+
+        実行中のものは取り消せない (書き込みが反映されたのに失敗と伝えると、呼び出し元の再試行で二重に書かれる) ので、
+        結果が出るまで待つ。
+        """
+        error = SheetsQuotaError(f"Sheets API の待ち時間が {timeout} 秒を超えました")
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            pass
+        except CancelledError:
+            # まとめた読み込みを別の呼び出し元が取り消した
+            raise error from None
+        while True:
+            # 待ちが長引くのはクォータ待ちでキューが詰まっているとき
+            if self._cancel_queued(future):
+                raise error
+            try:
+                return future.result(1.0)
+            except FutureTimeoutError:
+                continue
+            except CancelledError:
+                raise error from None
+
+    def _cancel_queued(self, future):
+        """future のジョブがまだキューにあれば (バックオフ中を含む) 取り除いて取り消す"""
+        with self._cond:
+            for entry in self._queue:
+                job = entry[2]
+                if job.future is future:
+                    self._queue.remove(entry)
+                    if job.key is not None and self._pending_reads.get(job.key) is job:
+                        del self._pending_reads[job.key]
+                    self._stats["timed_out"] += 1
+                    future.cancel()
+                    return True
+        return False
+
+    # --- 実行 ---
+    def _next_job(self):
+        """トークンを取得できる最優先のジョブを取り出す (なければ待機)"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                blocked = {}  # kind -> 次のトークンまでの秒数
+                waits = []    # バックオフ中のジョブの再実行までの秒数
+                for entry in sorted(self._queue):
+                    job = entry[2]
+                    if job.not_before > now:
+                        waits.append(job.not_before - now)
+                        continue
+                    if job.kind in blocked:
+                        continue
+                    delay = self._buckets[job.kind].try_acquire()
+                    if delay:
+                        blocked[job.kind] = delay
+                        continue
+                    self._queue.remove(entry)
+                    self._stats["in_flight"] += 1
+                    if not job.attempts:
+                        self._stats["queue_wait_ms_total"] += (now - job.enqueued_at) * 1000
+                    return job
+                if blocked:
+                    self._stats["bucket_waits"] += 1
+                waits.extend(blocked.values())
+                self._cond.wait(timeout=min(waits) if waits else None)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                if not is_quota_error(e):
+                    self._finish(job, error=e)
+                elif not self._retry_later(job):
+                    self._finish(job, error=SheetsQuotaError(str(e)))
+            else:
+                self._finish(job, result=result)
+
+    def _retry_later(self, job):
+        """クォータ超過: バックオフ後の時刻を付けてキューに戻す (リトライ回数を超えたら False)"""
+        with self._cond:
+            self._stats["throttled"] += 1
+            self._buckets[job.kind].drain()
+            if job.attempts >= QUOTA_RETRIES:
+                return False
+            job.not_before = time.monotonic() + min(60, 2 ** job.attempts) + random.uniform(0, 1)
+            job.attempts += 1
+            self._stats["in_flight"] -= 1
+            self._queue.append((job.priority, next(self._seq), job))
+            self._cond.notify_all()
+            return True
+
+    def _finish(self, job, result=None, error=None):
+        with self._cond:
+            self._stats["in_flight"] -= 1
+            self._stats["failed" if error else "completed"] += 1
+            if job.key is not None and self._pending_reads.get(job.key) is job:
+                del self._pending_reads[job.key]
+            self._cond.notify_all()
+        if error:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    # --- メトリクス ---
+    def metrics(self):
+        """キューの深さ・スロットル回数などを返す"""
+        with self._cond:
+            depth = {"read": 0, "write": 0}
+            for _, _, job in self._queue:
+                depth[job.kind] += 1
+            for bucket in self._buckets.values():
+                bucket._refill()
+            stats = dict(self._stats)
+            started = stats["completed"] + stats["failed"] + stats["in_flight"]
+            stats["avg_queue_wait_ms"] = stats.pop("queue_wait_ms_total") / started if started else 0.0
+            stats["queue_depth"] = depth
+            stats["tokens"] = {kind: round(b.tokens, 1) for kind, b in self._buckets.items()}
+            return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """プロセス共通のスケジューラを取得 (secrets の SHEETS_READS_PER_MINUTE / SHEETS_WRITES_PER_MINUTE で調整)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            reads, writes = DEFAULT_READS_PER_MINUTE, DEFAULT_WRITES_PER_MINUTE
+            try:
+                import streamlit as st
+                reads = int(st.secrets.get("SHEETS_READS_PER_MINUTE", reads))
+                writes = int(st.secrets.get("SHEETS_WRITES_PER_MINUTE", writes))
+            except Exception:
+                pass
+            _scheduler = SheetsScheduler(reads, writes)
+        return _scheduler
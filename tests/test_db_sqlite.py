@@ -0,0 +1,42 @@
+import pytest
+
+from db_sqlite import SQLiteBackend
+
+
+def test_save_categorized_image_recategorizes_existing_file(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "app.db"))
+    assert backend.save_categorized_image("f1", "https://example.com/f1", "寝室", "ベッド", "folder")
+    assert backend.save_categorized_image("f1", "https://example.com/f1", "キッチン", "コンロ", "folder")
+
+    images = backend.get_categorized_images()
+    assert len(images) == 1
+    assert images[0]["category"] == "キッチン"
+    assert images[0]["description"] == "コンロ"
+    assert backend.get_category_counts() == {"キッチン": 1}
+
+
+def test_migrate_refuses_non_empty_target_without_force(tmp_path, monkeypatch):
+    import db
+    import migrate_sheets_to_sqlite
+
+    class FakeSheets:
+        def __init__(self, sheet_key=None):
+            pass
+
+        def worksheet(self, table):
+            return True
+
+        def iter_row_chunks(self, table, chunk_size=5000):
+            columns = db.TABLE_HEADERS[table]
+            yield [{c: f"{table}-{c}" for c in columns}]
+
+    monkeypatch.setattr(db, "SheetsBackend", FakeSheets)
+    path = str(tmp_path / "app.db")
+    migrate_sheets_to_sqlite.migrate(path)
+    with pytest.raises(SystemExit):
+        migrate_sheets_to_sqlite.migrate(path)
+    migrate_sheets_to_sqlite.migrate(path, force=True)
+
+    backend = SQLiteBackend(path)
+    assert backend.count_rows("gallery_data") == 1
+    assert backend.count_rows("categorized_images") == 1
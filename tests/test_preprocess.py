@@ -0,0 +1,42 @@
+import base64
+import io
+import random
+
+import pytest
+from PIL import Image
+
+import preprocess
+
+TAB1_ENGINES = ["Nano Banana Pro", "Flux 2 Flex", "Seedream 4.5 Edit", "GPT Image 1.5"]
+
+
+def _encoded_size(image):
+    # app.image_to_base64 と同じ変換 (JPEG quality=90 → base64)
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=90)
+    return len(base64.b64encode(buffered.getvalue()))
+
+
+@pytest.fixture(scope="module")
+def photo():
+    # 圧縮しにくい (ノイズの多い) 大きな写真を想定
+    rng = random.Random(0)
+    small = Image.frombytes("RGB", (400, 300), bytes(rng.randrange(256) for _ in range(400 * 300 * 3)))
+    return small.resize((4000, 3000), Image.BILINEAR)
+
+
+@pytest.mark.parametrize("resolution", ["1K", "2K", "4K"])
+def test_tab1_inputs_stay_within_baseline_thumbnail(photo, resolution):
+    baseline = photo.copy()
+    baseline.thumbnail((1024, 1024))
+    baseline_size = _encoded_size(baseline)
+
+    _, variants, _ = preprocess.plan_inputs(photo, TAB1_ENGINES, "16:9", resolution)
+    for variant in variants.values():
+        assert max(variant.size) <= preprocess.DEFAULT_INPUT_EDGE
+        assert _encoded_size(variant) <= baseline_size
+
+
+def test_profile_can_ask_for_larger_input():
+    target = preprocess.get_profile("Veo 3.1").target("16:9")
+    assert target.input_edge == 1920
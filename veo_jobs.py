@@ -0,0 +1,410 @@
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import media_budget
+import video_downloader
+
+GENERATE_URL = "https://api.kie.ai/api/v1/veo/generate"
+RECORD_INFO_URL = "https://api.kie.ai/api/v1/veo/record-info"
+
+POLL_INTERVAL = 5        # record-info を確認する間隔 (秒)
+JOB_TIMEOUT = 600        # 送信から10分でタイムアウト
+QUEUE_TIMEOUT = 1800     # 送信できないまま (レート制限の再試行が続くなど) 作成から30分でタイムアウト
+POLL_WORKERS = 4
+FINISHED_JOB_TTL = 3600  # 完了したジョブを一覧に残す時間 (秒)
+# KIE の同時実行数の上限に合わせて、1つの API キーで同時に生成するタスク数を制限する
+DEFAULT_MAX_CONCURRENT_JOBS = 5
+SUBMIT_INTERVAL = 1.0    # 送信の最小間隔 (秒)
+SUBMIT_RETRY_DELAY = 15  # レート制限を受けたら待つ時間 (秒)
+MAX_BATCH_JOBS = 24
+
+# ジョブの状態
+STATUS_QUEUED = "queued"        # 送信待ち (同時実行数の上限に達している)
+STATUS_GENERATING = "generating"
+STATUS_SAVING = "saving"        # 生成完了、ギャラリーへの保存中 (ポーリングの対象から外す)
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_GENERATING, STATUS_SAVING)
+
+logger = logging.getLogger(__name__)
+
+
+class VeoSubmitError(Exception):
+    """veo/generate へのタスク送信に失敗した"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def estimated_duration(model_id):
+    # 目安: Fast は約2分、Quality は約5分
+    return 120 if "fast" in model_id else 300
+
+
+def parse_result_urls(data):
+    """record-info の data から動画URLのリストを取り出す"""
+    if "response" in data and data["response"] and "resultUrls" in data["response"]:
+        return data["response"]["resultUrls"] or []
+    if "resultUrls" in data:
+        # Fallback or older API style
+        if isinstance(data["resultUrls"], str):
+            return json.loads(data["resultUrls"])
+        return data["resultUrls"] or []
+    return []
+
+
+class VeoJob:
+    """1件の動画生成タスク (送信前は task_id が None)"""
+
+    def __init__(self, session_id, api_key, payload, model_name, batch_id=None):
+        self.job_id = uuid.uuid4().hex
+        self.task_id = None
+        self.session_id = session_id
+        self.api_key = api_key
+        self.payload = payload
+        self.prompt = payload["prompt"]
+        self.model_id = payload["model"]
+        self.model_name = model_name
+        self.aspect_ratio = payload.get("aspectRatio")
+        self.seed = payload.get("seed")
+        self.batch_id = batch_id
+        self.status = STATUS_QUEUED
+        self.error = None
+        self.video_urls = []
+        self.video_paths = {}  # url -> ダウンロード先 (バックグラウンドで取得)
+        self.created_at = time.time()
+        self.submitted_at = None
+        self.finished_at = None
+        self.last_polled_at = None
+        self.not_before = 0.0  # レート制限を受けたときの再送信時刻
+        self.delivered = False
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.created_at
+
+    @property
+    def progress(self):
+        """経過時間から推定した進捗 (0.0〜1.0)"""
+        if self.status == STATUS_SUCCEEDED:
+            return 1.0
+        if self.submitted_at is None:
+            return 0.0
+        return min((time.time() - self.submitted_at) / estimated_duration(self.model_id), 0.95)
+
+
+def post_generate(api_key, payload):
+    """veo/generate にタスクを送信して taskId を返す (失敗時は VeoSubmitError)"""
+    import requests  # 起動時には読み込まない (送信・確認のときだけ使う)
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    res = requests.post(GENERATE_URL, headers=headers, json=payload, timeout=60)
+    if res.status_code != 200:
+        raise VeoSubmitError(f"API Error ({res.status_code}): {res.text}", retryable=res.status_code in (429, 503))
+    resp_data = res.json()
+    if resp_data.get("code") != 200:
+        raise VeoSubmitError(f"Request Failed: {resp_data.get('msg')}", retryable=resp_data.get("code") in (429, 455))
+    return resp_data["data"]["taskId"]
+
+
+def batch_payloads(base_payload, prompts, seeds, aspect_ratios, models, image_urls_by_aspect=None):
+    """プロンプト × シード × 比率 × モデルの組み合わせごとの (payload, モデル表示名) を返す
+
+    seeds の None はランダム、models は [(model_id, 表示名), ...]。
+    image_urls_by_aspect: 比率ごとの開始フレーム画像のURL (比率に合わせて切り抜いたもの)
+    """
+    payloads = []
+    for prompt, seed, aspect_ratio, (model_id, model_name) in itertools.product(prompts, seeds, aspect_ratios, models):
+        payload = dict(base_payload, prompt=prompt, model=model_id, aspectRatio=aspect_ratio)
+        payload.pop("seed", None)
+        if image_urls_by_aspect:
+            payload["imageUrls"] = image_urls_by_aspect[aspect_ratio]
+        if seed:
+            payload["seed"] = seed
+        payloads.append((payload, model_name))
+    return payloads
+
+
+class VeoJobManager:
+    """Veo の動画生成タスクをプロセス共通で管理する
+
+    - submit() / submit_batch() はタスクをキューに入れてすぐに戻る (スクリプトは待たない)
+    - キューのタスクは API キーごとの同時実行数の上限 (max_concurrent_jobs) を守りながら
+      バックグラウンドで順に送信する
+    - 1本のバックグラウンドスレッドが全セッションの生成中タスクを POLL_INTERVAL ごとに
+      record-info でまとめて確認する
+    - 完了したら動画のダウンロードを開始し、ギャラリー (DB) に保存する
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL, timeout=JOB_TIMEOUT, poll_workers=POLL_WORKERS,
+                 max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS, queue_timeout=QUEUE_TIMEOUT):
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self._jobs = {}  # job_id -> VeoJob
+        self._in_flight = set()  # 送信中・問い合わせ中の job_id
+        self._last_submit_at = {}  # api_key -> 最後に送信した時刻
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="veo-poll")
+        self._stats = {"submitted": 0, "submit_retries": 0, "polls": 0, "poll_errors": 0, "succeeded": 0, "failed": 0, "timeout": 0}
+        threading.Thread(target=self._poll_loop, name="veo-poller", daemon=True).start()
+
+    # --- 投入 ---
+    def submit(self, session_id, api_key, payload, model_name):
+        """1件のタスクをキューに入れ、VeoJob を返す
+
+        送信はバッチと同じくバックグラウンドで行い、同時実行数の上限を守る
+        (送信の失敗はジョブの error に入る)。
+        """
+        job = VeoJob(session_id, api_key, payload, model_name)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._wakeup.set()
+        return job
+
+    def submit_batch(self, session_id, api_key, payloads):
+        """[(payload, モデル表示名), ...] をキューに入れ、(batch_id, ジョブのリスト) を返す
+
+        送信はバックグラウンドで行うため、結果はすべてのジョブが並行して進み、
+        全体の所要時間は同時実行数の上限内なら最も長いジョブとほぼ同じになる。
+        """
+        if len(payloads) > MAX_BATCH_JOBS:
+            raise VeoSubmitError(f"1回のバッチは {MAX_BATCH_JOBS} 件までです ({len(payloads)} 件)")
+        batch_id = uuid.uuid4().hex
+        jobs = [VeoJob(session_id, api_key, payload, model_name, batch_id=batch_id) for payload, model_name in payloads]
+        with self._lock:
+            for job in jobs:
+                self._jobs[job.job_id] = job
+        self._wakeup.set()
+        return batch_id, jobs
+
+    # --- 参照 ---
+    def jobs_for(self, session_id):
+        """セッションのジョブを新しい順に返す"""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.session_id == session_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def has_active_jobs(self, session_id):
+        return any(job.active for job in self.jobs_for(session_id))
+
+    def take_results(self, session_id):
+        """完了してまだセッションに渡していない動画を [(job, url, ダウンロード先), ...] で返す"""
+        results = []
+        with self._lock:
+            for job in self._jobs.values():
+                if job.session_id != session_id or job.status != STATUS_SUCCEEDED or job.delivered:
+                    continue
+                job.delivered = True
+                for url in job.video_urls:
+                    results.append((job, url, job.video_paths.get(url)))
+        return results
+
+    def dismiss(self, job_id):
+        """終了したジョブを一覧から消す"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and not job.active:
+                del self._jobs[job_id]
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queued"] = sum(job.status == STATUS_QUEUED for job in self._jobs.values())
+            stats["active"] = sum(job.active for job in self._jobs.values())
+            stats["jobs"] = len(self._jobs)
+        return stats
+
+    # --- バックグラウンドのポーリング ---
+    def _poll_loop(self):
+        wait = self.poll_interval
+        while True:
+            self._wakeup.wait(timeout=wait)
+            self._wakeup.clear()
+            # 想定外の例外でスレッドが終わると、以降どのジョブも確認されなくなる
+            try:
+                wait = self._poll_once()
+            except Exception:
+                logger.exception("Veo poll loop error")
+                wait = self.poll_interval
+
+    def _poll_once(self):
+        """1回分の確認・送信・片付けを行い、次に確認するまでの間隔を返す"""
+        now = time.time()
+        with self._lock:
+            due = [
+                job for job in self._jobs.values()
+                if job.status == STATUS_GENERATING and job.job_id not in self._in_flight
+                and (job.last_polled_at is None or now - job.last_polled_at >= self.poll_interval)
+            ]
+            for job in due:
+                job.last_polled_at = now
+                self._in_flight.add(job.job_id)
+            self._expire_queued(now)
+            to_submit = self._next_submissions(now)
+            # 送信待ちが残っていれば、次の送信枠まで短い間隔で確認する
+            has_queued = any(job.status == STATUS_QUEUED for job in self._jobs.values())
+            wait = min(self.poll_interval, SUBMIT_INTERVAL) if has_queued else self.poll_interval
+            # 完了から時間のたったジョブは片付ける
+            for job_id, job in list(self._jobs.items()):
+                if job.finished_at and now - job.finished_at > FINISHED_JOB_TTL:
+                    del self._jobs[job_id]
+        # 生成中のジョブは少数のワーカーでまとめて問い合わせる (完了後の動画取得で他のジョブを待たせない)
+        for job in due:
+            self._pool.submit(self._poll_job, job)
+        for job in to_submit:
+            self._pool.submit(self._submit_job, job)
+        return wait
+
+    def _expire_queued(self, now):
+        """作成から queue_timeout 秒たっても送信できていないジョブをタイムアウトにする (ロックを取った状態で呼ぶ)"""
+        for job in self._jobs.values():
+            if job.status == STATUS_QUEUED and job.job_id not in self._in_flight and now - job.created_at > self.queue_timeout:
+                job.status = STATUS_TIMEOUT
+                job.error = "送信待ちのままタイムアウトしました。"
+                job.finished_at = now
+                self._stats[STATUS_TIMEOUT] += 1
+
+    def _next_submissions(self, now):
+        """送信待ちのジョブのうち、今送信してよいものを古い順に選ぶ (ロックを取った状態で呼ぶ)"""
+        running = {}  # api_key -> 生成中・送信中の件数
+        for job in self._jobs.values():
+            if job.status == STATUS_GENERATING or (job.status == STATUS_QUEUED and job.job_id in self._in_flight):
+                running[job.api_key] = running.get(job.api_key, 0) + 1
+        selected = []
+        queued = sorted(
+            (job for job in self._jobs.values() if job.status == STATUS_QUEUED and job.job_id not in self._in_flight),
+            key=lambda job: job.created_at,
+        )
+        for job in queued:
+            if job.not_before > now or running.get(job.api_key, 0) >= self.max_concurrent_jobs:
+                continue
+            # 同じキーの送信は SUBMIT_INTERVAL 秒ずつ空ける
+            submit_at = max(now, self._last_submit_at.get(job.api_key, 0) + SUBMIT_INTERVAL)
+            if submit_at > now:
+                continue
+            self._last_submit_at[job.api_key] = submit_at
+            running[job.api_key] = running.get(job.api_key, 0) + 1
+            self._in_flight.add(job.job_id)
+            selected.append(job)
+        return selected
+
+    def _submit_job(self, job):
+        try:
+            task_id = post_generate(job.api_key, job.payload)
+        except Exception as e:
+            retryable = isinstance(e, VeoSubmitError) and e.retryable
+            with self._lock:
+                if retryable:
+                    # レート制限: キューに残して後で送り直す
+                    job.not_before = time.time() + SUBMIT_RETRY_DELAY
+                    self._stats["submit_retries"] += 1
+                self._in_flight.discard(job.job_id)
+            if not retryable:
+                self._finish(job, STATUS_FAILED, error=str(e))
+            return
+        with self._lock:
+            job.task_id = task_id
+            job.status = STATUS_GENERATING
+            job.submitted_at = time.time()
+            self._stats["submitted"] += 1
+            self._in_flight.discard(job.job_id)
+
+    def _poll_job(self, job):
+        try:
+            self._check_job(job)
+        finally:
+            with self._lock:
+                self._in_flight.discard(job.job_id)
+
+    def _check_job(self, job):
+        import requests
+        if time.time() - job.submitted_at > self.timeout:
+            self._finish(job, STATUS_TIMEOUT, error="タイムアウトしました。")
+            return
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {job.api_key}"}
+        try:
+            poll_res = requests.get(RECORD_INFO_URL, params={"taskId": job.task_id}, headers=headers, timeout=30)
+            with self._lock:
+                self._stats["polls"] += 1
+            if poll_res.status_code != 200:
+                return
+            poll_data = poll_res.json()
+            if poll_data.get("code") != 200:
+                return
+            data = poll_data["data"]
+            success_flag = data.get("successFlag")
+            # 0: Generating, 1: Success, 2/3: Failed
+            if success_flag == 1:
+                self._complete(job, parse_result_urls(data))
+            elif success_flag in [2, 3]:
+                self._finish(job, STATUS_FAILED, error=f"生成失敗: {poll_data.get('msg', 'Unknown error')}")
+        except Exception as e:
+            with self._lock:
+                self._stats["poll_errors"] += 1
+            logger.warning("Veo polling error (%s): %s", job.task_id, e)
+
+    def _complete(self, job, video_urls):
+        # 先に生成中から外す (保存に失敗しても、次のポーリングで二重に保存・ダウンロードしない)
+        with self._lock:
+            if job.status != STATUS_GENERATING:
+                return
+            job.status = STATUS_SAVING
+        try:
+            downloader = video_downloader.get_downloader()
+            for v_url in video_urls:
+                # セッションの「ダウンロード」ボタン用に、動画をディスクへバックグラウンドで取得しておく
+                job.video_paths[v_url] = video_downloader.default_path(v_url)
+                future = downloader.submit(v_url, job.video_paths[v_url])
+                future.add_done_callback(lambda f, url=v_url: self._register_download(f, job, url))
+                db.save_result(v_url, job.prompt, f"Veo 3.1 ({job.model_name})")
+        except Exception as e:
+            logger.warning("Veo result save error (%s): %s", job.task_id, e)
+            self._finish(job, STATUS_FAILED, error=f"結果の保存に失敗しました: {e}")
+            return
+        job.video_urls = list(video_urls)
+        self._finish(job, STATUS_SUCCEEDED)
+
+    def _register_download(self, future, job, url):
+        """ダウンロードが終わった動画をメディア予算に登録する (ディスク上限を超えたら古いものから消える)"""
+        if future.exception() is None:
+            media_budget.get_budget().register_file(job.video_paths[url], future.result(), url=url, session_id=job.session_id)
+
+    def _finish(self, job, status, error=None):
+        with self._lock:
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+            self._stats[status] += 1
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """プロセス共通のジョブマネージャーを取得 (secrets の VEO_MAX_CONCURRENT_JOBS で同時実行数を調整)"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            max_concurrent_jobs = DEFAULT_MAX_CONCURRENT_JOBS
+            try:
+                import streamlit as st
+                max_concurrent_jobs = int(st.secrets.get("VEO_MAX_CONCURRENT_JOBS", max_concurrent_jobs))
+            except Exception:
+                pass
+            _manager = VeoJobManager(max_concurrent_jobs=max_concurrent_jobs)
+        return _manager
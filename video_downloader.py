@@ -0,0 +1,299 @@
+"""生成された動画をディスクへストリーミングでダウンロードする
+
+- Range リクエストに対応したサーバーからは、大きいファイルを複数の区間に分けて並列に取得する
+- 途中の状態を <保存先>.part.json に記録し、中断しても取得済みの区間から再開する
+- 受信したバイト数 (区間ごと) を Content-Length と照合してから保存先に置き換える
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+DEFAULT_DOWNLOAD_DIR = "data/videos"
+SEGMENT_SIZE = 8 * 1024 * 1024   # 並列ダウンロードの1区間
+STREAM_CHUNK_SIZE = 256 * 1024
+STATE_SAVE_BYTES = 4 * 1024 * 1024  # 途中の状態を書き出す間隔 (区間ごとの受信バイト数)
+SEGMENT_WORKERS = 4              # 1ファイルあたりの並列数
+DOWNLOAD_WORKERS = 2             # 同時にダウンロードするファイル数
+MAX_RETRIES = 5
+TIMEOUT = (10, 60)               # (接続, 読み込み) 秒
+
+
+class DownloadError(Exception):
+    """リトライしてもダウンロードできなかった"""
+
+
+class DownloadStatus:
+    """1ファイルのダウンロード状況"""
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.total = None
+        self.downloaded = 0
+        self.resumed = 0  # 前回までに取得済みだったバイト数
+        self.status = "pending"  # pending / downloading / done / failed
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.downloaded += n
+
+    @property
+    def throughput(self):
+        """今回の転送速度 (bytes/s)"""
+        if not self.started_at:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return (self.downloaded - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "path": self.path,
+            "status": self.status,
+            "total": self.total,
+            "downloaded": self.downloaded,
+            "throughput_mbps": round(self.throughput * 8 / 1e6, 2),
+            "error": self.error,
+        }
+
+
+def default_path(url, download_dir=DEFAULT_DOWNLOAD_DIR):
+    """URL から保存先を決める (同じURLは同じファイルになる)"""
+    name = os.path.basename(urlparse(url).path) or "video.mp4"
+    digest = hashlib.md5(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(download_dir, f"{digest}_{name}")
+
+
+class VideoDownloader:
+    def __init__(self, segment_size=SEGMENT_SIZE, segment_workers=SEGMENT_WORKERS,
+                 download_workers=DOWNLOAD_WORKERS, max_retries=MAX_RETRIES, timeout=TIMEOUT):
+        self.segment_size = segment_size
+        self.segment_workers = segment_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._local = threading.local()  # requests.Session はスレッドごとに持つ
+        self._pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="video-download")
+        self._statuses = {}  # path -> DownloadStatus
+        self._futures = {}   # path -> Future (同じファイルを二重にダウンロードしない)
+        self._lock = threading.Lock()
+
+    def _session(self):
+        import requests  # requests は実際にダウンロードするときに読み込む (アプリの起動時間の短縮)
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    # --- バックグラウンド実行 ---
+    def submit(self, url, path=None):
+        """ダウンロードをバックグラウンドで開始し、Future (結果は保存先のパス) を返す"""
+        path = path or default_path(url)
+        status = self._status_for(url, path)
+        with self._lock:
+            future = self._futures.get(path)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._futures[path] = self._pool.submit(self._download_status, status)
+            return future
+
+    def statuses(self):
+        with self._lock:
+            return [status.to_dict() for status in self._statuses.values()]
+
+    def _status_for(self, url, path):
+        with self._lock:
+            status = self._statuses.get(path)
+            if status is None or status.status == "failed":
+                status = self._statuses[path] = DownloadStatus(url, path)
+            return status
+
+    # --- ダウンロード ---
+    def download(self, url, path=None):
+        """呼び出し元のスレッドでダウンロードし、保存先のパスを返す (失敗時は DownloadError)"""
+        return self._download_status(self._status_for(url, path or default_path(url)))
+
+    def _download_status(self, status):
+        if os.path.exists(status.path) and not os.path.exists(status.path + ".part.json"):
+            status.status = "done"
+            return status.path
+        if os.path.dirname(status.path):
+            os.makedirs(os.path.dirname(status.path), exist_ok=True)
+        status.status = "downloading"
+        status.started_at = time.time()
+        try:
+            total, ranges = self._probe(status.url)
+            status.total = total
+            if total and ranges:
+                self._download_segments(status)
+            else:
+                self._download_single(status)
+            self._verify(status)
+        except Exception as e:
+            status.status = "failed"
+            status.error = str(e)
+            status.finished_at = time.time()
+            raise DownloadError(f"{status.url}: {e}") from e
+        os.replace(status.path + ".part", status.path)
+        self._remove(status.path + ".part.json")
+        status.status = "done"
+        status.finished_at = time.time()
+        return status.path
+
+    def _probe(self, url):
+        """(Content-Length, Range 対応) を調べる"""
+        import requests
+        try:
+            with self._session().head(url, allow_redirects=True, timeout=self.timeout) as res:
+                if res.status_code == 200:
+                    length = res.headers.get("Content-Length")
+                    return (int(length) if length else None), res.headers.get("Accept-Ranges") == "bytes"
+        except requests.RequestException:
+            pass
+        # HEAD を受け付けないサーバーは先頭1バイトの Range リクエストで確認する
+        res = self._session().get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.timeout)
+        res.close()
+        if res.status_code == 206:
+            content_range = res.headers.get("Content-Range", "")
+            total = content_range.rsplit("/", 1)[-1]
+            return (int(total) if total.isdigit() else None), True
+        length = res.headers.get("Content-Length")
+        return (int(length) if length else None), False
+
+    def _load_state(self, status):
+        """取得済みの区間 {開始位置: 取得済みバイト数} を読む (サイズが変わっていれば捨てる)"""
+        state_path = status.path + ".part.json"
+        if os.path.exists(state_path) and os.path.exists(status.path + ".part"):
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("total") == status.total and state.get("url") == status.url:
+                return {int(k): v for k, v in state["segments"].items()}
+        return {}
+
+    def _download_segments(self, status):
+        import requests
+        part_path = status.path + ".part"
+        done = self._load_state(status)
+        if not done:
+            with open(part_path, "wb") as f:
+                f.truncate(status.total)
+        status.resumed = status.downloaded = sum(done.values())
+        segments = [
+            (start, min(start + self.segment_size, status.total) - start)
+            for start in range(0, status.total, self.segment_size)
+        ]
+        state_lock = threading.Lock()
+
+        def save_state():
+            tmp_path = status.path + ".part.json.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"url": status.url, "total": status.total, "segments": done}, f)
+            os.replace(tmp_path, status.path + ".part.json")
+
+        def fetch(segment):
+            start, length = segment
+            session = self._session()
+            fd = os.open(part_path, os.O_WRONLY)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    # 区間の途中で切れた場合は続きから取得する
+                    offset = saved = done.get(start, 0)
+                    if offset >= length:
+                        return
+                    try:
+                        with session.get(
+                            status.url, stream=True, timeout=self.timeout,
+                            headers={"Range": f"bytes={start + offset}-{start + length - 1}"},
+                        ) as res:
+                            if res.status_code != 206:
+                                raise DownloadError(f"Range request returned {res.status_code}")
+                            for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+                                chunk = chunk[:length - offset]
+                                os.pwrite(fd, chunk, start + offset)
+                                offset += len(chunk)
+                                status.add(len(chunk))
+                                # 状態ファイルは STATE_SAVE_BYTES ごとと区間の終わりにだけ書く
+                                if offset >= length or offset - saved >= STATE_SAVE_BYTES:
+                                    with state_lock:
+                                        done[start] = saved = offset
+                                        save_state()
+                                if offset >= length:
+                                    break
+                        if offset >= length:
+                            return
+                    except (requests.RequestException, DownloadError):
+                        if attempt == self.max_retries:
+                            raise
+                    finally:
+                        # 途中で切れても受信済みの分から再開できるようにする
+                        if offset > saved:
+                            with state_lock:
+                                done[start] = saved = offset
+                                save_state()
+                    time.sleep(min(30, 2 ** attempt))
+                raise DownloadError(f"segment {start} incomplete")
+            finally:
+                os.close(fd)
+
+        pending = [s for s in segments if done.get(s[0], 0) < s[1]]
+        with ThreadPoolExecutor(max_workers=self.segment_workers) as pool:
+            for future in [pool.submit(fetch, s) for s in pending]:
+                future.result()
+        # .part は最初に total まで伸ばしてあるのでファイルサイズでは確認できない。区間ごとの受信バイト数を照合する
+        missing = [start for start, length in segments if done.get(start, 0) != length]
+        if missing:
+            raise DownloadError(f"{len(missing)} segment(s) incomplete (first at byte {missing[0]})")
+
+    def _download_single(self, status):
+        """Range 非対応のサーバー: 先頭から1本でストリーミングする"""
+        import requests
+        part_path = status.path + ".part"
+        for attempt in range(self.max_retries + 1):
+            status.downloaded = 0
+            try:
+                with self._session().get(status.url, stream=True, timeout=self.timeout) as res:
+                    res.raise_for_status()
+                    length = res.headers.get("Content-Length")
+                    status.total = int(length) if length else status.total
+                    with open(part_path, "wb") as f:
+                        for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+                            f.write(chunk)
+                            status.add(len(chunk))
+                if status.total is None or status.downloaded == status.total:
+                    return
+            except requests.RequestException:
+                if attempt == self.max_retries:
+                    raise
+            time.sleep(min(30, 2 ** attempt))
+        raise DownloadError(f"received {status.downloaded} of {status.total} bytes")
+
+    def _verify(self, status):
+        size = os.path.getsize(status.path + ".part")
+        if status.total is not None and size != status.total:
+            raise DownloadError(f"size mismatch: {size} != Content-Length {status.total}")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader():
+    """プロセス共通のダウンローダーを取得"""
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = VideoDownloader()
+        return _downloader